@@ -0,0 +1,151 @@
+import os
+import asyncio
+import logging
+import threading
+from typing import Callable, Dict, Optional, Tuple
+
+from faiss_agent import RagAgent
+
+logger = logging.getLogger("agent_registry")
+
+# Caches the agent derives from the index files and writes while loading
+# (e.g. the legacy store's BM25 index); they are not index changes
+DERIVED_SUFFIXES = ("_bm25.npz",)
+
+
+class AgentRegistry:
+    """
+    Process-level holder for the shared RagAgent.
+
+    The agent (FAISS index, texts, metadata and tokenizer) is loaded once and
+    handed out to every request. When the files backing the index change on
+    disk, a new agent is built off the event loop and swapped in with a single
+    reference assignment, so requests that already hold the old agent finish
+    against it undisturbed.
+    """
+
+    def __init__(
+        self,
+        agent_factory: Callable[[], RagAgent],
+        faiss_dir: str,
+        index_name: str = "water-treatment",
+        poll_interval: float = 5.0
+    ):
+        """
+        Initialize the registry.
+
+        Args:
+            agent_factory: Callable that builds a fully loaded RagAgent
+            faiss_dir: Directory containing the FAISS index and related files
+            index_name: Base name of the FAISS index
+            poll_interval: Seconds between checks for changed index files
+        """
+        self.agent_factory = agent_factory
+        self.faiss_dir = faiss_dir
+        self.index_name = index_name
+        self.poll_interval = poll_interval
+        self._agent: Optional[RagAgent] = None
+        self._signature: Optional[Tuple] = None
+        # Signature of index files that failed to load; not retried until they change
+        self._failed_signature: Optional[Tuple] = None
+        self._reload_lock = threading.Lock()
+        self._watch_task: Optional[asyncio.Task] = None
+
+    @property
+    def ready(self) -> bool:
+        """True once an agent with a loaded index is available."""
+        return self._agent is not None and self._agent.index is not None
+
+    def get(self) -> RagAgent:
+        """Return the current agent. Raises RuntimeError if none is loaded yet."""
+        agent = self._agent
+        if agent is None:
+            raise RuntimeError("RagAgent is not loaded yet")
+        return agent
+
+    def index_signature(self) -> Tuple:
+        """Fingerprint of the index files (name, size, mtime) used to detect changes, derived caches excluded."""
+        entries = []
+        try:
+            names = sorted(os.listdir(self.faiss_dir))
+        except FileNotFoundError:
+            return ()
+        for name in names:
+            if not name.startswith(self.index_name) or name.endswith(DERIVED_SUFFIXES):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.faiss_dir, name))
+            except FileNotFoundError:
+                continue
+            entries.append((name, stat.st_size, stat.st_mtime_ns))
+        return tuple(entries)
+
+    def load(self) -> bool:
+        """
+        Build a new agent and swap it in if its index loaded.
+
+        When the files fail to load, their signature is remembered so the
+        watcher does not rebuild the agent again until they change.
+
+        Returns:
+            True if a new agent was installed, False if the previous one was kept
+        """
+        with self._reload_lock:
+            signature = self.index_signature()
+            try:
+                agent = self.agent_factory()
+            except Exception:
+                self._failed_signature = signature
+                raise
+            if agent.index is None:
+                self._failed_signature = signature
+                logger.error("FAISS index failed to load; keeping the current agent until the index files change")
+                return False
+            # Single reference assignment: in-flight requests keep the old agent
+            self._agent = agent
+            self._signature = signature
+            self._failed_signature = None
+            logger.info(f"Loaded RagAgent with {agent.index.ntotal} vectors from {self.faiss_dir}")
+            return True
+
+    def reload_if_changed(self) -> bool:
+        """Reload the agent when the index files differ from the loaded ones and from the last failed ones."""
+        signature = self.index_signature()
+        if signature == self._signature or signature == self._failed_signature:
+            return False
+        logger.info("FAISS index files changed, reloading RagAgent")
+        return self.load()
+
+    async def _watch(self):
+        """Poll the index files and hot-reload the agent when they change."""
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                await asyncio.to_thread(self.reload_if_changed)
+            except Exception as e:
+                logger.error(f"Error reloading RagAgent: {e}")
+
+    def start_watching(self):
+        """Start the background hot-reload task on the running event loop."""
+        if self._watch_task is None and self.poll_interval > 0:
+            self._watch_task = asyncio.create_task(self._watch())
+
+    async def stop_watching(self):
+        """Cancel the background hot-reload task."""
+        if self._watch_task is not None:
+            self._watch_task.cancel()
+            try:
+                await self._watch_task
+            except asyncio.CancelledError:
+                pass
+            self._watch_task = None
+
+    def status(self) -> Dict[str, object]:
+        """Summary of the loaded index for the readiness endpoint."""
+        agent = self._agent
+        return {
+            "ready": self.ready,
+            "faiss_dir": self.faiss_dir,
+            "index_name": self.index_name,
+            "vectors": agent.index.ntotal if self.ready else 0,
+        }
@@ -0,0 +1,259 @@
+import math
+import time
+import logging
+from dataclasses import dataclass, asdict
+from typing import Any, Dict, List, Optional, Tuple
+
+import faiss
+import numpy as np
+
+logger = logging.getLogger("ann_index")
+
+INDEX_KINDS = ("flat", "ivf_flat", "hnsw", "ivf_pq")
+
+
+@dataclass
+class IndexConfig:
+    """
+    FAISS index type and parameters.
+
+    Build-time fields (nlist, hnsw_m, ef_construction, pq_m, pq_nbits,
+    search_dims) are stored in the snapshot manifest; search-time fields
+    (nprobe, ef_search) are applied when the index is loaded and may be
+    overridden per agent.
+
+    When `search_dims` is set, the index holds Matryoshka-truncated,
+    L2-normalised copies of the embeddings and the full vectors are kept
+    alongside it for re-ranking.
+    """
+    kind: str = "flat"
+    search_dims: int = 0  # 0 = full dimension
+    nlist: int = 0  # 0 = about 4 * sqrt(n)
+    nprobe: int = 8
+    hnsw_m: int = 32
+    ef_construction: int = 200
+    ef_search: int = 64
+    pq_m: int = 64
+    pq_nbits: int = 8
+
+    def __post_init__(self):
+        if self.kind not in INDEX_KINDS:
+            raise ValueError(f"Unsupported index type: {self.kind}. Use one of {', '.join(INDEX_KINDS)}.")
+
+    def to_dict(self) -> Dict[str, Any]:
+        return asdict(self)
+
+    @classmethod
+    def from_dict(cls, data: Optional[Dict[str, Any]]) -> "IndexConfig":
+        data = data or {}
+        return cls(**{key: value for key, value in data.items() if key in cls.__dataclass_fields__})
+
+
+def _nlist(config: IndexConfig, n: int) -> int:
+    nlist = config.nlist or int(4 * math.sqrt(n))
+    # Every inverted list needs training points
+    return max(1, min(nlist, n))
+
+
+def _pq_m(config: IndexConfig, d: int) -> int:
+    """Largest sub-quantizer count <= pq_m that divides the dimension."""
+    m = min(config.pq_m, d)
+    while d % m:
+        m -= 1
+    return m
+
+
+def truncate_embeddings(vectors: np.ndarray, dims: int) -> np.ndarray:
+    """
+    Keep the first `dims` components of each row and L2-normalise them.
+
+    Embeddings trained with Matryoshka representation learning (such as
+    text-embedding-3-*) stay useful when truncated this way. A `dims` of 0
+    or at least the vector dimension returns the vectors unchanged.
+    """
+    vectors = np.asarray(vectors, dtype='float32')
+    if not dims or dims >= vectors.shape[1]:
+        return np.ascontiguousarray(vectors)
+    truncated = np.array(vectors[:, :dims], dtype='float32')
+    norms = np.linalg.norm(truncated, axis=1, keepdims=True)
+    truncated /= np.where(norms > 0, norms, 1)
+    return truncated
+
+
+def rerank(vectors: np.ndarray, queries: np.ndarray, candidates: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Re-score first-pass candidates with full-dimension vectors.
+
+    Args:
+        vectors: Full vectors, typically memory-mapped; only candidate rows are read
+        queries: Full query vectors of shape (n_queries, dim)
+        candidates: Candidate ids of shape (n_queries, n_candidates), -1 for none
+        k: Number of hits to keep per query
+
+    Returns:
+        Tuple of (distances, indices) of shape (n_queries, k) ordered by
+        squared L2 distance, padded with inf / -1
+    """
+    queries = np.asarray(queries, dtype='float32')
+    distances = np.full((len(queries), k), np.inf, dtype='float32')
+    indices = np.full((len(queries), k), -1, dtype='int64')
+    for row, (query, ids) in enumerate(zip(queries, candidates)):
+        # Sorted, unique ids keep reads from the memory-mapped file sequential
+        ids = np.unique(ids[ids >= 0])
+        if not len(ids):
+            continue
+        diffs = np.asarray(vectors[ids], dtype='float32') - query
+        scores = np.einsum('ij,ij->i', diffs, diffs)
+        order = np.argsort(scores, kind='stable')[:k]
+        distances[row, :len(order)] = scores[order]
+        indices[row, :len(order)] = ids[order]
+    return distances, indices
+
+
+def build_ann_index(vectors: np.ndarray, config: IndexConfig):
+    """
+    Build and populate a FAISS index of the configured type.
+
+    Args:
+        vectors: float32 array of shape (n, dim)
+        config: Index type and parameters
+
+    Returns:
+        Trained FAISS index containing `vectors` (truncated to
+        `config.search_dims` if set) with ids 0..n-1
+    """
+    vectors = truncate_embeddings(vectors, config.search_dims)
+    n, d = vectors.shape
+    if config.kind == "flat":
+        index = faiss.IndexFlatL2(d)
+    elif config.kind == "hnsw":
+        index = faiss.IndexHNSWFlat(d, config.hnsw_m)
+        index.hnsw.efConstruction = config.ef_construction
+    elif config.kind == "ivf_flat":
+        index = faiss.IndexIVFFlat(faiss.IndexFlatL2(d), d, _nlist(config, n))
+    else:
+        # 2**nbits centroids per sub-quantizer need at least as many training points
+        nbits = max(1, min(config.pq_nbits, int(math.log2(max(n, 2)))))
+        index = faiss.IndexIVFPQ(faiss.IndexFlatL2(d), d, _nlist(config, n), _pq_m(config, d), nbits)
+    if not index.is_trained:
+        index.train(vectors)
+    index.add(vectors)
+    apply_search_config(index, config)
+    return index
+
+
+def apply_search_config(index, config: IndexConfig):
+    """Set nprobe / efSearch on a loaded index."""
+    if isinstance(index, faiss.IndexIVF):
+        index.nprobe = min(config.nprobe, index.nlist)
+    elif isinstance(index, faiss.IndexHNSW):
+        index.hnsw.efSearch = config.ef_search
+
+
+def search_parameters(index, selector=None):
+    """SearchParameters of the right type for `index`, carrying its current nprobe / efSearch."""
+    if isinstance(index, faiss.IndexIVF):
+        return faiss.SearchParametersIVF(sel=selector, nprobe=index.nprobe)
+    if isinstance(index, faiss.IndexHNSW):
+        return faiss.SearchParametersHNSW(sel=selector, efSearch=index.hnsw.efSearch)
+    return faiss.SearchParameters(sel=selector)
+
+
+def _recall(truth: np.ndarray, found: np.ndarray) -> Optional[float]:
+    if not len(truth):
+        return None
+    hits = sum(len(set(t) & set(f[f >= 0])) for t, f in zip(truth, found))
+    return round(hits / truth.size, 4)
+
+
+def _percentile(latencies: List[float], q: int) -> Optional[float]:
+    return round(float(np.percentile(latencies, q)), 3) if latencies else None
+
+
+def evaluate_index(
+    index,
+    vectors: np.ndarray,
+    queries: np.ndarray,
+    k: int = 10,
+    config: Optional[IndexConfig] = None,
+    rerank_factor: int = 4
+) -> Dict[str, Any]:
+    """
+    Measure recall@k and latency of `index` against exact search.
+
+    Args:
+        index: Index under test, containing `vectors` with ids 0..n-1
+        vectors: The full indexed vectors, used to build the exact baseline
+        queries: Held-out full-dimension query vectors
+        k: Number of neighbours
+        config: Config the index was built with; truncated indexes are
+            queried with truncated queries
+        rerank_factor: For truncated indexes, also report recall and latency
+            after re-ranking `rerank_factor * k` candidates with full vectors
+
+    Returns:
+        Report with recall@k and single-query / batch latency figures
+    """
+    config = config or IndexConfig()
+    queries = np.ascontiguousarray(queries, dtype='float32')
+    search_queries = truncate_embeddings(queries, config.search_dims)
+    k = min(k, len(vectors))
+    exact = faiss.IndexFlatL2(vectors.shape[1])
+    exact.add(np.ascontiguousarray(vectors, dtype='float32'))
+    _, truth = exact.search(queries, k)
+
+    latencies = []
+    found = np.empty_like(truth)
+    for i in range(len(queries)):
+        start = time.perf_counter()
+        _, labels = index.search(search_queries[i:i + 1], k)
+        latencies.append((time.perf_counter() - start) * 1000)
+        found[i] = labels[0]
+
+    start = time.perf_counter()
+    index.search(search_queries, k)
+    batch_ms = (time.perf_counter() - start) * 1000
+
+    report = {
+        "index_type": type(index).__name__,
+        "n_vectors": int(index.ntotal),
+        "dim": int(index.d),
+        "n_queries": int(len(queries)),
+        "k": int(k),
+        f"recall@{k}": _recall(truth, found),
+        "latency_ms_p50": _percentile(latencies, 50),
+        "latency_ms_p95": _percentile(latencies, 95),
+        "batch_ms": round(batch_ms, 3),
+    }
+
+    if index.d < vectors.shape[1] and rerank_factor:
+        n_candidates = min(k * rerank_factor, len(vectors))
+        latencies = []
+        for i in range(len(queries)):
+            start = time.perf_counter()
+            _, candidates = index.search(search_queries[i:i + 1], n_candidates)
+            _, labels = rerank(vectors, queries[i:i + 1], candidates, k)
+            latencies.append((time.perf_counter() - start) * 1000)
+            found[i] = labels[0]
+        report.update({
+            "rerank_factor": int(rerank_factor),
+            f"reranked_recall@{k}": _recall(truth, found),
+            "reranked_latency_ms_p50": _percentile(latencies, 50),
+            "reranked_latency_ms_p95": _percentile(latencies, 95),
+        })
+    return report
+
+
+def holdout_queries(vectors: np.ndarray, n_queries: int = 100, noise: float = 0.1, seed: int = 0) -> np.ndarray:
+    """
+    Query vectors for evaluation when no real queries are supplied.
+
+    Sampled corpus vectors are perturbed with Gaussian noise whose norm is
+    about `noise` times the vector norm, so that each query is not
+    trivially identical to an indexed vector.
+    """
+    rng = np.random.default_rng(seed)
+    picks = rng.choice(len(vectors), size=min(n_queries, len(vectors)), replace=False)
+    base = np.asarray(vectors[picks], dtype='float32')
+    scale = noise * np.linalg.norm(base, axis=1, keepdims=True) / math.sqrt(base.shape[1])
+    return (base + rng.standard_normal(base.shape).astype('float32') * scale).astype('float32')
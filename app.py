@@ -2,10 +2,10 @@ from dotenv import load_dotenv
 load_dotenv('.env.local')
 import os
 
-from fastapi import FastAPI, UploadFile, File, Form
+from fastapi import FastAPI, UploadFile, File, Form, Depends, Request, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import HTMLResponse, JSONResponse
-from typing import Optional, List, Dict, Any
+from fastapi.responses import HTMLResponse, JSONResponse, StreamingResponse
+from typing import Optional, List, Dict, Any, Tuple
 import shutil
 import os
 import pdfplumber
@@ -13,20 +13,196 @@ from schemas import AnalyzeResponse, ExtractedFeatures, Recommendation, Product
 import tempfile
 import re
 import logging
-from faiss_agent import RagAgent, load_lab_report
+from faiss_agent import RagAgent
+from agent_registry import AgentRegistry
+from embedding_cache import EmbeddingCache
+from llm_calls import CallPolicy, LLMCaller, parse_backup_models
+from jobs import JobQueue
+from pdf_pool import PdfExtractionPool
+from report_cache import ReportCache, hash_upload, file_sha256
+from database import engine
+import models
+import uuid
+import zipfile
 import requests
 import mypdf
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI
 from google import genai
 import time
 from requests.auth import HTTPBasicAuth
 from fastapi import Body
+from contextlib import asynccontextmanager
+import asyncio
+import json
 
 # Load environment variables
 from dotenv import load_dotenv
 load_dotenv('.env.local')
 
-app = FastAPI()
+FAISS_DIR = os.getenv("FAISS_DIR", "FAISS")
+FAISS_INDEX_NAME = os.getenv("FAISS_INDEX_NAME", "water-treatment")
+FAISS_RELOAD_INTERVAL = float(os.getenv("FAISS_RELOAD_INTERVAL", "5"))
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", "embedding_cache.db")
+EMBEDDING_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", "4096"))
+FAISS_RERANK_FACTOR = int(os.getenv("FAISS_RERANK_FACTOR", "4"))
+HYBRID_SEARCH = os.getenv("HYBRID_SEARCH", "1") == "1"
+CONTEXT_TOKEN_LIMIT = int(os.getenv("CONTEXT_TOKEN_LIMIT", "100000"))
+MULTI_QUERY_SEARCH = os.getenv("MULTI_QUERY_SEARCH", "0") == "1"
+REPORT_ENCODING = os.getenv("REPORT_ENCODING", "table")  # "table" or "json"
+REPORT_DROP_PASSING = os.getenv("REPORT_DROP_PASSING", "0") == "1"
+SUMMARY_MODE = os.getenv("SUMMARY_MODE", "rules")  # "rules" or "llm"
+QUERY_MODE = os.getenv("QUERY_MODE", "llm")  # "llm" or "template"; requests may override it
+STRUCTURED_OUTPUT = os.getenv("STRUCTURED_OUTPUT", "1") == "1"
+LLM_DEADLINE = float(os.getenv("LLM_DEADLINE", "300"))
+LLM_ATTEMPT_TIMEOUT = float(os.getenv("LLM_ATTEMPT_TIMEOUT", "180"))
+LLM_MAX_ATTEMPTS = int(os.getenv("LLM_MAX_ATTEMPTS", "3"))
+LLM_PARSE_RETRIES = int(os.getenv("LLM_PARSE_RETRIES", "0"))  # resend an unparseable reply; 0 or 1
+LLM_HEDGE = os.getenv("LLM_HEDGE", "0") == "1"
+# e.g. "gpt=gemini:gemini-2.5-flash,gemini=gpt:openai/gpt-4.1-mini"; empty = the other provider, "none" = no backup
+LLM_BACKUP_MODELS = parse_backup_models(os.getenv("LLM_BACKUP_MODELS", ""))
+JOBS_DIR = os.getenv("JOBS_DIR", "jobs")
+BATCH_MAX_REPORTS = int(os.getenv("BATCH_MAX_REPORTS", "100"))
+BATCH_MAX_MB = float(os.getenv("BATCH_MAX_MB", "500"))  # total size of a batch's PDFs, after unzipping
+PDF_POOL_WORKERS = int(os.getenv("PDF_POOL_WORKERS", "0")) or None  # 0 = min(4, CPU count)
+PDF_EXTRACT_TIMEOUT = float(os.getenv("PDF_EXTRACT_TIMEOUT", "60"))
+BATCH_LLM_CONCURRENCY = int(os.getenv("BATCH_LLM_CONCURRENCY", "4"))
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+JOB_DRAIN_TIMEOUT = float(os.getenv("JOB_DRAIN_TIMEOUT", "60"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+PERSIST_REPORTS = os.getenv("PERSIST_REPORTS", "1") == "1"
+REPORT_CACHE_MAX_MB = float(os.getenv("REPORT_CACHE_MAX_MB", "256"))
+REPORT_CACHE_MAX_ENTRIES = int(os.getenv("REPORT_CACHE_MAX_ENTRIES", "10000"))
+
+def initialize_clients():
+    """Create the GPT, Gemini and embedding clients shared by every request."""
+    logging.info("Initializing clients")
+    # For GitHub-hosted model
+    github_token = os.environ.get("GITHUB_TOKEN")
+    github_endpoint = os.environ.get("GITHUB_ENDPOINT")
+    gpt_client = OpenAI(
+        base_url=github_endpoint,
+        api_key=github_token,
+    )
+    async_gpt_client = AsyncOpenAI(
+        base_url=github_endpoint,
+        api_key=github_token,
+    )
+
+    # For Gemini model
+    gemini_api_key = os.environ.get("GEMINI_API_KEY")
+    gemini_client = genai.Client(api_key=gemini_api_key)
+
+    # For embeddings (using same GitHub client in this example)
+    azure_endpoint = os.environ.get("AZURE_ENDPOINT")
+    embedding_client = OpenAI(
+        base_url=azure_endpoint,
+        api_key=github_token,
+    )
+    async_embedding_client = AsyncOpenAI(
+        base_url=azure_endpoint,
+        api_key=github_token,
+    )
+    return gpt_client, gemini_client, embedding_client, async_gpt_client, async_embedding_client
+
+def build_agent_registry() -> AgentRegistry:
+    """Create the registry that owns the process-wide RagAgent."""
+    gpt_client, gemini_client, embedding_client, async_gpt_client, async_embedding_client = initialize_clients()
+    # Shared by every agent the registry builds, so reloads keep the warm cache
+    embedding_cache = EmbeddingCache(EMBEDDING_CACHE_PATH, max_entries=EMBEDDING_CACHE_SIZE)
+    # Likewise for circuit breaker state and observed latencies
+    llm_caller = LLMCaller(CallPolicy(
+        deadline=LLM_DEADLINE,
+        attempt_timeout=LLM_ATTEMPT_TIMEOUT,
+        max_attempts=LLM_MAX_ATTEMPTS,
+        parse_retries=LLM_PARSE_RETRIES,
+        hedge=LLM_HEDGE,
+    ))
+
+    def agent_factory() -> RagAgent:
+        return RagAgent(
+            faiss_dir=FAISS_DIR,
+            index_name=FAISS_INDEX_NAME,
+            gpt_client=gpt_client,
+            gemini_client=gemini_client,
+            embedding_client=embedding_client,
+            async_gpt_client=async_gpt_client,
+            async_embedding_client=async_embedding_client,
+            embedding_cache=embedding_cache,
+            rerank_factor=FAISS_RERANK_FACTOR,
+            hybrid=HYBRID_SEARCH,
+            multi_query=MULTI_QUERY_SEARCH,
+            report_encoding=REPORT_ENCODING,
+            drop_passing=REPORT_DROP_PASSING,
+            summary_mode=SUMMARY_MODE,
+            query_mode=QUERY_MODE,
+            structured_output=STRUCTURED_OUTPUT,
+            llm_caller=llm_caller,
+            backup_models=LLM_BACKUP_MODELS,
+            embedding_model="text-embedding-3-large",
+            context_token_limit=CONTEXT_TOKEN_LIMIT,
+            docs_per_category=10,  # Retrieve more docs per category
+            categories=[
+                "training", "ro", "pumps", "filters", "media",
+                "airblowers", "chemicals", "domestic", "dosage"
+            ]
+        )
+
+    return AgentRegistry(
+        agent_factory,
+        faiss_dir=FAISS_DIR,
+        index_name=FAISS_INDEX_NAME,
+        poll_interval=FAISS_RELOAD_INTERVAL,
+    )
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Load the FAISS index once per process and keep it in memory
+    app.state.agent_registry = None
+    try:
+        app.state.agent_registry = build_agent_registry()
+    except Exception as e:
+        logging.error(f"Failed to initialize clients: {e}")
+    if app.state.agent_registry is not None:
+        try:
+            await asyncio.to_thread(app.state.agent_registry.load)
+        except Exception as e:
+            # The watcher retries once the index files change
+            logging.error(f"Failed to initialize RagAgent: {e}")
+        app.state.agent_registry.start_watching()
+
+    # PDF parsing is CPU-bound; it runs in worker processes off the event loop
+    app.state.pdf_pool = PdfExtractionPool(max_workers=PDF_POOL_WORKERS, timeout=PDF_EXTRACT_TIMEOUT)
+    # Parsed reports keyed by the SHA-256 of the PDF, so re-uploads skip extraction
+    app.state.report_cache = ReportCache(
+        max_bytes=int(REPORT_CACHE_MAX_MB * 1024 * 1024),
+        max_entries=REPORT_CACHE_MAX_ENTRIES,
+    )
+    app.state.report_parses = {}
+    # Uploads being parsed, owned by the shared parse rather than the request
+    app.state.parse_dir = tempfile.mkdtemp(prefix="report_parses_")
+    app.state.report_writes = set()
+
+    # Job table lives in the same SQLite database as the recommendations
+    models.Base.metadata.create_all(engine)
+    os.makedirs(JOBS_DIR, exist_ok=True)
+    app.state.job_queue = JobQueue(
+        lambda job: run_recommendation_job(app, job),
+        concurrency=JOB_WORKERS,
+        drain_timeout=JOB_DRAIN_TIMEOUT,
+        max_attempts=JOB_MAX_ATTEMPTS,
+    )
+    await app.state.job_queue.start()
+    yield
+    # Drain in-flight jobs while the agent is still available
+    await app.state.job_queue.stop()
+    await app.state.pdf_pool.shutdown()
+    shutil.rmtree(app.state.parse_dir, ignore_errors=True)
+    if app.state.report_writes:
+        await asyncio.gather(*app.state.report_writes, return_exceptions=True)
+    if app.state.agent_registry is not None:
+        await app.state.agent_registry.stop_watching()
+
+app = FastAPI(lifespan=lifespan)
 
 # Add CORS middleware to allow frontend requests
 app.add_middleware(
@@ -43,32 +219,195 @@ recommendations_store = {
     "rationale": ""
 }
 
+def get_agent(request: Request) -> RagAgent:
+    """Dependency returning the shared RagAgent, or 503 until it is loaded."""
+    registry = request.app.state.agent_registry
+    if registry is None or not registry.ready:
+        raise HTTPException(status_code=503, detail="RagAgent is not ready")
+    return registry.get()
+
+def get_query_mode(query_mode: Optional[str] = Form(None)) -> Optional[str]:
+    """Dependency reading the optional per-request search query mode ("llm" or "template")."""
+    if query_mode not in (None, "", "llm", "template"):
+        raise HTTPException(status_code=400, detail="query_mode must be 'llm' or 'template'")
+    return query_mode or None
+
+def normalize_recommendation(recommendation) -> Dict[str, Any]:
+    """Convert an agent Recommendation into the dict shape of schemas.Recommendation."""
+    # Fix: Safely convert recommendation to dict for both Pydantic and plain dict cases
+    if hasattr(recommendation, "dict"):
+        rec = recommendation.dict()
+    elif isinstance(recommendation, dict):
+        rec = recommendation
+    else:
+        # fallback: try to convert to dict (e.g., dataclass)
+        rec = dict(recommendation)
+
+    # Normalize keys to match Pydantic schema
+    if "RO" in rec:
+        rec["ro"] = rec.pop("RO")
+    if "postreatment" in rec:
+        rec["posttreatment"] = rec.pop("postreatment")
+    if "pretreatment" not in rec:
+        rec["pretreatment"] = []
+    if "ro" not in rec:
+        rec["ro"] = []
+    if "posttreatment" not in rec:
+        rec["posttreatment"] = []
+
+    # Ensure all product lists are lists of dicts (not custom objects)
+    for key in ["pretreatment", "ro", "posttreatment"]:
+        rec[key] = [
+            p.dict() if hasattr(p, "dict") else dict(p) if not isinstance(p, dict) else p
+            for p in rec[key]
+        ]
+    return rec
+
+def persist_report(app: FastAPI, digest: str, lab_report: Dict[str, Any]):
+    """Write a parsed report to the report cache in the background."""
+    async def write():
+        try:
+            await asyncio.to_thread(app.state.report_cache.put, digest, lab_report)
+        except Exception as e:
+            logging.warning(f"Could not cache parsed report {digest[:12]}: {e}")
+
+    task = asyncio.create_task(write())
+    app.state.report_writes.add(task)
+    task.add_done_callback(app.state.report_writes.discard)
+
+async def extract_report(app: FastAPI, pdf_path: str, digest: str) -> Dict[str, Any]:
+    """
+    Parsed report for a PDF whose SHA-256 is `digest`.
+
+    Served from the report cache when the same bytes were parsed before;
+    otherwise extracted on the PDF pool and, with PERSIST_REPORTS, cached
+    without holding up the request. Concurrent requests for the same digest
+    share one extraction. Returns {} if no tables could be extracted.
+    """
+    if PERSIST_REPORTS:
+        lab_report = await asyncio.to_thread(app.state.report_cache.get, digest)
+        if lab_report is not None:
+            return lab_report
+
+    parses = app.state.report_parses
+    parse = parses.get(digest)
+    if parse is not None:
+        return await asyncio.shield(parse)
+    # The shared parse reads its own link or copy of the upload: the
+    # requester that started it may delete its file (client disconnect,
+    # batch cancelled) while other requests still wait on the result
+    staged_path = await asyncio.to_thread(stage_upload, pdf_path, app.state.parse_dir, digest)
+    parse = parses.get(digest)
+    if parse is not None:
+        # Another request started the same parse meanwhile
+        os.remove(staged_path)
+        return await asyncio.shield(parse)
+    parse = asyncio.ensure_future(extract_staged(app, staged_path))
+    parses[digest] = parse
+    parse.add_done_callback(lambda _: parses.pop(digest, None))
+    lab_report = await asyncio.shield(parse)
+    if PERSIST_REPORTS and lab_report:
+        persist_report(app, digest, lab_report)
+    return lab_report
+
+def stage_upload(pdf_path: str, parse_dir: str, digest: str) -> str:
+    """Hard-link (or, across filesystems, copy) an upload into the parse directory; returns the new path."""
+    staged_path = os.path.join(parse_dir, f"{digest}_{uuid.uuid4().hex}.pdf")
+    try:
+        os.link(pdf_path, staged_path)
+    except OSError:
+        shutil.copyfile(pdf_path, staged_path)
+    return staged_path
+
+async def extract_staged(app: FastAPI, staged_path: str) -> Dict[str, Any]:
+    """Extract a staged upload on the PDF pool, then delete it."""
+    try:
+        return await app.state.pdf_pool.extract(staged_path, save=False)
+    finally:
+        os.remove(staged_path)
+
+async def run_recommendation_job(app: FastAPI, job: Dict[str, Any]) -> Dict[str, Any]:
+    """Run the /extract-features pipeline for a queued job and return the AnalyzeResponse dict."""
+    registry = app.state.agent_registry
+    while registry is None or not registry.ready:
+        if registry is None:
+            raise RuntimeError("RagAgent is not available")
+        # Queued jobs wait for the index instead of failing during startup
+        await asyncio.sleep(1)
+    agent = registry.get()
+
+    digest = await asyncio.to_thread(file_sha256, job["report_path"])
+    lab_report = await extract_report(app, job["report_path"], digest)
+    if not lab_report:
+        raise ValueError("No tables could be extracted from the report")
+    recommendation, rationale = await agent.aprocess(
+        user_query=job["query"],
+        lab_report_json=lab_report,
+        model_type="gemini",
+        model_name="gemini-2.5-pro-exp-03-25",
+        temperature=0.2,
+        max_tokens=1500
+    )
+    return AnalyzeResponse(recommendations=normalize_recommendation(recommendation), rationale=rationale).dict()
+
+def sse_event(event: str, data: Any) -> str:
+    """Format one Server-Sent Events message."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+class TempFileStreamingResponse(StreamingResponse):
+    """
+    StreamingResponse that deletes a temporary file once the response ends.
+
+    The file is removed however the response ends: normally, on an error,
+    or when the client disconnects before the body generator ever runs.
+    Background tasks are not enough here, because Starlette skips them
+    when the client goes away.
+    """
+
+    def __init__(self, content: Any, temp_path: str, **kwargs):
+        super().__init__(content, **kwargs)
+        self.temp_path = temp_path
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            if os.path.exists(self.temp_path):
+                os.remove(self.temp_path)
+                logging.info(f"Deleted temp file {self.temp_path}")
+
 # Routes
 @app.get("/")
 def read_root(status_code=200):
     return {"status": "ok", "message": "Product Recommendation API is running"}
 
+@app.get("/ready")
+def readiness(request: Request):
+    registry = request.app.state.agent_registry
+    if registry is None or not registry.ready:
+        return JSONResponse(status_code=503, content={"ready": False})
+    return registry.status()
+
 @app.post("/extract-features", response_model=AnalyzeResponse)
-async def extract_details_and_analyze(report: UploadFile = File(...), query: str = Form(...)):
+async def extract_details_and_analyze(
+    request: Request,
+    report: UploadFile = File(...),
+    query: str = Form(...),
+    query_mode: Optional[str] = Depends(get_query_mode),
+    agent: RagAgent = Depends(get_agent)
+):
     start_time = time.time()
     logging.info("Received request to /extract-features")
     print("Step 1: Start extract_details_and_analyze")
     print(f"Received file: {report.filename}")
     print(f"Received query: {query}")
 
-    # Process the original filename
-    original_name = report.filename
-    name_no_ext = os.path.splitext(original_name)[0]
-    clean_name = name_no_ext.strip().lower().replace(" ", "_")
-    clean_name = clean_name + ".json"  # Remove special characters
-
-    # Save the uploaded file to a temporary location
+    # Save the uploaded file to a temporary location, hashing it as it is copied
     try:
         with tempfile.NamedTemporaryFile(delete=False) as temp_file:
             temp_file_path = temp_file.name
-            with open(temp_file_path, "wb") as f:
-                shutil.copyfileobj(report.file, f)
-        logging.info(f"Saved uploaded file to {temp_file_path}")
+        digest = await asyncio.to_thread(hash_upload, report.file, temp_file_path)
+        logging.info(f"Saved uploaded file to {temp_file_path} (sha256 {digest[:12]})")
         print(f"Step 2: Saved uploaded file to {temp_file_path}")
     except Exception as e:
         logging.error(f"Error saving uploaded file: {e}")
@@ -79,7 +418,7 @@ async def extract_details_and_analyze(report: UploadFile = File(...), query: str
     try:
         logging.info("Extracting features from PDF")
         print("Step 3: Extracting features from PDF")
-        lab_report = mypdf.extract_pdf_data(temp_file_path, clean_name)
+        lab_report = await extract_report(request.app, temp_file_path, digest)
     except Exception as e:
         logging.error(f"Error extracting features: {e}")
         print(f"Error extracting features: {e}")
@@ -89,94 +428,26 @@ async def extract_details_and_analyze(report: UploadFile = File(...), query: str
         logging.info(f"Deleted temp file {temp_file_path}")
         print(f"Deleted temp file {temp_file_path}")
 
-    # Analyze the extracted features using RagAgent
-    def intialize_clients():
-        logging.info("Initializing clients")
-        print("Step 4: Initializing clients")
-        # Initialize the clients here if needed
-        # Initialize clients with your API keys
-        # For GitHub-hosted model
-        github_token = os.environ.get("GITHUB_TOKEN")
-        github_endpoint = os.environ.get("GITHUB_ENDPOINT")
-        gpt_client = OpenAI(
-            base_url=github_endpoint,
-            api_key=github_token,
-        )
-
-        # For Gemini model
-        gemini_api_key = os.environ.get("GEMINI_API_KEY")
-        gemini_client = genai.Client(api_key=gemini_api_key)
-
-        # For embeddings (using same GitHub client in this example)
-        azure_endpoint = os.environ.get("AZURE_ENDPOINT")
-        embedding_client = OpenAI(
-            base_url=azure_endpoint,
-            api_key=github_token,
-        )
-        return gpt_client, gemini_client, embedding_client
-
-    try:
-        gpt_client, gemini_client, embedding_client = intialize_clients()
-        logging.info("Clients initialized successfully")
-        print("Step 5: Clients initialized successfully")
-        logging.info(f"Time elapsed after client init: {time.time() - start_time:.2f}s")
-    except Exception as e:
-        logging.error(f"Failed to initialize clients: {e}")
-        print(f"Failed to initialize clients: {e}")
-        return JSONResponse(status_code=500, content={"error": f"Failed to initialize clients: {str(e)}"})
-
-    try:
-        logging.info("Initializing RagAgent")
-        print("Step 6: Initializing RagAgent")
-        agent = RagAgent(
-                faiss_dir="FAISS",
-                index_name="water-treatment",
-                gpt_client=gpt_client,
-                gemini_client=gemini_client,
-                embedding_client=embedding_client,
-                embedding_model="text-embedding-3-large",
-                context_token_limit=100000,  # Increased context token limit
-                docs_per_category=10,  # Retrieve more docs per category
-                categories=[
-                    "training", "ro", "pumps", "filters", "media",
-                    "airblowers", "chemicals", "domestic", "dosage"
-                ]
-            )
-        logging.info("RagAgent initialized successfully")
-        print("Step 7: RagAgent initialized successfully")
-        logging.info(f"Time elapsed after RagAgent init: {time.time() - start_time:.2f}s")
-    except Exception as e:
-        logging.error(f"Failed to initialize RagAgent: {e}")
-        print(f"Failed to initialize RagAgent: {e}")
-        return JSONResponse(status_code=500, content={"error": f"Failed to initialize RagAgent: {str(e)}"})
-
-    # Load the lab report JSON data
-    try:
-        logging.info("Loading lab report JSON")
-        print("Step 8: Loading lab report JSON")
-        # Fix: Use the correct function to load the lab report JSON from mypdf or faiss_agent
-        # If mypdf does not have load_lab_report, use from faiss_agent import load_lab_report
-        lab_report_json = load_lab_report('outputs/' + clean_name)
-        logging.info("Lab report JSON loaded")
-        print("Step 9: Lab report JSON loaded")
-    except Exception as e:
-        logging.error(f"Failed to load lab report: {e}")
-        print(f"Failed to load lab report: {e}")
-        return JSONResponse(status_code=500, content={"error": f"Failed to load lab report: {str(e)}"})
+    # The parsed report goes to the agent in memory; it encodes it for the prompts
+    if not lab_report:
+        logging.error("No tables could be extracted from the report")
+        print("No tables could be extracted from the report")
+        return JSONResponse(status_code=500, content={"error": "Failed to load lab report: no tables could be extracted from the report"})
     try:
         logging.info("Processing query with RagAgent")
         print("Step 10: Processing query with RagAgent")
-        recommendation, rationale = agent.process(
+        recommendation, rationale = await agent.aprocess(
             user_query=query,
-            lab_report_json=lab_report_json,
+            lab_report_json=lab_report,
             model_type="gemini",
             model_name="gemini-2.5-pro-exp-03-25",
             temperature=0.2,
-            max_tokens=1500
+            max_tokens=1500,
+            query_mode=query_mode
         )
         logging.info("Query processed successfully")
         print("Step 11: Query processed successfully")
-        logging.info(f"Time elapsed after agent.process: {time.time() - start_time:.2f}s")
+        logging.info(f"Time elapsed after agent.aprocess: {time.time() - start_time:.2f}s")
     except Exception as e:
         logging.error(f"Failed to process query: {e}")
         print(f"Failed to process query: {e}")
@@ -252,33 +523,7 @@ async def extract_details_and_analyze(report: UploadFile = File(...), query: str
     #     return JSONResponse(status_code=500, content={"error": f"Failed to enrich recommendation: {str(e)}"})
     
     # Create the response object
-    # Fix: Safely convert recommendation to dict for both Pydantic and plain dict cases
-    if hasattr(recommendation, "dict"):
-        rec = recommendation.dict()
-    elif isinstance(recommendation, dict):
-        rec = recommendation
-    else:
-        # fallback: try to convert to dict (e.g., dataclass)
-        rec = dict(recommendation)
-
-    # Normalize keys to match Pydantic schema
-    if "RO" in rec:
-        rec["ro"] = rec.pop("RO")
-    if "postreatment" in rec:
-        rec["posttreatment"] = rec.pop("postreatment")
-    if "pretreatment" not in rec:
-        rec["pretreatment"] = []
-    if "ro" not in rec:
-        rec["ro"] = []
-    if "posttreatment" not in rec:
-        rec["posttreatment"] = []
-
-    # Ensure all product lists are lists of dicts (not custom objects)
-    for key in ["pretreatment", "ro", "posttreatment"]:
-        rec[key] = [
-            p.dict() if hasattr(p, "dict") else dict(p) if not isinstance(p, dict) else p
-            for p in rec[key]
-        ]
+    rec = normalize_recommendation(recommendation)
 
     response = AnalyzeResponse(
         recommendations=rec,
@@ -310,6 +555,293 @@ async def extract_details_and_analyze(report: UploadFile = File(...), query: str
         print(f"Failed to return response: {e}")
         return JSONResponse(status_code=500, content={"error": f"Failed to return response: {str(e)}"})
 
+@app.post("/extract-features/stream")
+async def extract_details_and_analyze_stream(
+    request: Request,
+    report: UploadFile = File(...),
+    query: str = Form(...),
+    query_mode: Optional[str] = Depends(get_query_mode),
+    agent: RagAgent = Depends(get_agent)
+):
+    """
+    Streaming variant of /extract-features using Server-Sent Events.
+
+    Events, in order: "report" once the PDF is parsed; "summary" and
+    "context" as those stages finish; "token" for each chunk of the model
+    reply; then "recommendation" with the same payload as /extract-features.
+    An "error" event ends the stream early if a stage fails.
+    """
+    logging.info("Received request to /extract-features/stream")
+
+    # The upload is closed once this handler returns, so save it first
+    with tempfile.NamedTemporaryFile(delete=False) as temp_file:
+        temp_file_path = temp_file.name
+    try:
+        digest = await asyncio.to_thread(hash_upload, report.file, temp_file_path)
+    except Exception as e:
+        logging.error(f"Error saving uploaded file: {e}")
+        os.remove(temp_file_path)
+        return JSONResponse(status_code=500, content={"error": str(e)})
+
+    app = request.app
+
+    async def events():
+        start_time = time.time()
+        try:
+            lab_report = await extract_report(app, temp_file_path, digest)
+            if not lab_report:
+                raise ValueError("No tables could be extracted from the report")
+        except Exception as e:
+            logging.error(f"Error extracting features: {e}")
+            yield sse_event("error", {"stage": "report", "error": str(e)})
+            return
+        yield sse_event("report", {"report": lab_report})
+
+        try:
+            async for event, data in agent.astream(
+                user_query=query,
+                lab_report_json=lab_report,
+                model_type="gemini",
+                model_name="gemini-2.5-pro-exp-03-25",
+                temperature=0.2,
+                max_tokens=1500,
+                query_mode=query_mode
+            ):
+                if event == "recommendation":
+                    rec = normalize_recommendation(data["recommendation"])
+                    response = AnalyzeResponse(recommendations=rec, rationale=data["rationale"])
+                    recommendations_store["recommendations"] = rec
+                    recommendations_store["rationale"] = data["rationale"]
+                    data = response.dict()
+                yield sse_event(event, data)
+        except Exception as e:
+            logging.error(f"Failed to process query: {e}")
+            yield sse_event("error", {"stage": "recommendation", "error": str(e)})
+            return
+        logging.info(f"Total time for /extract-features/stream: {time.time() - start_time:.2f}s")
+
+    # The response owns the temp file from here on and deletes it when it ends
+    return TempFileStreamingResponse(
+        events(),
+        temp_file_path,
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@app.post("/jobs", status_code=202)
+async def submit_job(request: Request, report: UploadFile = File(...), query: str = Form(...)):
+    """Queue a recommendation run; poll /jobs/{job_id} or subscribe to /jobs/{job_id}/events."""
+    report_path = os.path.join(JOBS_DIR, f"{uuid.uuid4().hex}.pdf")
+
+    def save_upload():
+        with open(report_path, "wb") as f:
+            shutil.copyfileobj(report.file, f)
+
+    try:
+        await asyncio.to_thread(save_upload)
+        return await request.app.state.job_queue.submit(query, report_path, report.filename)
+    except BaseException as e:
+        # Not queued (shutting down, database error, client gone): the upload has no owner
+        if os.path.exists(report_path):
+            os.remove(report_path)
+        if isinstance(e, RuntimeError):
+            raise HTTPException(status_code=503, detail=str(e))
+        raise
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str, request: Request):
+    job = await request.app.state.job_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+@app.get("/jobs/{job_id}/events")
+async def job_events(job_id: str, request: Request):
+    """Server-Sent Events stream of job state changes, ending when the job finishes."""
+    job_queue = request.app.state.job_queue
+    if await job_queue.get(job_id) is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+
+    async def events():
+        async for job in job_queue.events(job_id):
+            yield sse_event(job["status"], job)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+class _SizeLimitedReader:
+    """File wrapper that raises ValueError once more than the shared byte budget has been read."""
+
+    def __init__(self, source, budget: List[int]):
+        self.source = source
+        self.budget = budget
+
+    def read(self, size: int = -1) -> bytes:
+        chunk = self.source.read(size)
+        self.budget[0] -= len(chunk)
+        if self.budget[0] < 0:
+            raise ValueError(f"A batch may contain at most {BATCH_MAX_MB:g} MB of PDFs")
+        return chunk
+
+def save_batch_uploads(reports: List[UploadFile], batch_dir: str) -> List[Tuple[str, str, str]]:
+    """
+    Save uploaded PDFs, and the PDFs inside uploaded zips, into `batch_dir`.
+
+    Blocking; run it in a thread. The report count is checked before each
+    PDF or zip is written out, and the total size of the PDFs, after
+    unzipping, is capped at BATCH_MAX_MB.
+
+    Returns:
+        List of (report_name, saved_path, sha256) in upload order
+
+    Raises:
+        ValueError: If the batch has too many reports or is too large
+    """
+    saved = []
+    budget = [int(BATCH_MAX_MB * 1024 * 1024)]
+
+    def check_count(extra: int):
+        if len(saved) + extra > BATCH_MAX_REPORTS:
+            raise ValueError(f"A batch may contain at most {BATCH_MAX_REPORTS} reports")
+
+    def save(name: str, source):
+        path = os.path.join(batch_dir, f"{len(saved):04d}.pdf")
+        saved.append((name, path, hash_upload(_SizeLimitedReader(source, budget), path)))
+
+    for report in reports:
+        filename = report.filename or "report.pdf"
+        if filename.lower().endswith(".zip"):
+            with zipfile.ZipFile(report.file) as archive:
+                # Member names are only used as labels, never as paths
+                members = [
+                    member for member in archive.infolist()
+                    if not member.is_dir() and member.filename.lower().endswith(".pdf")
+                ]
+                check_count(len(members))
+                # Declared sizes catch most oversized zips up front; the reader enforces the real size
+                if sum(member.file_size for member in members) > budget[0]:
+                    raise ValueError(f"A batch may contain at most {BATCH_MAX_MB:g} MB of PDFs")
+                for member in members:
+                    with archive.open(member) as source:
+                        save(os.path.basename(member.filename), source)
+        elif filename.lower().endswith(".pdf"):
+            check_count(1)
+            save(filename, report.file)
+    return saved
+
+@app.post("/extract-features/batch")
+async def extract_details_and_analyze_batch(
+    request: Request,
+    reports: List[UploadFile] = File(...),
+    query: str = Form(...),
+    query_mode: Optional[str] = Depends(get_query_mode),
+    agent: RagAgent = Depends(get_agent)
+):
+    """
+    Analyze many lab reports (PDFs and/or zips of PDFs) with one query.
+
+    Reports are extracted in parallel on the PDF process pool, and each one
+    goes through the agent's batch as soon as it is parsed, sharing
+    embeddings requests and a bounded number of concurrent LLM calls with
+    the rest of the batch. Results stream back as Server-Sent Events in completion
+    order: a "result" event per report with the /extract-features payload,
+    an "error" event per report that failed, then a "done" event.
+    """
+    logging.info(f"Received request to /extract-features/batch with {len(reports)} uploads")
+    batch_id = uuid.uuid4().hex[:8]
+    batch_dir = tempfile.mkdtemp(prefix=f"batch_{batch_id}_")
+    try:
+        saved = await asyncio.to_thread(save_batch_uploads, reports, batch_dir)
+    except (ValueError, zipfile.BadZipFile) as e:
+        shutil.rmtree(batch_dir, ignore_errors=True)
+        return JSONResponse(status_code=400, content={"error": str(e)})
+    if not saved:
+        shutil.rmtree(batch_dir, ignore_errors=True)
+        return JSONResponse(status_code=400, content={"error": "No PDF reports found in the upload"})
+
+    app = request.app
+
+    async def events():
+        start_time = time.time()
+        # Extraction errors and recommendation results, in the order they happen; None ends the stream
+        out: asyncio.Queue = asyncio.Queue()
+
+        async def extract(i: int, path: str, digest: str):
+            # The pool's size bounds how many PDFs are parsed at once
+            try:
+                lab_report = await extract_report(app, path, digest)
+                if not lab_report:
+                    raise ValueError("No tables could be extracted from the report")
+                return i, lab_report
+            except (Exception, asyncio.CancelledError) as e:
+                if isinstance(e, asyncio.CancelledError) and asyncio.current_task().cancelling():
+                    raise
+                return i, e
+
+        extractions = [asyncio.create_task(extract(i, path, digest)) for i, (_, path, digest) in enumerate(saved)]
+
+        async def extracted():
+            """Each report as soon as it is parsed; failures go straight to the stream."""
+            count = 0
+            for finished in asyncio.as_completed(extractions):
+                i, result = await finished
+                if isinstance(result, BaseException):
+                    out.put_nowait(("error", {"index": i, "report_name": saved[i][0], "stage": "report", "error": str(result) or type(result).__name__}))
+                    continue
+                count += 1
+                yield str(i), result
+            logging.info(f"Batch {batch_id}: extracted {count}/{len(saved)} reports in {time.time() - start_time:.2f}s")
+
+        async def recommend():
+            async for key, recommendation, rationale in agent.abatch_process(
+                extracted(),
+                user_query=query,
+                model_type="gemini",
+                model_name="gemini-2.5-pro-exp-03-25",
+                temperature=0.2,
+                max_tokens=1500,
+                llm_concurrency=BATCH_LLM_CONCURRENCY,
+                query_mode=query_mode
+            ):
+                out.put_nowait(("recommendation", (int(key), recommendation, rationale)))
+
+        producer = asyncio.create_task(recommend())
+        producer.add_done_callback(lambda _: out.put_nowait(None))
+        succeeded = failed = 0
+        try:
+            while (item := await out.get()) is not None:
+                kind, payload = item
+                if kind == "error":
+                    failed += 1
+                    yield sse_event("error", payload)
+                    continue
+                i, recommendation, rationale = payload
+                try:
+                    response = AnalyzeResponse(recommendations=normalize_recommendation(recommendation), rationale=rationale)
+                except Exception as e:
+                    failed += 1
+                    yield sse_event("error", {"index": i, "report_name": saved[i][0], "stage": "recommendation", "error": str(e)})
+                    continue
+                succeeded += 1
+                yield sse_event("result", {"index": i, "report_name": saved[i][0], **response.dict()})
+            producer.result()
+        finally:
+            for task in [producer] + extractions:
+                task.cancel()
+            shutil.rmtree(batch_dir, ignore_errors=True)
+        total = time.time() - start_time
+        logging.info(f"Batch {batch_id}: {succeeded} succeeded, {failed} failed in {total:.2f}s")
+        yield sse_event("done", {"count": len(saved), "succeeded": succeeded, "failed": failed, "seconds": round(total, 2)})
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
 # Endpoint to get current recommendations (for QuotationCart.vue)
 @app.get("/api/recommendations")
 def get_recommendations():
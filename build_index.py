@@ -0,0 +1,400 @@
+import os
+import sys
+import time
+import random
+import hashlib
+import argparse
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+import pdfplumber
+import tiktoken
+from dotenv import load_dotenv
+from openai import OpenAI
+
+import vector_store
+from ann_index import INDEX_KINDS, IndexConfig, build_ann_index, evaluate_index, holdout_queries, truncate_embeddings
+from embedding_cache import normalize_text
+
+logger = logging.getLogger("build_index")
+
+
+def content_hash(text: str) -> str:
+    """SHA-256 of the whitespace-normalized chunk text."""
+    return hashlib.sha256(normalize_text(text).encode("utf-8")).hexdigest()
+
+
+def source_path(path: str) -> str:
+    """Canonical form of a PDF path for chunk ids and sources, so "./x.pdf" and "x.pdf" match."""
+    try:
+        return os.path.relpath(path)
+    except ValueError:
+        # Another drive on Windows
+        return os.path.abspath(path)
+
+
+def chunk_source(chunk_id: str, metadata: Dict[str, Any]) -> str:
+    """Canonical source path of a stored chunk; ids are `<file_path>_<n>` when metadata has no source."""
+    return source_path(metadata.get("source") or chunk_id.rsplit("_", 1)[0])
+
+
+def find_pdfs(paths: List[str]) -> List[str]:
+    """Expand files and directories into a sorted list of PDF paths."""
+    pdfs = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                pdfs.extend(os.path.join(root, f) for f in files if f.lower().endswith(".pdf"))
+        elif path.lower().endswith(".pdf"):
+            pdfs.append(path)
+    return sorted(pdfs)
+
+
+def chunk_pdf(
+    pdf_path: str,
+    category: str,
+    tokenizer,
+    chunk_tokens: int = 800,
+    overlap: int = 100
+) -> List[Tuple[str, str, Dict[str, Any]]]:
+    """
+    Split a PDF into token-bounded chunks.
+
+    Chunk ids follow the existing `<file_path>_<n>` convention, numbered
+    across the whole file.
+
+    Args:
+        pdf_path: Path to the PDF file
+        category: Category stored in each chunk's metadata
+        tokenizer: tiktoken encoding used to measure chunks
+        chunk_tokens: Maximum tokens per chunk
+        overlap: Tokens shared between consecutive chunks of a page
+
+    Returns:
+        List of (chunk_id, text, metadata) tuples
+    """
+    chunks = []
+    step = max(chunk_tokens - overlap, 1)
+    with pdfplumber.open(pdf_path) as pdf:
+        doc_metadata = {
+            key: value for key, value in (pdf.metadata or {}).items()
+            if isinstance(value, str)
+        }
+        total_pages = len(pdf.pages)
+        for page_number, page in enumerate(pdf.pages):
+            text = (page.extract_text() or "").strip()
+            page.close()
+            if not text:
+                continue
+            tokens = tokenizer.encode(text)
+            for start in range(0, len(tokens), step):
+                chunk_text = tokenizer.decode(tokens[start:start + chunk_tokens]).strip()
+                if not chunk_text:
+                    continue
+                chunk_id = f"{pdf_path}_{len(chunks)}"
+                metadata = {
+                    **doc_metadata,
+                    "id": chunk_id,
+                    "category": category,
+                    "source": pdf_path,
+                    "file_path": pdf_path,
+                    "page": page_number,
+                    "total_pages": total_pages,
+                    "content_hash": content_hash(chunk_text),
+                }
+                chunks.append((chunk_id, chunk_text, metadata))
+                if start + chunk_tokens >= len(tokens):
+                    break
+    return chunks
+
+
+def embed_with_retry(
+    client,
+    model: str,
+    texts: List[str],
+    max_attempts: int = 5,
+    base_delay: float = 1.0
+) -> List[List[float]]:
+    """Embed one batch, retrying with jittered exponential backoff."""
+    for attempt in range(1, max_attempts + 1):
+        try:
+            response = client.embeddings.create(input=texts, model=model)
+            data = sorted(response.data, key=lambda d: getattr(d, "index", 0))
+            return [d.embedding for d in data]
+        except Exception as e:
+            if attempt == max_attempts:
+                raise
+            delay = base_delay * 2 ** (attempt - 1) * random.uniform(0.5, 1.5)
+            logger.warning(f"Embedding batch failed ({e}); retry {attempt}/{max_attempts - 1} in {delay:.1f}s")
+            time.sleep(delay)
+
+
+def embed_chunks(
+    client,
+    model: str,
+    texts: List[str],
+    batch_size: int = 64,
+    concurrency: int = 4
+) -> np.ndarray:
+    """
+    Embed texts in batches with at most `concurrency` requests in flight.
+
+    Returns:
+        float32 array of shape (len(texts), dim), in input order
+    """
+    batches = [texts[i:i + batch_size] for i in range(0, len(texts), batch_size)]
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(lambda batch: embed_with_retry(client, model, batch), batches))
+    vectors = [vector for batch in results for vector in batch]
+    return np.array(vectors, dtype='float32')
+
+
+def load_existing(faiss_dir: str, index_name: str):
+    """
+    Load the current index, texts, metadata, ids and source vectors for appending.
+
+    Returns:
+        Tuple of (index, texts, metadatas, ids, vectors, index_config, parent_version);
+        index and vectors are None for a new store
+    """
+    store_dir = os.path.join(faiss_dir, index_name)
+    if vector_store.has_bundle(store_dir):
+        bundle = vector_store.load_bundle(store_dir, mmap=False)
+        vectors = bundle.vectors()
+        if vectors is None:
+            vectors = bundle.index.reconstruct_n(0, bundle.index.ntotal)
+        return (bundle.index, list(bundle.texts), list(bundle.metadatas), bundle.ids(),
+                np.array(vectors, dtype='float32'), bundle.index_config, bundle.version)
+    if os.path.exists(os.path.join(faiss_dir, f"{index_name}.index")):
+        index, texts, metadatas, ids = vector_store.load_legacy(faiss_dir, index_name)
+        vectors = index.reconstruct_n(0, index.ntotal)
+        return index, list(texts), list(metadatas), list(ids), vectors, IndexConfig(), "legacy"
+    return None, [], [], [], None, IndexConfig(), None
+
+
+def ingest(
+    pdf_paths: List[str],
+    category: str,
+    embedding_client,
+    faiss_dir: str = "FAISS",
+    index_name: str = "water-treatment",
+    embedding_model: str = "text-embedding-3-large",
+    chunk_tokens: int = 800,
+    overlap: int = 100,
+    batch_size: int = 64,
+    concurrency: int = 4,
+    dry_run: bool = False,
+    index_config: Optional[IndexConfig] = None,
+    rebuild: bool = False,
+    eval_queries: int = 0,
+    keep_snapshots: int = vector_store.KEEP_SNAPSHOTS
+) -> Optional[str]:
+    """
+    Chunk, de-duplicate, embed and append PDFs to the vector store.
+
+    PDF paths are normalized (see source_path) before chunk ids are built.
+    A PDF whose chunks match the stored ones for its path is skipped. A PDF
+    that changed since it was indexed - new content, or another
+    `chunk_tokens` - has all its stored chunks replaced, so old and new
+    text never mix; stored vectors of unchanged chunk texts are reused.
+    Otherwise a chunk is skipped only when its content hash is already
+    stored. New vectors are appended to the existing index; the index is
+    rebuilt from the stored source vectors when chunks were replaced,
+    `rebuild` is set or `index_config` asks for a different index type or
+    search dimension. Token counts and BM25 postings of the parent
+    snapshot are carried over, so only the new chunks are tokenized. With
+    `eval_queries`, the snapshot also carries a recall@k / latency report
+    against exact search. A new snapshot is written only when something
+    changed; snapshots beyond the newest `keep_snapshots` are pruned.
+
+    Returns:
+        Path of the new snapshot, or None when nothing was added
+    """
+    tokenizer = tiktoken.get_encoding("cl100k_base")
+    index, texts, metadatas, ids, vectors, current_config, parent = load_existing(faiss_dir, index_name)
+    config = index_config or current_config
+    rebuild = (
+        rebuild or index is None
+        or config.kind != current_config.kind
+        or config.search_dims != current_config.search_dims
+    )
+    row_hashes = [metadata.get("content_hash") or content_hash(text) for text, metadata in zip(texts, metadatas)]
+    rows_by_source: Dict[str, List[int]] = {}
+    for row, (chunk_id, metadata) in enumerate(zip(ids, metadatas)):
+        rows_by_source.setdefault(chunk_source(chunk_id, metadata), []).append(row)
+    known_hashes = set(row_hashes)
+    removed = set()
+
+    new_chunks = []
+    for pdf_path in pdf_paths:
+        source = source_path(pdf_path)
+        try:
+            chunks = chunk_pdf(source, category, tokenizer, chunk_tokens, overlap)
+        except Exception as e:
+            logger.error(f"Error chunking {source}: {e}")
+            continue
+        stored = [row for row in rows_by_source.get(source, []) if row not in removed]
+        if stored:
+            if [(ids[row], row_hashes[row]) for row in stored] == [(c[0], c[2]["content_hash"]) for c in chunks]:
+                logger.info(f"{source}: {len(chunks)} chunks, unchanged")
+                continue
+            logger.warning(f"{source} changed since it was indexed; replacing its {len(stored)} stored chunks")
+            removed.update(stored)
+            known_hashes = {h for row, h in enumerate(row_hashes) if row not in removed}
+            known_hashes.update(c[2]["content_hash"] for c in new_chunks)
+        fresh = [chunk for chunk in chunks if chunk[2]["content_hash"] not in known_hashes]
+        known_hashes.update(chunk[2]["content_hash"] for chunk in fresh)
+        logger.info(f"{source}: {len(chunks)} chunks, {len(fresh)} new")
+        new_chunks.extend(fresh)
+
+    if not new_chunks and not removed and not (rebuild and vectors is not None):
+        logger.info("Nothing new to index")
+        return None
+    if removed and len(removed) == len(ids) and not new_chunks:
+        logger.error("Replacing the changed PDFs would leave the store empty; not writing a snapshot")
+        return None
+    if dry_run:
+        logger.info(
+            f"Dry run: would embed up to {len(new_chunks)} chunks"
+            + (f", replacing {len(removed)} stored chunks" if removed else "")
+            + (" and rebuild the index" if rebuild or removed else "")
+        )
+        return None
+
+    # Vectors of replaced chunks whose text is unchanged are reused rather than re-embedded
+    reusable = {row_hashes[row]: vectors[row] for row in removed}
+    if removed:
+        kept = [row for row in range(len(ids)) if row not in removed]
+        texts = [texts[row] for row in kept]
+        metadatas = [metadatas[row] for row in kept]
+        ids = [ids[row] for row in kept]
+        vectors = vectors[kept]
+        rebuild = True
+
+    if new_chunks:
+        to_embed = [c[1] for c in new_chunks if c[2]["content_hash"] not in reusable]
+        embedded = iter(
+            embed_chunks(embedding_client, embedding_model, to_embed, batch_size, concurrency) if to_embed else []
+        )
+        new_vectors = np.array([
+            reusable[c[2]["content_hash"]] if c[2]["content_hash"] in reusable else next(embedded)
+            for c in new_chunks
+        ], dtype='float32')
+        if vectors is not None and new_vectors.shape[1] != vectors.shape[1]:
+            raise ValueError(f"Embedding dimension {new_vectors.shape[1]} does not match index dimension {vectors.shape[1]}")
+        vectors = new_vectors if vectors is None else np.vstack([vectors, new_vectors])
+        if not rebuild:
+            index.add(truncate_embeddings(new_vectors, config.search_dims))
+    if rebuild:
+        logger.info(f"Building {config.kind} index over {len(vectors)} vectors")
+        index = build_ann_index(vectors, config)
+
+    report = None
+    if eval_queries:
+        report = evaluate_index(index, vectors, holdout_queries(vectors, eval_queries), config=config)
+        logger.info(f"Index report: {report}")
+
+    for chunk_id, text, metadata in new_chunks:
+        ids.append(chunk_id)
+        texts.append(text)
+        metadatas.append(metadata)
+
+    return vector_store.write_bundle(
+        os.path.join(faiss_dir, index_name),
+        index,
+        texts,
+        metadatas,
+        ids,
+        tokenizer=tokenizer,
+        vectors=vectors,
+        index_config=config,
+        extra_manifest={
+            "parent": parent,
+            "added": len(new_chunks),
+            "replaced": len(removed),
+            "embedding_model": embedding_model,
+            "eval": report,
+        },
+        # With rows removed the parent is no longer a prefix of this snapshot
+        base_dir=os.path.join(faiss_dir, index_name, parent) if parent not in (None, "legacy") and not removed else None,
+        keep=keep_snapshots
+    )
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Add PDFs to the FAISS vector store incrementally")
+    parser.add_argument("paths", nargs="*", help="PDF files or directories")
+    parser.add_argument("--category", help="Category for the new chunks, e.g. ro, pumps, dosage")
+    parser.add_argument("--faiss-dir", default="FAISS")
+    parser.add_argument("--index-name", default="water-treatment")
+    parser.add_argument("--embedding-model", default="text-embedding-3-large")
+    parser.add_argument("--chunk-tokens", type=int, default=800)
+    parser.add_argument("--overlap", type=int, default=100)
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--dry-run", action="store_true")
+    parser.add_argument("--index-type", choices=INDEX_KINDS, help="Index type; defaults to the current one")
+    parser.add_argument("--nlist", type=int, default=0, help="IVF lists (0 = about 4 * sqrt(n))")
+    parser.add_argument("--nprobe", type=int, default=8)
+    parser.add_argument("--hnsw-m", type=int, default=32)
+    parser.add_argument("--ef-construction", type=int, default=200)
+    parser.add_argument("--ef-search", type=int, default=64)
+    parser.add_argument("--pq-m", type=int, default=64)
+    parser.add_argument("--pq-nbits", type=int, default=8)
+    parser.add_argument("--search-dims", type=int, default=0,
+                        help="Index Matryoshka-truncated embeddings of this size and re-rank with full vectors (0 = full)")
+    parser.add_argument("--rebuild", action="store_true", help="Rebuild the index from the stored vectors")
+    parser.add_argument("--eval-queries", type=int, default=0, help="Held-out queries for a recall/latency report (0 to skip)")
+    parser.add_argument("--keep-snapshots", type=int, default=vector_store.KEEP_SNAPSHOTS, help="Snapshots to keep (0 keeps all)")
+    args = parser.parse_args(argv)
+    if args.paths and not args.category:
+        parser.error("--category is required when adding PDFs")
+
+    index_config = None
+    if args.index_type:
+        index_config = IndexConfig(
+            kind=args.index_type,
+            nlist=args.nlist,
+            nprobe=args.nprobe,
+            hnsw_m=args.hnsw_m,
+            ef_construction=args.ef_construction,
+            ef_search=args.ef_search,
+            pq_m=args.pq_m,
+            pq_nbits=args.pq_nbits,
+            search_dims=args.search_dims,
+        )
+    elif args.search_dims:
+        parser.error("--search-dims requires --index-type")
+
+    load_dotenv('.env.local')
+    embedding_client = OpenAI(
+        base_url=os.environ.get("AZURE_ENDPOINT"),
+        api_key=os.environ.get("GITHUB_TOKEN"),
+    )
+    path = ingest(
+        find_pdfs(args.paths),
+        args.category,
+        embedding_client,
+        faiss_dir=args.faiss_dir,
+        index_name=args.index_name,
+        embedding_model=args.embedding_model,
+        chunk_tokens=args.chunk_tokens,
+        overlap=args.overlap,
+        batch_size=args.batch_size,
+        concurrency=args.concurrency,
+        dry_run=args.dry_run,
+        index_config=index_config,
+        rebuild=args.rebuild,
+        eval_queries=args.eval_queries,
+        keep_snapshots=args.keep_snapshots,
+    )
+    if path:
+        print(f"Wrote {path}")
+    return 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main())
@@ -0,0 +1,129 @@
+import os
+import re
+import sqlite3
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+logger = logging.getLogger("embedding_cache")
+
+
+def normalize_text(text: str) -> str:
+    """Collapse whitespace so trivially different queries share a cache entry."""
+    return re.sub(r"\s+", " ", text).strip()
+
+
+def text_key(text: str) -> str:
+    """SHA-256 of the normalized text, used as the cache key together with the model name."""
+    return hashlib.sha256(normalize_text(text).encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    Two-tier cache of embedding vectors keyed by (embedding_model, text hash).
+
+    Tier one is an in-memory LRU bounded by entry count. Tier two is a SQLite
+    table that survives restarts; vectors are stored as float32 blobs.
+    Lookups that miss memory but hit SQLite are promoted into the LRU.
+    """
+
+    def __init__(self, db_path: Optional[str] = "embedding_cache.db", max_entries: int = 4096):
+        """
+        Initialize the cache.
+
+        Args:
+            db_path: Path of the SQLite file; None keeps the cache in memory only
+            max_entries: Maximum number of vectors held in the in-memory LRU
+        """
+        self.max_entries = max_entries
+        self._lru: "OrderedDict[Tuple[str, str], np.ndarray]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = None
+        if db_path:
+            directory = os.path.dirname(db_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._conn = sqlite3.connect(db_path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings ("
+                "model TEXT NOT NULL, "
+                "text_hash TEXT NOT NULL, "
+                "dim INTEGER NOT NULL, "
+                "vector BLOB NOT NULL, "
+                "PRIMARY KEY (model, text_hash))"
+            )
+            self._conn.commit()
+
+    def _remember(self, key: Tuple[str, str], vector: np.ndarray):
+        """Insert into the LRU, evicting the least recently used entries."""
+        self._lru[key] = vector
+        self._lru.move_to_end(key)
+        while len(self._lru) > self.max_entries:
+            self._lru.popitem(last=False)
+
+    def get_many(self, model: str, texts: Sequence[str]) -> Dict[int, List[float]]:
+        """
+        Look up cached embeddings.
+
+        Args:
+            model: Embedding model name
+            texts: Texts to look up
+
+        Returns:
+            Mapping of position in `texts` to embedding for every cache hit
+        """
+        hits: Dict[int, List[float]] = {}
+        missing: Dict[str, List[int]] = {}
+        with self._lock:
+            for i, text in enumerate(texts):
+                key = (model, text_key(text))
+                vector = self._lru.get(key)
+                if vector is not None:
+                    self._lru.move_to_end(key)
+                    hits[i] = vector.tolist()
+                else:
+                    missing.setdefault(key[1], []).append(i)
+
+            if missing and self._conn is not None:
+                hashes = list(missing)
+                for start in range(0, len(hashes), 500):
+                    chunk = hashes[start:start + 500]
+                    rows = self._conn.execute(
+                        f"SELECT text_hash, vector FROM embeddings WHERE model = ? "
+                        f"AND text_hash IN ({','.join('?' * len(chunk))})",
+                        [model, *chunk]
+                    ).fetchall()
+                    for text_hash, blob in rows:
+                        vector = np.frombuffer(blob, dtype=np.float32).copy()
+                        self._remember((model, text_hash), vector)
+                        for i in missing[text_hash]:
+                            hits[i] = vector.tolist()
+        return hits
+
+    def put_many(self, model: str, texts: Sequence[str], embeddings: Sequence[Sequence[float]]):
+        """Store embeddings for `texts` in both tiers."""
+        rows = []
+        with self._lock:
+            for text, embedding in zip(texts, embeddings):
+                vector = np.asarray(embedding, dtype=np.float32)
+                text_hash = text_key(text)
+                self._remember((model, text_hash), vector)
+                rows.append((model, text_hash, int(vector.shape[0]), vector.tobytes()))
+            if rows and self._conn is not None:
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO embeddings (model, text_hash, dim, vector) VALUES (?, ?, ?, ?)",
+                    rows
+                )
+                self._conn.commit()
+
+    def close(self):
+        """Close the SQLite connection."""
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
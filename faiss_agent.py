@@ -1,14 +1,28 @@
 import os
 import json
 import re
+import asyncio
+import logging
 import faiss
 import pickle
 import numpy as np
-from typing import List, Dict, Tuple, Optional, Union, Any
+from typing import List, Dict, Tuple, Optional, Union, Any, AsyncIterator, Callable
 from pydantic import BaseModel, Field
 import tiktoken
-from openai import OpenAI
+from openai import OpenAI, BadRequestError
+from embedding_cache import EmbeddingCache, text_key
+import vector_store
+from ann_index import IndexConfig, apply_search_config, rerank, search_parameters, truncate_embeddings
+from lexical_index import BM25Index, load_or_build, reciprocal_rank_fusion
+from report_encoding import encode_lab_report, token_savings
+from lab_summary import summarize_lab_report
+from query_builder import build_search_query
+from json_splitter import repair_json, split_json_and_markdown
+from llm_calls import InvalidAnswer, LLMCaller, Route
 from google import genai
+from google.genai import errors as genai_errors, types as genai_types
+
+logger = logging.getLogger("faiss_agent")
 
 class Product(BaseModel):
     """Represents a Product to be used in the treatment pipeline."""
@@ -27,6 +41,62 @@ class Recommendation(BaseModel):
     RO: List[Product]
     postreatment: List[Product]
 
+
+class RecommendationResult(BaseModel):
+    """Structured-output reply of the recommendation call."""
+    recommendation: Recommendation
+    rationale: str = Field(description="Markdown explanation under the headings **RO SELECTED**, **Pretreatment**, **Posttreatment**")
+
+
+def strict_json_schema(model) -> Dict[str, Any]:
+    """
+    JSON schema of a Pydantic model in the form OpenAI's strict structured outputs accept.
+
+    Every object gets `additionalProperties: false` and lists all its
+    properties as required (optional fields stay nullable); defaults are
+    dropped, since strict mode does not support them.
+    """
+    def visit(node):
+        if isinstance(node, dict):
+            node.pop("default", None)
+            if node.get("type") == "object" and "properties" in node:
+                node["additionalProperties"] = False
+                node["required"] = list(node["properties"])
+            for value in node.values():
+                visit(value)
+        elif isinstance(node, list):
+            for value in node:
+                visit(value)
+        return node
+
+    return visit(model.model_json_schema())
+
+
+# Output instructions when the reply is constrained to RecommendationResult
+STRUCTURED_OUTPUT_INSTRUCTIONS = (
+    "Reply with a JSON object with two fields: `recommendation`, holding the pretreatment, RO and "
+    "postreatment product lists (the category field of a product is only one of pretreatment, RO, postreatment; "
+    "price is null for now), and `rationale`, explaining your approach in Markdown under these headings:\n"
+    "**RO SELECTED**, **Pretreatment**, **Posttreatment**."
+)
+
+# Recommendation model used when a request names none
+DEFAULT_MODELS = {"gpt": "openai/gpt-4.1", "gemini": "gemini-2.5-pro-exp-03-25"}
+
+# Treatment stage each category covers, appended to the search query in multi-query mode
+CATEGORY_QUERY_HINTS = {
+    "training": "water treatment system design guidelines",
+    "ro": "reverse osmosis membranes and RO system sizing",
+    "pumps": "feed and high pressure pumps flow and head",
+    "filters": "pretreatment multimedia and cartridge filters",
+    "media": "filter media sand and activated carbon",
+    "airblowers": "air blowers for aeration and backwash",
+    "chemicals": "antiscalant and membrane cleaning chemicals",
+    "domestic": "domestic point of use water treatment",
+    "dosage": "chemical dosing pumps and posttreatment",
+}
+
+
 class RagAgent:
     """
     Retrieval Augmented Generation (RAG) agent for water treatment recommendations.
@@ -48,7 +118,24 @@ class RagAgent:
         embedding_model: str = "text-embedding-3-large",
         context_token_limit: int = 6700,
         docs_per_category: int = 3,
-        categories: List[str] = None
+        categories: List[str] = None,
+        async_gpt_client = None,
+        async_embedding_client = None,
+        embedding_cache: Optional[EmbeddingCache] = None,
+        index_config: Optional[IndexConfig] = None,
+        rerank_factor: int = 4,
+        hybrid: bool = True,
+        rrf_k: int = 60,
+        multi_query: bool = False,
+        query_hints: Optional[Dict[str, str]] = None,
+        report_encoding: str = "table",
+        drop_passing: bool = False,
+        summary_mode: str = "rules",
+        query_mode: str = "llm",
+        query_keywords: Optional[Dict[str, Tuple[str, str]]] = None,
+        structured_output: bool = True,
+        llm_caller: Optional[LLMCaller] = None,
+        backup_models: Optional[Dict[str, Tuple[str, str]]] = None
     ):
         """
         Initialize the RAG agent with FAISS index and configuration.
@@ -63,6 +150,28 @@ class RagAgent:
             context_token_limit: Maximum tokens for context
             docs_per_category: Number of documents to retrieve per category
             categories: List of categories to query (defaults to standard set if None)
+            async_gpt_client: Async OpenAI client for GPT models, used by aprocess
+            async_embedding_client: Async client for generating embeddings, used by aprocess
+            embedding_cache: Optional EmbeddingCache shared across requests and agent reloads
+            index_config: Overrides the search-time parameters (nprobe, ef_search) stored with the index
+            rerank_factor: When the index holds truncated embeddings, fetch this many times more
+                candidates per category and re-rank them with the full vectors (0 disables re-ranking)
+            hybrid: Fuse BM25 lexical hits with the dense hits of every category
+            rrf_k: Rank constant of the reciprocal-rank fusion
+            multi_query: Search with one sub-query per category / treatment stage in addition to the query
+            query_hints: Category -> stage phrase used to form sub-queries (defaults to CATEGORY_QUERY_HINTS)
+            report_encoding: How parsed lab reports go into prompts: 'table' (report_encoding.encode_lab_report) or 'json'
+            drop_passing: With 'table', leave passing parameters out of the table
+            summary_mode: Lab summary from 'rules' (lab_summary.summarize_lab_report, no LLM call) or 'llm' (json_summarizer)
+            query_mode: Default search query source: 'llm' (generate_search_query) or 'template' (query_builder.build_search_query)
+            query_keywords: Parameter pattern -> (stage, keywords) table for 'template' queries (defaults to query_builder.TREATMENT_KEYWORDS)
+            structured_output: Constrain recommendation replies to the RecommendationResult schema
+                (OpenAI json_schema / Gemini response_schema) instead of parsing JSON out of free text
+            llm_caller: Deadlines, retries, circuit breakers and hedging for recommendation calls;
+                share one across agent reloads to keep its breaker and latency state
+            backup_models: Provider -> (provider, model) that takes over a recommendation call when the
+                primary fails, or races it when hedging is on; defaults to the other provider when both
+                clients are configured ({} disables backups)
         """
         print("Initializing the RAG Agent with FAISS")
         self.faiss_dir = faiss_dir
@@ -70,6 +179,35 @@ class RagAgent:
         self.gpt_client = gpt_client
         self.gemini_client = gemini_client
         self.embedding_client = embedding_client
+        self.async_gpt_client = async_gpt_client
+        self.async_embedding_client = async_embedding_client
+        self.embedding_cache = embedding_cache
+        self.index_config = index_config
+        self.rerank_factor = rerank_factor
+        self.hybrid = hybrid
+        self.rrf_k = rrf_k
+        self.multi_query = multi_query
+        self.query_hints = query_hints or CATEGORY_QUERY_HINTS
+        if report_encoding not in ("table", "json"):
+            raise ValueError(f"Unsupported report encoding: {report_encoding}. Use 'table' or 'json'.")
+        self.report_encoding = report_encoding
+        self.drop_passing = drop_passing
+        if summary_mode not in ("rules", "llm"):
+            raise ValueError(f"Unsupported summary mode: {summary_mode}. Use 'rules' or 'llm'.")
+        self.summary_mode = summary_mode
+        self.query_mode = self._checked_query_mode(query_mode)
+        self.query_keywords = query_keywords
+        self.structured_output = structured_output
+        # Providers that rejected a schema request; they get text-mode requests from then on
+        self.structured_output_unsupported = set()
+        self.llm_caller = llm_caller or LLMCaller()
+        if backup_models is None:
+            backup_models = {
+                provider: (other, DEFAULT_MODELS[other])
+                for provider, other in (("gpt", "gemini"), ("gemini", "gpt"))
+                if self._has_client(provider) and self._has_client(other)
+            }
+        self.backup_models = backup_models
         self.embedding_model = embedding_model
         self.tokenizer = tiktoken.get_encoding("cl100k_base")
         self.context_token_limit = context_token_limit
@@ -83,15 +221,55 @@ class RagAgent:
         self.load_faiss_data()
 
     def load_faiss_data(self):
-        """Load FAISS index and related data from files."""
+        """
+        Load FAISS index and related data from files.
+
+        A versioned snapshot in `<faiss_dir>/<index_name>/` (see vector_store.py)
+        is preferred: the index is memory-mapped and texts/metadata are read
+        lazily. Otherwise the legacy `.index` + pickle files are loaded.
+        """
         try:
-            self.index = faiss.read_index(os.path.join(self.faiss_dir, f"{self.index_name}.index"))
-            
-            with open(os.path.join(self.faiss_dir, f"{self.index_name}_texts.pkl"), 'rb') as f:
-                self.texts = pickle.load(f)
-            
-            with open(os.path.join(self.faiss_dir, f"{self.index_name}_metadata.pkl"), 'rb') as f:
-                self.metadatas = pickle.load(f)
+            store_dir = os.path.join(self.faiss_dir, self.index_name)
+            text_token_counts = None
+            if vector_store.has_bundle(store_dir):
+                bundle = vector_store.load_bundle(store_dir)
+                self.index = bundle.index
+                self.texts = bundle.texts
+                self.metadatas = bundle.metadatas
+                self.category_code_map = bundle.category_code_map
+                self.category_codes = bundle.category_codes
+                text_token_counts = bundle.text_token_counts(self.tokenizer.name)
+                self.store_version = bundle.version
+                self.search_dims = bundle.index_config.search_dims
+                self.full_vectors = bundle.vectors() if self.search_dims else None
+                load_lexical = bundle.lexical_index
+            else:
+                self.index = faiss.read_index(os.path.join(self.faiss_dir, f"{self.index_name}.index"))
+                
+                with open(os.path.join(self.faiss_dir, f"{self.index_name}_texts.pkl"), 'rb') as f:
+                    self.texts = pickle.load(f)
+                
+                with open(os.path.join(self.faiss_dir, f"{self.index_name}_metadata.pkl"), 'rb') as f:
+                    self.metadatas = pickle.load(f)
+
+                self._encode_categories()
+                self.store_version = None
+                self.search_dims = 0
+                self.full_vectors = None
+                load_lexical = self._load_legacy_lexical_index
+
+            if self.index_config is not None:
+                apply_search_config(self.index, self.index_config)
+            self._build_category_selectors()
+            self._prepare_token_counts(text_token_counts)
+
+            self.lexical_index = None
+            if self.hybrid:
+                try:
+                    self.lexical_index = load_lexical()
+                except Exception as e:
+                    # Dense retrieval still works without the lexical side
+                    print(f"Error loading BM25 index: {str(e)}")
             
             print(f"Loaded FAISS index and data from {self.faiss_dir}")
         except Exception as e:
@@ -100,20 +278,379 @@ class RagAgent:
             self.index = None
             self.texts = []
             self.metadatas = []
+            self.store_version = None
+            self.search_dims = 0
+            self.full_vectors = None
+            self.lexical_index = None
+            self.category_code_map = {}
+            self.category_codes = np.zeros(0, dtype='int8')
+            self.category_ids = {}
+            self.category_selectors = {}
+            self.text_token_counts = np.zeros(0, dtype='int32')
+            self._extra_blocks = {}
+            self._header_tokens = {}
+
+    def _load_legacy_lexical_index(self) -> BM25Index:
+        """BM25 index persisted as `<index_name>_bm25.npz` next to the legacy FAISS files."""
+        texts_path = os.path.join(self.faiss_dir, f"{self.index_name}_texts.pkl")
+        stat = os.stat(texts_path)
+        return load_or_build(
+            os.path.join(self.faiss_dir, f"{self.index_name}_bm25.npz"),
+            self.texts,
+            f"{stat.st_size}:{stat.st_mtime_ns}"
+        )
 
     def count_tokens(self, text: str) -> int:
         """Count tokens in text using the tokenizer."""
-        encoding = tiktoken.get_encoding("cl100k_base")
-        num_tokens = len(encoding.encode(text))
-        return num_tokens
+        return len(self.tokenizer.encode(text))
+
+    @staticmethod
+    def _checked_query_mode(query_mode: str) -> str:
+        if query_mode not in ("llm", "template"):
+            raise ValueError(f"Unsupported query mode: {query_mode}. Use 'llm' or 'template'.")
+        return query_mode
+
+    @staticmethod
+    def _parsed_lab_report(lab_report: Union[str, Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+        """The lab report as a dict, or None if it is a string that is not a JSON object."""
+        if isinstance(lab_report, dict):
+            return lab_report
+        try:
+            parsed = json.loads(lab_report)
+        except ValueError:
+            return None
+        return parsed if isinstance(parsed, dict) else None
+
+    def prepare_lab_report(self, lab_report: Union[str, Dict[str, Any]]) -> str:
+        """
+        Lab report text for the prompts.
+
+        Parsed reports (a dict, or its JSON string) are sent as the compact
+        table of report_encoding.encode_lab_report when report_encoding is
+        'table', and as compact JSON otherwise. Strings that are not JSON
+        are passed through unchanged.
+        """
+        parsed = self._parsed_lab_report(lab_report)
+        if parsed is None:
+            return lab_report
+        lab_report = parsed
+        if self.report_encoding == "json":
+            return serialize_lab_report(lab_report)
+        encoded = encode_lab_report(lab_report, drop_passing=self.drop_passing)
+        if logger.isEnabledFor(logging.DEBUG):
+            # Counting tokens runs tiktoken over both encodings; skip it unless it is logged
+            savings = token_savings(lab_report, encoded, self.count_tokens)
+            logger.debug(
+                f"Lab report encoded in {savings['encoded_tokens']} tokens "
+                f"({savings['saved_tokens']} fewer than JSON, {savings['saved_ratio']:.0%})"
+            )
+        return encoded
+
+    def _extra_block(self, metadata: Dict[str, Any]) -> str:
+        """Summary or questions block appended after a chunk in the context."""
+        if metadata.get("summary"):
+            return f"Summary: {metadata['summary']}\n"
+        qblock = metadata.get("questions_this_excerpt_can_answer", "")
+        if qblock:
+            cleaned = re.sub(r'<think>.*?</think>', '', qblock, flags=re.DOTALL).strip()
+            return f"Questions: {cleaned[:500]}\n"
+        return ""
+
+    def _prepare_token_counts(self, text_token_counts: Optional[np.ndarray] = None):
+        """
+        Token counts of every chunk, so context budgeting is integer arithmetic.
+
+        Counts stored in a snapshot are used as-is; otherwise all texts are
+        encoded once here. Metadata blocks are built and counted on first use.
+        """
+        if text_token_counts is None:
+            text_token_counts = np.array(
+                [len(tokens) for tokens in self.tokenizer.encode_batch(list(self.texts))], dtype='int32'
+            )
+        self.text_token_counts = text_token_counts
+        self._extra_blocks = {}
+        self._header_tokens = {}
+
+    def _extra_block_for(self, idx: int) -> Tuple[str, int]:
+        """Metadata block of chunk `idx` and its token count, memoised per chunk."""
+        cached = self._extra_blocks.get(idx)
+        if cached is None:
+            block = self._extra_block(self.metadatas[idx])
+            cached = (block, self.count_tokens(block) if block else 0)
+            self._extra_blocks[idx] = cached
+        return cached
+
+    def _header_token_count(self, header: str) -> int:
+        """Token count of a context header; headers repeat across requests so they are memoised."""
+        count = self._header_tokens.get(header)
+        if count is None:
+            count = len(self.tokenizer.encode(header))
+            if len(self._header_tokens) < 10000:
+                self._header_tokens[header] = count
+        return count
 
     def get_embedding(self, text: str) -> List[float]:
         """Get embedding vector for text using specified client."""
-        response = self.embedding_client.embeddings.create(
-            input=[text],
-            model=self.embedding_model
+        return self.get_embeddings([text])[0]
+
+    async def aget_embedding(self, text: str) -> List[float]:
+        """Async variant of get_embedding."""
+        return (await self.aget_embeddings([text]))[0]
+
+    def get_embeddings(self, texts: List[str]) -> List[List[float]]:
+        """
+        Get embedding vectors for several texts.
+
+        Cached vectors are returned directly; all cache misses are sent to the
+        embedding client in a single batched request.
+
+        Args:
+            texts: Texts to embed
+
+        Returns:
+            List of embeddings in the same order as `texts`
+        """
+        embeddings, misses = self._cached_embeddings(texts)
+        if misses:
+            response = self.embedding_client.embeddings.create(
+                input=misses,
+                model=self.embedding_model
+            )
+            self._fill_misses(texts, embeddings, misses, response)
+        return embeddings
+
+    async def aget_embeddings(self, texts: List[str]) -> List[List[float]]:
+        """Async variant of get_embeddings."""
+        if self.async_embedding_client is None:
+            return await asyncio.to_thread(self.get_embeddings, texts)
+        # The cache is SQLite; keep its reads and writes off the event loop
+        embeddings, misses = await asyncio.to_thread(self._cached_embeddings, texts)
+        if misses:
+            response = await self.async_embedding_client.embeddings.create(
+                input=misses,
+                model=self.embedding_model
+            )
+            await asyncio.to_thread(self._fill_misses, texts, embeddings, misses, response)
+        return embeddings
+
+    def _cached_embeddings(self, texts: List[str]) -> Tuple[List[Optional[List[float]]], List[str]]:
+        """Return cached embeddings (None where missing) and the distinct texts still to embed."""
+        embeddings: List[Optional[List[float]]] = [None] * len(texts)
+        if self.embedding_cache is not None:
+            for i, embedding in self.embedding_cache.get_many(self.embedding_model, texts).items():
+                embeddings[i] = embedding
+        misses, seen = [], set()
+        for text, embedding in zip(texts, embeddings):
+            key = text_key(text)
+            if embedding is None and key not in seen:
+                seen.add(key)
+                misses.append(text)
+        return embeddings, misses
+
+    def _fill_misses(self, texts: List[str], embeddings: List[Optional[List[float]]], misses: List[str], response):
+        """Slot a batched embeddings response into place and store it in the cache."""
+        data = sorted(response.data, key=lambda d: getattr(d, "index", 0))
+        fetched = {text_key(text): d.embedding for text, d in zip(misses, data)}
+        for i, text in enumerate(texts):
+            if embeddings[i] is None:
+                embeddings[i] = fetched[text_key(text)]
+        if self.embedding_cache is not None:
+            self.embedding_cache.put_many(self.embedding_model, misses, [d.embedding for d in data])
+
+    async def _achat(self, **kwargs):
+        """Run a chat completion on the async GPT client, or the sync one in a thread."""
+        if self.async_gpt_client is None:
+            return await asyncio.to_thread(self.gpt_client.chat.completions.create, **kwargs)
+        return await self.async_gpt_client.chat.completions.create(**kwargs)
+
+    async def _agemini(self, **kwargs):
+        """Run a Gemini generate_content call on the client's async surface when available."""
+        aio = getattr(self.gemini_client, "aio", None)
+        if aio is None:
+            return await asyncio.to_thread(self.gemini_client.models.generate_content, **kwargs)
+        return await aio.models.generate_content(**kwargs)
+
+    async def _astream_chat(self, **kwargs) -> AsyncIterator[str]:
+        """
+        Open a chat completion stream and return its text deltas.
+
+        Request errors are raised here, before the first delta is read.
+        Without an async client the whole reply arrives at once.
+        """
+        if self.async_gpt_client is None:
+            response = await asyncio.to_thread(self.gpt_client.chat.completions.create, **kwargs)
+            return _single_chunk(response.choices[0].message.content or "")
+        stream = await self.async_gpt_client.chat.completions.create(stream=True, **kwargs)
+
+        async def deltas():
+            async for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+
+        return deltas()
+
+    async def _astream_gemini(self, **kwargs) -> AsyncIterator[str]:
+        """Open a Gemini stream and return its text chunks; see _astream_chat."""
+        aio = getattr(self.gemini_client, "aio", None)
+        if aio is None:
+            response = await asyncio.to_thread(self.gemini_client.models.generate_content, **kwargs)
+            return _single_chunk(response.text or "")
+        stream = await aio.models.generate_content_stream(**kwargs)
+
+        async def texts():
+            async for chunk in stream:
+                if chunk.text:
+                    yield chunk.text
+
+        return texts()
+
+    def _encode_categories(self):
+        """Encode metadata categories as a compact integer column with a category -> code map."""
+        names = sorted({metadata.get("category") or "" for metadata in self.metadatas} | set(self.categories))
+        self.category_code_map = {name: code for code, name in enumerate(names)}
+        dtype = 'int8' if len(names) < 128 else 'int16'
+        self.category_codes = np.array(
+            [self.category_code_map[metadata.get("category") or ""] for metadata in self.metadatas],
+            dtype=dtype
         )
-        return response.data[0].embedding
+
+    def _build_category_selectors(self):
+        """Group vector ids by category code and build one FAISS IDSelector per category."""
+        self.category_ids = {
+            cat: np.flatnonzero(self.category_codes == self.category_code_map.get(cat, -1)).astype('int64')
+            for cat in self.categories
+        }
+        self.category_selectors = {
+            cat: faiss.IDSelectorBatch(ids)
+            for cat, ids in self.category_ids.items() if len(ids)
+        }
+
+    def category_k(self, category: str) -> int:
+        """Number of neighbours to retrieve for a category."""
+        if category == "training":
+            # Training material is not capped by docs_per_category
+            return self.docs_per_category * len(self.categories) * 2
+        return self.docs_per_category
+
+    def search_by_category(self, query_embeddings: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Exact top-k search restricted to each category.
+
+        Every category is searched with an IDSelector over its own vector ids,
+        so sparse categories return their nearest chunks however far they are
+        from the query. All query rows are searched in one call per category.
+
+        If the index holds Matryoshka-truncated embeddings, the query is
+        truncated the same way for the first pass, and `rerank_factor` times
+        more candidates are re-scored with the full vectors.
+
+        Args:
+            query_embeddings: float32 array of shape (n_queries, dim)
+
+        Returns:
+            Tuple of (distances, indices), each of shape
+            (len(categories), n_queries, k), padded with inf / -1
+        """
+        n_queries = query_embeddings.shape[0]
+        k = max(self.category_k(cat) for cat in self.categories)
+        distances = np.full((len(self.categories), n_queries, k), np.inf, dtype='float32')
+        indices = np.full((len(self.categories), n_queries, k), -1, dtype='int64')
+        search_queries = truncate_embeddings(query_embeddings, self.search_dims)
+        reranking = self.search_dims and self.rerank_factor and self.full_vectors is not None
+        for c, cat in enumerate(self.categories):
+            selector = self.category_selectors.get(cat)
+            if selector is None:
+                continue
+            cat_k = min(self.category_k(cat), len(self.category_ids[cat]))
+            n_candidates = min(cat_k * self.rerank_factor, len(self.category_ids[cat])) if reranking else cat_k
+            cat_distances, cat_indices = self.index.search(
+                search_queries, n_candidates, params=search_parameters(self.index, selector)
+            )
+            if reranking:
+                cat_distances, cat_indices = rerank(self.full_vectors, query_embeddings, cat_indices, cat_k)
+            distances[c, :, :cat_k] = cat_distances
+            indices[c, :, :cat_k] = cat_indices
+        return distances, indices
+
+    def merge_query_rows(self, distances: np.ndarray, indices: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Merge the hits of all query rows of every category, keeping each chunk once.
+
+        Args:
+            distances: Array of shape (len(categories), n_queries, k) from search_by_category
+            indices: Matching array of indices
+
+        Returns:
+            Tuple of (distances, indices) of shape (len(categories), n_queries * k),
+            ordered by best distance over the rows and padded with inf / -1
+        """
+        n_categories = distances.shape[0]
+        distances = distances.reshape(n_categories, -1)
+        indices = indices.reshape(n_categories, -1)
+        merged_distances = np.full_like(distances, np.inf)
+        merged_indices = np.full_like(indices, -1)
+        for c in range(n_categories):
+            valid = indices[c] >= 0
+            cat_distances, cat_indices = distances[c][valid], indices[c][valid]
+            order = np.argsort(cat_distances, kind='stable')
+            # np.unique keeps the first, i.e. closest, occurrence of each chunk
+            _, first = np.unique(cat_indices[order], return_index=True)
+            keep = order[np.sort(first)]
+            merged_distances[c, :len(keep)] = cat_distances[keep]
+            merged_indices[c, :len(keep)] = cat_indices[keep]
+        return merged_distances, merged_indices
+
+    def select_category_hits(self, indices: np.ndarray, distances: np.ndarray) -> List[Tuple[np.ndarray, np.ndarray]]:
+        """
+        Select the hits for every category in one masked numpy operation.
+
+        Args:
+            indices: Array of shape (len(categories), k) from search_by_category
+            distances: Matching array of distances
+
+        Returns:
+            One (text_offsets, distances) pair per category, in category order.
+            Offsets index into self.texts and self.metadatas.
+        """
+        valid = indices >= 0  # FAISS uses -1 to indicate no result
+        safe = np.where(valid, indices, 0)
+        wanted = np.array([self.category_code_map.get(cat, -1) for cat in self.categories])[:, None]
+        limits = np.array([self.category_k(cat) for cat in self.categories])[:, None]
+        mask = valid & (self.category_codes[safe] == wanted)
+        mask &= np.cumsum(mask, axis=1) <= limits
+        return [(indices[c][mask[c]], distances[c][mask[c]]) for c in range(len(self.categories))]
+
+    def fuse_lexical_hits(
+        self,
+        search_query: str,
+        category_hits: List[Tuple[np.ndarray, np.ndarray]]
+    ) -> List[Tuple[np.ndarray, np.ndarray]]:
+        """
+        Merge BM25 hits into the dense hits of every category with reciprocal-rank fusion.
+
+        Exact strings such as model numbers and "250 L/hr" match lexically even
+        when their embeddings are far from the query.
+
+        Args:
+            search_query: Query text
+            category_hits: Dense (text_offsets, distances) per category, from select_category_hits
+
+        Returns:
+            Fused (text_offsets, distances) per category, still capped at category_k.
+            Hits found only lexically have a distance of NaN.
+        """
+        scores = self.lexical_index.scores(search_query)
+        fused_hits = []
+        for cat, (dense_ids, dense_distances) in zip(self.categories, category_hits):
+            k = self.category_k(cat)
+            lexical_ids = BM25Index.top_k(scores, self.category_ids.get(cat, np.zeros(0, dtype='int64')), k)
+            fused_ids = reciprocal_rank_fusion([dense_ids, lexical_ids], k=self.rrf_k)[:k]
+            distance_of = dict(zip(dense_ids.tolist(), dense_distances.tolist()))
+            fused_hits.append((
+                np.array(fused_ids, dtype='int64'),
+                np.array([distance_of.get(idx, np.nan) for idx in fused_ids], dtype='float32')
+            ))
+        return fused_hits
 
     def filter_by_category(self, indices, distances, category):
         """
@@ -127,26 +664,36 @@ class RagAgent:
         Returns:
             Tuple of (filtered_indices, filtered_distances, filtered_texts, filtered_metadatas)
         """
-        filtered_indices = []
-        filtered_distances = []
-        filtered_texts = []
-        filtered_metadatas = []
-        
-        for i, idx in enumerate(indices):
-            if idx != -1:  # FAISS uses -1 to indicate no result
-                metadata = self.metadatas[idx]
-                if metadata.get("category") == category:
-                    filtered_indices.append(idx)
-                    filtered_distances.append(distances[i])
-                    filtered_texts.append(self.texts[idx])
-                    filtered_metadatas.append(metadata)
-                    
-                    # For training category, we might want to get more results
-                    if category != "training" and len(filtered_indices) >= self.docs_per_category:
-                        break
-                        
+        indices = np.asarray(indices)
+        distances = np.asarray(distances)
+        valid = indices >= 0
+        mask = valid & (self.category_codes[np.where(valid, indices, 0)] == self.category_code_map.get(category, -1))
+        # For training category, we might want to get more results
+        if category != "training":
+            mask &= np.cumsum(mask) <= self.docs_per_category
+        selected = np.flatnonzero(mask)
+        filtered_indices = indices[selected].tolist()
+        filtered_distances = distances[selected].tolist()
+        filtered_texts = [self.texts[idx] for idx in filtered_indices]
+        filtered_metadatas = [self.metadatas[idx] for idx in filtered_indices]
         return filtered_indices, filtered_distances, filtered_texts, filtered_metadatas
 
+    def search_queries(self, search_query: str) -> List[str]:
+        """
+        Queries to embed for `search_query`.
+
+        In multi-query mode this is the query itself followed by one sub-query
+        per category, formed by appending that category's stage hint.
+        """
+        if not self.multi_query:
+            return [search_query]
+        queries = [search_query]
+        for cat in self.categories:
+            sub_query = f"{search_query} {self.query_hints.get(cat, cat)}"
+            if sub_query not in queries:
+                queries.append(sub_query)
+        return queries
+
     def build_context(self, search_query: str) -> str:
         """
         Build retrieval context by querying FAISS index across multiple categories.
@@ -157,78 +704,134 @@ class RagAgent:
         Returns:
             String containing formatted context from retrieved documents
         """
-        import numpy as np
         print("Building RAG Context using FAISS")
         try:
-            query_embedding = self.get_embedding(search_query)
-            query_embedding_np = np.array([query_embedding]).astype('float32')
-            print(f"Generated embedding of length {len(query_embedding)}")
+            # All sub-queries go out in one embeddings request
+            query_embeddings = self.get_embeddings(self.search_queries(search_query))
+            print(f"Generated {len(query_embeddings)} embeddings of length {len(query_embeddings[0])}")
         except Exception as e:
             print(f"Error generating embedding: {str(e)}")
-            # Generate a fallback random embedding
-            query_embedding = list(np.random.rand(1536))
-            query_embedding_np = np.array([query_embedding]).astype('float32')
-            print("Using random fallback embedding")
-        
-        # Initial search with more results than needed to allow for filtering
-        total_docs_needed = self.docs_per_category * len(self.categories) * 2
-        total_docs_needed = min(total_docs_needed, len(self.texts))  # Don't exceed available docs
-        
+            query_embeddings = [self._fallback_embedding()]
+        return self.build_context_from_embeddings(query_embeddings, search_query)
+
+    async def abuild_context(self, search_query: str) -> str:
+        """Async variant of build_context; the FAISS search and assembly run in a worker thread."""
+        print("Building RAG Context using FAISS")
+        try:
+            query_embeddings = await self.aget_embeddings(self.search_queries(search_query))
+            print(f"Generated {len(query_embeddings)} embeddings of length {len(query_embeddings[0])}")
+        except Exception as e:
+            print(f"Error generating embedding: {str(e)}")
+            query_embeddings = [self._fallback_embedding()]
+        return await asyncio.to_thread(self.build_context_from_embeddings, query_embeddings, search_query)
+
+    def _fallback_embedding(self) -> List[float]:
+        """Random embedding used when the embedding request fails."""
+        print("Using random fallback embedding")
+        return list(np.random.rand(1536))
+
+    def build_context_from_embedding(self, query_embedding: List[float], search_query: Optional[str] = None) -> str:
+        """
+        Build retrieval context for an already computed query embedding.
+
+        Args:
+            query_embedding: Embedding vector of the search query
+            search_query: Query text; when given and hybrid search is enabled,
+                BM25 hits are fused with the dense hits
+
+        Returns:
+            String containing formatted context from retrieved documents
+        """
+        return self.build_context_from_embeddings([query_embedding], search_query)
+
+    def retrieve_hits(
+        self,
+        query_embeddings: List[List[float]],
+        search_query: Optional[str] = None
+    ) -> List[Tuple[np.ndarray, np.ndarray]]:
+        """
+        Retrieved chunks for the query embeddings, before context assembly.
+
+        Args:
+            query_embeddings: Embedding vectors of the search query and any sub-queries
+            search_query: Query text; when given and hybrid search is enabled,
+                BM25 hits are fused with the dense hits
+
+        Returns:
+            One (text_offsets, distances) pair per category, in category order
+        """
+        category_distances, category_indices = self.search_by_category(np.array(query_embeddings).astype('float32'))
+        # Drop padding and apply the per-category limits for all categories at once
+        category_distances, category_indices = self.merge_query_rows(category_distances, category_indices)
+        category_hits = self.select_category_hits(category_indices, category_distances)
+        if search_query and self.lexical_index is not None:
+            try:
+                category_hits = self.fuse_lexical_hits(search_query, category_hits)
+            except Exception as e:
+                print(f"Error in lexical search: {str(e)}")
+        return category_hits
+
+    def build_context_from_embeddings(self, query_embeddings: List[List[float]], search_query: Optional[str] = None) -> str:
+        """
+        Build retrieval context for one or more query embeddings.
+
+        All rows are searched together, one multi-row search per category,
+        and the hits of each category are merged keeping every chunk once at
+        its best distance.
+
+        Args:
+            query_embeddings: Embedding vectors of the search query and any sub-queries
+            search_query: Query text; when given and hybrid search is enabled,
+                BM25 hits are fused with the dense hits
+
+        Returns:
+            String containing formatted context from retrieved documents
+        """
         if self.index is None:
             print("FAISS index not loaded properly.")
             return "Error: FAISS index not loaded properly."
         
-        # Search FAISS index
+        # Exact top-k within every category
         try:
-            distances, indices = self.index.search(query_embedding_np, total_docs_needed)
-            distances = distances[0]  # Flatten arrays
-            indices = indices[0]
+            category_hits = self.retrieve_hits(query_embeddings, search_query)
         except Exception as e:
             print(f"Error searching FAISS index: {str(e)}")
             return f"Error searching vector database: {str(e)}"
             
         parts, total_tokens = [], 0
-        
-        for cat in self.categories:
+        for cat, (cat_indices, cat_distances) in zip(self.categories, category_hits):
             try:
-                # Filter results by category
-                cat_indices, cat_distances, cat_texts, cat_metadatas = self.filter_by_category(
-                    indices, distances, cat
-                )
-                
-                if not cat_indices:
+                if not len(cat_indices):
                     print(f"No results found for category: {cat}")
                     continue
                 
                 print(f"Found {len(cat_indices)} documents for category {cat}")
                 
-                for i, (text, metadata, dist) in enumerate(zip(cat_texts, cat_metadatas, cat_distances)):
+                for i, (idx, dist) in enumerate(zip(cat_indices, cat_distances)):
                     # Format header with category and relevance score
-                    header = f"\n## {cat.title()} (rel={1 - dist/2:.2f})\n"
-                    snippet = text
+                    relevance = f"rel={1 - dist/2:.2f}" if np.isfinite(dist) else "lexical match"
+                    header = f"\n## {cat.title()} ({relevance})\n"
+                    header_tokens = self._header_token_count(header)
                     
-                    # Truncate by token budget
-                    remain = self.context_token_limit - total_tokens - len(self.tokenizer.encode(header))
+                    # Truncate by token budget using the counts computed at load time
+                    remain = self.context_token_limit - total_tokens - header_tokens
                     if remain <= 0:
                         print(f"Reached token limit at {cat} document {i}")
                         break
                         
-                    tokens = self.tokenizer.encode(snippet)[:remain]
-                    snippet = self.tokenizer.decode(tokens)
-                    
-                    part = header + snippet + "\n"
+                    snippet = self.texts[idx]
+                    snippet_tokens = int(self.text_token_counts[idx])
+                    if snippet_tokens > remain:
+                        # Only the chunk that overflows the budget is re-encoded
+                        snippet = self.tokenizer.decode(self.tokenizer.encode(snippet)[:remain])
+                        snippet_tokens = remain
                     
                     # Include metadata where available
-                    if metadata.get("summary"):
-                        part += f"Summary: {metadata['summary']}\n"
-                    else:
-                        qblock = metadata.get("questions_this_excerpt_can_answer", "")
-                        if qblock:
-                            cleaned = re.sub(r'<think>.*?</think>', '', qblock, flags=re.DOTALL).strip()
-                            part += f"Questions: {cleaned[:500]}\n"
+                    extra_block, extra_tokens = self._extra_block_for(idx)
+                    part = header + snippet + "\n" + extra_block
                             
                     parts.append(part)
-                    total_tokens += len(self.tokenizer.encode(part))
+                    total_tokens += header_tokens + snippet_tokens + 1 + extra_tokens
                     print(f"Added {cat} document {i}, total tokens now: {total_tokens}")
                     
                     if total_tokens >= self.context_token_limit:
@@ -260,10 +863,34 @@ class RagAgent:
             Optimized search query for retrieval
         """
         print("Generating search query")
+        response = self.gpt_client.chat.completions.create(
+            model=model,
+            messages=self._search_query_messages(lab_json, user_query),
+            max_tokens=500,
+            temperature=0.0
+        )
+        print(response.choices[0].message.content)
+        return response.choices[0].message.content
+
+    async def agenerate_search_query(self, lab_json: str, user_query: str, model: str = "openai/gpt-4.1-mini") -> str:
+        """Async variant of generate_search_query."""
+        print("Generating search query")
+        response = await self._achat(
+            model=model,
+            messages=self._search_query_messages(lab_json, user_query),
+            max_tokens=500,
+            temperature=0.0
+        )
+        print(response.choices[0].message.content)
+        return response.choices[0].message.content
+
+    def _search_query_messages(self, lab_json: str, user_query: str) -> List[Dict[str, str]]:
+        """Chat messages asking the model to turn the lab report into a search query."""
         system_prompt = (
-            "You are an AI assistant that converts a JSON-formatted water lab report into a concise, "
+            "You are an AI assistant that converts a water lab report (JSON, or a pipe-separated table of "
+            "parameter|value|unit|guideline|remark) into a concise, "
             "action-oriented search query for semantic retrieval from a database of water-treatment equipment "
-            "and design guides. When you receive a JSON input, you must:\n"
+            "and design guides. When you receive a lab report, you must:\n"
             "1. Extract and name the site location, source and analysis date.\n"
             "2. List each parameter that exceeds WHO guidelines, giving its name, unit, and value.\n"
             "3. Summarize in keyword form the recommended treatment stages under three headings:\n"
@@ -279,80 +906,34 @@ class RagAgent:
 
         user_prompt = (
             f"{user_query}\n"
-            "Please transform the following water lab report (JSON) into a concise search query as per the system instructions.\n"
-            "```json\n"
+            "Please transform the following water lab report into a concise search query as per the system instructions.\n"
+            "```\n"
             f"{lab_json}\n"
             "```"
         )
-
-        response = self.gpt_client.chat.completions.create(
-            model=model,
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_prompt}
-            ],
-            max_tokens=500,
-            temperature=0.0
-        )
-        print(response.choices[0].message.content)
-        return response.choices[0].message.content
+        return [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_prompt}
+        ]
 
     def extract_json_and_markdown(self, response_text: str) -> Tuple[str, str]:
         """
         Extract JSON and markdown parts from model response.
 
+        Uses a single pass over the text (see json_splitter), so braces in
+        the prose or inside JSON strings cannot end the object early.
+
         Args:
             response_text: Raw response from LLM
 
         Returns:
             Tuple of (json_string, markdown_explanation)
         """
-        # Try to find JSON block using regex patterns for code blocks
-        json_match = re.search(r'```(?:json)?\s*([\s\S]*?)\s*```', response_text)
-        if json_match:
-            json_part = json_match.group(1).strip()
-            # Remove the JSON block to get markdown
-            markdown_part = re.sub(r'```(?:json)?\s*[\s\S]*?\s*```', '', response_text, 1).strip()
-            return json_part, markdown_part
-
-        # Try to find first JSON object with opening/closing braces
-        json_match = re.search(r'(\{[\s\S]*\})', response_text)
-        if json_match:
-            json_part = json_match.group(1).strip()
-            # Get everything after the JSON
-            parts = response_text.split(json_match.group(1), 1)
-            markdown_part = parts[1].strip() if len(parts) > 1 else ""
-            return json_part, markdown_part
-
-        # Try finding JSON after a marker like "JSON:" or "JSON Object:"
-        json_marker_match = re.search(r'(?:JSON|JSON Object|JSON Response):\s*(\{[\s\S]*\})', response_text, re.IGNORECASE)
-        if json_marker_match:
-            json_part = json_marker_match.group(1).strip()
-            # Get content after the JSON
-            parts = response_text.split(json_part, 1)
-            markdown_part = parts[1].strip() if len(parts) > 1 else ""
-            return json_part, markdown_part
-
-        # Fallback: try splitting by double newline and assume first part is JSON
-        parts = response_text.split("\n\n", 1)
-        if len(parts) == 2 and parts[0].strip().startswith('{') and parts[0].strip().endswith('}'):
-            return parts[0].strip(), parts[1].strip()
-
-        # If all else fails
-        raise ValueError("Could not extract JSON and markdown from the response")
+        return split_json_and_markdown(response_text)
 
     def fix_json_format(self, json_str: str) -> str:
-        """Attempt to fix common JSON formatting issues."""
-        # Replace single quotes with double quotes
-        json_str = re.sub(r"(?<!\w)'(.*?)'(?!\w)", r'"\1"', json_str)
-
-        # Fix missing quotes around keys
-        json_str = re.sub(r'(\s*)(\w+)(\s*):(\s*)', r'\1"\2"\3:\4', json_str)
-
-        # Fix trailing commas
-        json_str = re.sub(r',(\s*[}\]])', r'\1', json_str)
-
-        return json_str
+        """Attempt to fix common JSON formatting issues, leaving string contents alone."""
+        return repair_json(json_str)
 
     def get_gpt_recommendations(
         self,
@@ -362,6 +943,20 @@ class RagAgent:
         model: str = "openai/gpt-4.1",
         temperature: float = 0.2,
         max_tokens: int = 1500
+    ) -> Tuple[Recommendation, str]:
+        """Synchronous wrapper around aget_gpt_recommendations; must not be called from a running event loop."""
+        return asyncio.run(self.aget_gpt_recommendations(
+            rag_context, rag_summary, user_query, model=model, temperature=temperature, max_tokens=max_tokens
+        ))
+
+    async def aget_gpt_recommendations(
+        self,
+        rag_context: str,
+        rag_summary: str,
+        user_query: str,
+        model: str = "openai/gpt-4.1",
+        temperature: float = 0.2,
+        max_tokens: int = 1500
     ) -> Tuple[Recommendation, str]:
         """
         Get recommendations using GPT models.
@@ -377,6 +972,33 @@ class RagAgent:
             Tuple of (recommendation_object, explanation_markdown)
         """
         print("Generating GPT recommendations")
+        if self._use_structured_output("gpt"):
+            try:
+                response = await self._achat(
+                    **self._gpt_structured_request(rag_context, rag_summary, user_query, model, temperature, max_tokens)
+                )
+            except Exception as e:
+                if not self._schema_rejected(e):
+                    raise
+                self._structured_output_failed("gpt", e)
+            else:
+                return self._parse_structured_reply(response.choices[0].message.content)
+        response = await self._achat(
+            model=model,
+            messages=self._gpt_recommendation_messages(rag_context, rag_summary, user_query),
+            temperature=temperature,
+            max_tokens=max_tokens
+        )
+        return self._parse_gpt_reply(response.choices[0].message.content.strip())
+
+    def _gpt_recommendation_messages(
+        self,
+        rag_context: str,
+        rag_summary: str,
+        user_query: str,
+        structured: bool = False
+    ) -> List[Dict[str, str]]:
+        """Chat messages for the GPT recommendation call; `structured` asks for a RecommendationResult reply."""
         system_prompt = {
             "role": "system",
             "content": (
@@ -392,6 +1014,7 @@ class RagAgent:
                 "depending on the pretreatment and postreatment depending on the RO chosen based on the results from lab report."
                 "Avoid repeating of products or giving a product dealing with a pretreatment that another product has already dealt with"
                 "Just be as accurate as possible when giving results"
+            ) + (STRUCTURED_OUTPUT_INSTRUCTIONS if structured else (
                 "**First**, emit ONLY a JSON object matching these Pydantic schemas (no extra keys):\n\n"
                 "```python\n"
                 "class Product(BaseModel):\n"
@@ -407,23 +1030,65 @@ class RagAgent:
                 "Category field is only one of pretreatment, RO, postreatment.\n\n"
                 "**Then**, in Markdown, explain your approach under these headings:\n"
                 "**RO SELECTED**, **Pretreatment**, **Posttreatment**."
-            )
+            ))
         }
 
         user_query_content = {
             "role": "user",
             "content": f"{rag_context}\n\n{user_query}\n\nBelow are the Water Lab Results:\n{rag_summary}"
         }
+        return [system_prompt, user_query_content]
 
-        response = self.gpt_client.chat.completions.create(
+    def _gpt_structured_request(
+        self,
+        rag_context: str,
+        rag_summary: str,
+        user_query: str,
+        model: str,
+        temperature: float,
+        max_tokens: int
+    ) -> Dict[str, Any]:
+        """Chat completion arguments for a recommendation constrained to RecommendationResult."""
+        return dict(
             model=model,
-            messages=[system_prompt, user_query_content],
+            messages=self._gpt_recommendation_messages(rag_context, rag_summary, user_query, structured=True),
             temperature=temperature,
-            max_tokens=max_tokens
+            max_tokens=max_tokens,
+            response_format={
+                "type": "json_schema",
+                "json_schema": {
+                    "name": "recommendation_result",
+                    "strict": True,
+                    "schema": strict_json_schema(RecommendationResult),
+                },
+            },
         )
 
-        reply_text = response.choices[0].message.content.strip()
+    def _use_structured_output(self, provider: str) -> bool:
+        return self.structured_output and provider not in self.structured_output_unsupported
+
+    @staticmethod
+    def _schema_rejected(error: Exception) -> bool:
+        """Whether the API refused the request itself (HTTP 400), e.g. a model without schema support."""
+        if isinstance(error, BadRequestError):
+            return True
+        return isinstance(error, genai_errors.ClientError) and getattr(error, "code", None) == 400
+
+    def _structured_output_failed(self, provider: str, error: Exception):
+        """Fall back to text mode for a provider whose API rejected the schema request."""
+        print(f"Structured output request failed on {provider}, retrying in text mode: {str(error)}")
+        self.structured_output_unsupported.add(provider)
 
+    def _parse_structured_reply(self, reply_text: str) -> Tuple[Recommendation, str]:
+        """Validate a schema-constrained reply; no JSON extraction or repair is needed."""
+        try:
+            result = RecommendationResult.model_validate_json(reply_text)
+        except Exception as e:
+            raise ValueError(f"Structured recommendation did not match the schema: {e}")
+        return result.recommendation, result.rationale
+
+    def _parse_gpt_reply(self, reply_text: str) -> Tuple[Recommendation, str]:
+        """Parse a GPT reply into a Recommendation and its markdown explanation."""
         # Extract JSON and markdown parts
         json_part, markdown_part = self.extract_json_and_markdown(reply_text)
 
@@ -447,6 +1112,20 @@ class RagAgent:
         model: str = "gemini-2.5-pro-exp-03-25",
         temperature: float = 0.2,
         max_tokens: int = 1500
+    ) -> Tuple[Recommendation, str]:
+        """Synchronous wrapper around aget_gemini_recommendations; must not be called from a running event loop."""
+        return asyncio.run(self.aget_gemini_recommendations(
+            rag_context, rag_summary, user_query, model=model, temperature=temperature, max_tokens=max_tokens
+        ))
+
+    async def aget_gemini_recommendations(
+        self,
+        rag_context: str,
+        rag_summary: str,
+        user_query: str,
+        model: str = "gemini-2.5-pro-exp-03-25",
+        temperature: float = 0.2,
+        max_tokens: int = 1500
     ) -> Tuple[Recommendation, str]:
         """
         Get recommendations using Gemini models.
@@ -462,6 +1141,41 @@ class RagAgent:
             Tuple of (recommendation_object, explanation_markdown)
         """
         print("Generating Gemini Recommendations")
+        if self._use_structured_output("gemini"):
+            try:
+                response = await self._agemini(
+                    **self._gemini_structured_request(rag_context, rag_summary, user_query, model)
+                )
+            except Exception as e:
+                if not self._schema_rejected(e):
+                    raise
+                self._structured_output_failed("gemini", e)
+            else:
+                return self._parse_structured_reply(response.text)
+        full_prompt = self._gemini_prompt(rag_context, rag_summary, user_query)
+
+        try:
+            response = await self._agemini(
+                model=model,
+                contents=f"{full_prompt}",
+            )
+        except Exception as e:
+            raise ValueError(f"API request failed: {e}")
+        return self._parse_gemini_reply(response.text)
+
+    def _gemini_structured_request(self, rag_context: str, rag_summary: str, user_query: str, model: str) -> Dict[str, Any]:
+        """generate_content arguments for a recommendation constrained to RecommendationResult."""
+        return dict(
+            model=model,
+            contents=self._gemini_prompt(rag_context, rag_summary, user_query, structured=True),
+            config=genai_types.GenerateContentConfig(
+                response_mime_type="application/json",
+                response_schema=RecommendationResult,
+            ),
+        )
+
+    def _gemini_prompt(self, rag_context: str, rag_summary: str, user_query: str, structured: bool = False) -> str:
+        """Single-turn prompt for the Gemini recommendation call; `structured` asks for a RecommendationResult reply."""
         system_prompt = (
             "You are an expert water-treatment design assistant. You will receive three inputs:  "
             "1) RAG-retrieved context containing technical excerpts on pumps, filters, RO membranes, "
@@ -473,6 +1187,7 @@ class RagAgent:
             "The website url is : https://www.davisandshirtliff.com/products-and-solutions/"
             "Include products -like chemical dosage, chemicals, airblowers, pumps, water treatment media, filters, and type of ros to use-"
             "depending on the pretreatment and postreatment depending on the RO chosen based on the results from lab report."
+        ) + (STRUCTURED_OUTPUT_INSTRUCTIONS if structured else (
             "**First**, emit ONLY a JSON object matching these Pydantic schemas (no extra keys):\n\n"
             "```python\n"
             "class Product(BaseModel):\n"
@@ -490,51 +1205,54 @@ class RagAgent:
             "Category field is only one of pretreatment, RO, postreatment.\n\n"
             "**Then**, in Markdown, explain your approach under these headings:\n"
             "**RO SELECTED**, **Pretreatment**, **Posttreatment**."
-        )
+        ))
 
         full_prompt = f"{system_prompt}\n\n{rag_context}\n\n{user_query}\n\nBelow are the Water Lab Results:\n{rag_summary}"
         #print(f"Full prompt:\n{full_prompt}")
+        return full_prompt
 
-        # Get response from Gemini
+    def _parse_gemini_reply(self, reply_text: str) -> Tuple[Optional[Recommendation], str]:
+        """Parse a Gemini reply; returns (None, reply_text) when no JSON can be extracted."""
+        # Extract JSON and markdown parts
         try:
-            response = self.gemini_client.models.generate_content(
-                model=model,
-                contents=f"{full_prompt}",
-            )
-            reply_text = response.text
-
-            # Extract JSON and markdown parts
-            try:
-                json_part, markdown_part = self.extract_json_and_markdown(reply_text)
+            json_part, markdown_part = self.extract_json_and_markdown(reply_text)
 
-                # Try to fix common JSON formatting issues
-                json_part = self.fix_json_format(json_part)
+            # Try to fix common JSON formatting issues
+            json_part = self.fix_json_format(json_part)
 
-                try:
-                    # Parse JSON into Pydantic model
-                    recommendation = Recommendation.model_validate_json(json_part)
-                    return recommendation, markdown_part
-                except Exception as e:
-                    # Attempt a more forgiving parse as fallback
-                    data = json.loads(json_part)
-                    recommendation = Recommendation.model_validate(data)
-                    return recommendation, markdown_part
-            except ValueError:
-                # Return the full response as markdown if JSON extraction fails
-                return None, reply_text
+            try:
+                # Parse JSON into Pydantic model
+                recommendation = Recommendation.model_validate_json(json_part)
+                return recommendation, markdown_part
+            except Exception as e:
+                # Attempt a more forgiving parse as fallback
+                data = json.loads(json_part)
+                recommendation = Recommendation.model_validate(data)
+                return recommendation, markdown_part
+        except ValueError:
+            # Return the full response as markdown if JSON extraction fails
+            return None, reply_text
 
-        except Exception as e:
-            raise ValueError(f"API request failed: {e}")
-            
     def json_summarizer(self, json_part : str, gpt_client) -> str:
         print("Getting the Lab results Summary")
         """
         Receives a json file and summarizes it to be fed into the LLM
         """
+        response = gpt_client.chat.completions.create(**self._summarizer_request(json_part))
+        return response.choices[0].message.content
+
+    async def ajson_summarizer(self, json_part: str) -> str:
+        """Async variant of json_summarizer using the agent's GPT client."""
+        print("Getting the Lab results Summary")
+        response = await self._achat(**self._summarizer_request(json_part))
+        return response.choices[0].message.content
+
+    def _summarizer_request(self, json_part: str) -> Dict[str, Any]:
+        """Chat completion arguments for the lab report summary."""
         model_name = "openai/gpt-4.1-mini"
-        system_prompt = "You are a Water treatment analyst. You will receive a JSON format input containing lab test results.Provide a clear, detailed summary interpreting all fields."
+        system_prompt = "You are a Water treatment analyst. You will receive lab test results as JSON or as a parameter|value|unit|guideline|remark table.Provide a clear, detailed summary interpreting all fields."
         system_prompt += "Keep most of the information as possible. Summarize the comments too. Just summarize everything."
-        response = gpt_client.chat.completions.create(
+        return dict(
             messages=[
                 {
                     "role": "system",
@@ -550,43 +1268,92 @@ class RagAgent:
             max_tokens=1500,
             model=model_name
         )
-        return response.choices[0].message.content
 
     def process(
         self,
         user_query: str,
-        lab_report_json: str,
+        lab_report_json: Union[str, Dict[str, Any]],
         model_type: str = "gpt",
         model_name: str = None,
         temperature: float = 0.2,
-        max_tokens: int = 1500
+        max_tokens: int = 1500,
+        query_mode: Optional[str] = None
     ) -> Tuple[Recommendation, str]:
         """
         Process a user query and return water treatment recommendations.
 
+        Synchronous wrapper around aprocess for scripts such as rag_tester.py.
+        Must not be called from a running event loop; use aprocess there.
+
         Args:
             user_query: User's request for treatment design
-            lab_report_json: JSON string containing water lab analysis
+            lab_report_json: Parsed water lab analysis, or its JSON string
             model_type: 'gpt' or 'gemini'
             model_name: Specific model name to use
             temperature: Sampling temperature
             max_tokens: Maximum tokens for response
+            query_mode: 'llm' or 'template' search query; defaults to the agent's query_mode
 
         Returns:
             Tuple of (recommendation_object, explanation_markdown)
         """
-        # Generate search query from lab report
+        return asyncio.run(self.aprocess(
+            user_query=user_query,
+            lab_report_json=lab_report_json,
+            model_type=model_type,
+            model_name=model_name,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            query_mode=query_mode
+        ))
+
+    async def _asearch_query(
+        self,
+        lab_report_json: str,
+        user_query: str,
+        lab_report: Optional[Dict[str, Any]] = None,
+        query_mode: Optional[str] = None
+    ) -> str:
+        """
+        Search query for the lab report, falling back to the user query on failure.
+
+        In 'template' query mode a parsed `lab_report` is turned into a query
+        by query_builder.build_search_query, without an LLM call.
+        """
+        if (query_mode or self.query_mode) == "template" and lab_report is not None:
+            try:
+                search_query = build_search_query(lab_report, user_query, self.query_keywords)
+                print(f"Search Query (template): {search_query}")
+                return search_query
+            except Exception as e:
+                print(f"Error building template search query, using the LLM: {str(e)}")
         try:
-            search_query = self.generate_search_query(lab_report_json, user_query)
+            search_query = await self.agenerate_search_query(lab_report_json, user_query)
             print(f"Search Query: {search_query}")
         except Exception as e:
             print(f"Error generating search query: {str(e)}")
             search_query = f"{user_query} water treatment system design"
             print(f"Using fallback search query: {search_query}")
+        return search_query
+
+    async def _aretrieve(
+        self,
+        lab_report_json: str,
+        user_query: str,
+        lab_report: Optional[Dict[str, Any]] = None,
+        query_mode: Optional[str] = None
+    ) -> str:
+        """Search query generation followed by context retrieval, with fallbacks."""
+        # Generate search query from lab report
+        search_query = await self._asearch_query(lab_report_json, user_query, lab_report, query_mode)
 
         # Build context from vector DB
+        return await self._achecked_context(self.abuild_context(search_query))
+
+    async def _achecked_context(self, context_coro) -> str:
+        """Await a context build, substituting a fallback context when it fails or comes back empty."""
         try:
-            rag_context = self.build_context(search_query)
+            rag_context = await context_coro
             #print(rag_context)
             if not rag_context or len(rag_context.strip()) < 100:
                 print("WARNING: RAG context is empty or very small!")
@@ -605,59 +1372,464 @@ class RagAgent:
     Please design a water treatment system based on the lab report and user query directly.
     """
             print("Using fallback context due to error")
+        return rag_context
+
+    async def _asummarize(self, lab_report_json: str, lab_report: Optional[Dict[str, Any]] = None) -> str:
+        """
+        Lab report summary, falling back to the raw JSON on failure.
 
-        # Lab Summary
+        In 'rules' summary mode a parsed `lab_report` is summarized locally
+        with lab_summary.summarize_lab_report instead of calling the LLM.
+        """
+        if self.summary_mode == "rules" and lab_report is not None:
+            try:
+                rag_summary = summarize_lab_report(lab_report)
+                print(f"RAG Summary length: {len(rag_summary)} (rule-based)")
+                return rag_summary
+            except Exception as e:
+                print(f"Error in rule-based lab summary, using the LLM: {str(e)}")
         try:
-            rag_summary = self.json_summarizer(lab_report_json, self.gpt_client)
+            rag_summary = await self.ajson_summarizer(lab_report_json)
             #print(rag_summary)
             print(f"RAG Summary length: {len(rag_summary)}")
         except Exception as e:
             print(f"Error generating lab summary: {str(e)}")
-            rag_summary = f"Lab report summary generation failed. Using raw JSON: {lab_report_json[:500]}..."
+            rag_summary = f"Lab report summary generation failed. Using raw report: {lab_report_json[:500]}..."
+        return rag_summary
+
+    async def aprocess(
+        self,
+        user_query: str,
+        lab_report_json: Union[str, Dict[str, Any]],
+        model_type: str = "gpt",
+        model_name: str = None,
+        temperature: float = 0.2,
+        max_tokens: int = 1500,
+        query_mode: Optional[str] = None
+    ) -> Tuple[Recommendation, str]:
+        """
+        Async version of process.
+
+        The lab summary does not depend on retrieval, so it runs concurrently
+        with the search query -> embedding -> FAISS search chain; both are
+        joined before the final recommendation call.
+
+        Args:
+            user_query: User's request for treatment design
+            lab_report_json: Parsed water lab analysis, or its JSON string
+            model_type: 'gpt' or 'gemini'
+            model_name: Specific model name to use
+            temperature: Sampling temperature
+            max_tokens: Maximum tokens for response
+            query_mode: 'llm' or 'template' search query; defaults to the agent's query_mode
+
+        Returns:
+            Tuple of (recommendation_object, explanation_markdown)
+        """
+        if model_type.lower() not in ("gpt", "gemini"):
+            raise ValueError(f"Unsupported model type: {model_type}. Use 'gpt' or 'gemini'.")
+        query_mode = self._checked_query_mode(query_mode or self.query_mode)
+        lab_report = self._parsed_lab_report(lab_report_json)
+        lab_report_json = self.prepare_lab_report(lab_report if lab_report is not None else lab_report_json)
+
+        rag_context, rag_summary = await asyncio.gather(
+            self._aretrieve(lab_report_json, user_query, lab_report, query_mode),
+            self._asummarize(lab_report_json, lab_report)
+        )
+
+        return await self._arecommend(
+            rag_context, rag_summary, user_query, model_type, model_name, temperature, max_tokens
+        )
 
-        # Select model and get recommendations
-        if model_type.lower() == "gpt":
-            model = model_name or "openai/gpt-4.1"
+    async def _arecommend(
+        self,
+        rag_context: str,
+        rag_summary: str,
+        user_query: str,
+        model_type: str,
+        model_name: Optional[str],
+        temperature: float,
+        max_tokens: int,
+        semaphore: Optional[asyncio.Semaphore] = None
+    ) -> Tuple[Recommendation, str]:
+        """
+        Final recommendation call, with an error placeholder on failure.
+
+        Runs through the agent's LLMCaller: each request has a timeout and
+        the call a deadline, failed requests are retried with jittered
+        backoff, and the provider's backup route (backup_models) takes over
+        when the primary fails or, with hedging, is slower than usual.
+        With `semaphore`, every request - retries, backup and hedge
+        included - holds a slot only while it is out.
+        """
+        provider = model_type.lower()
+
+        async def request(route_provider: str, model: str):
+            get = self.aget_gpt_recommendations if route_provider == "gpt" else self.aget_gemini_recommendations
+            if semaphore is None:
+                return await get(rag_context, rag_summary, user_query, model=model, temperature=temperature, max_tokens=max_tokens)
+            async with semaphore:
+                return await get(rag_context, rag_summary, user_query, model=model, temperature=temperature, max_tokens=max_tokens)
+
+        primary, backup = self._recommendation_routes(provider, model_name, request)
+        try:
+            return await self.llm_caller.first_valid(primary, backup, validate=self._check_recommendation)
+        except InvalidAnswer as e:
+            return self._unparsed_reply(e.result[1])
+        except Exception as e:
+            print(f"Error getting {provider} recommendations: {str(e)}")
+            # Return a minimal recommendation with error
+            return self._error_recommendation(), f"Error processing request: {str(e)}"
+
+    def _recommendation_routes(
+        self,
+        provider: str,
+        model_name: Optional[str],
+        request: Callable[[str, str], Any]
+    ) -> Tuple[Route, Optional[Route]]:
+        """
+        The primary route for `provider` and its backup from backup_models,
+        if the backup provider has a client. `request(provider, model)`
+        makes one request on a route.
+        """
+        model = model_name or DEFAULT_MODELS[provider]
+        primary = Route(provider, f"{provider}:{model}", lambda: request(provider, model))
+        backup = None
+        if provider in self.backup_models:
+            backup_provider, backup_model = self.backup_models[provider]
+            if self._has_client(backup_provider):
+                backup = Route(
+                    backup_provider, f"{backup_provider}:{backup_model}", lambda: request(backup_provider, backup_model)
+                )
+        return primary, backup
+
+    def _has_client(self, provider: str) -> bool:
+        if provider == "gpt":
+            return self.gpt_client is not None or self.async_gpt_client is not None
+        return provider == "gemini" and self.gemini_client is not None
+
+    @staticmethod
+    def _check_recommendation(result: Tuple[Optional[Recommendation], str]):
+        if result[0] is None:
+            raise InvalidAnswer("Reply contained no recommendation JSON", result)
+
+    async def astream(
+        self,
+        user_query: str,
+        lab_report_json: Union[str, Dict[str, Any]],
+        model_type: str = "gpt",
+        model_name: str = None,
+        temperature: float = 0.2,
+        max_tokens: int = 1500,
+        query_mode: Optional[str] = None
+    ) -> AsyncIterator[Tuple[str, Dict[str, Any]]]:
+        """
+        Streaming version of aprocess.
+
+        Runs the same stages as aprocess and yields `(event, data)` pairs as
+        the work progresses:
+
+        - ("summary", {"summary"}) when the lab summary is ready
+        - ("context", {"chars", "tokens", "store_version"}) when retrieval is done
+        - ("token", {"text"}) for every chunk of the model reply
+        - ("recommendation", {"recommendation", "rationale"}) once the reply is parsed
+
+        Summary and retrieval still run concurrently; whichever finishes first
+        is reported first. `query_mode` is as for aprocess.
+
+        The reply streams through the agent's LLMCaller: opening the stream
+        and each chunk have the policy's attempt timeout, the whole reply its
+        deadline, and failures count against the provider's breaker. Until
+        the first token the request is retried and then handed to the
+        backup route; after that a failure ends the stream with the error
+        placeholder. With structured output the tokens are the JSON reply.
+        """
+        model_type = model_type.lower()
+        if model_type not in ("gpt", "gemini"):
+            raise ValueError(f"Unsupported model type: {model_type}. Use 'gpt' or 'gemini'.")
+        query_mode = self._checked_query_mode(query_mode or self.query_mode)
+        lab_report = self._parsed_lab_report(lab_report_json)
+        lab_report_json = self.prepare_lab_report(lab_report if lab_report is not None else lab_report_json)
+
+        retrieve = asyncio.create_task(self._aretrieve(lab_report_json, user_query, lab_report, query_mode))
+        summarize = asyncio.create_task(self._asummarize(lab_report_json, lab_report))
+        try:
+            pending = {retrieve, summarize}
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                if summarize in done:
+                    yield "summary", {"summary": summarize.result()}
+                if retrieve in done:
+                    rag_context = retrieve.result()
+                    yield "context", {
+                        "chars": len(rag_context),
+                        "tokens": self.count_tokens(rag_context),
+                        "store_version": self.store_version,
+                    }
+        finally:
+            # The client went away before both stages finished
+            for task in (retrieve, summarize):
+                task.cancel()
+        rag_context, rag_summary = retrieve.result(), summarize.result()
+
+        parts = []
+        # Provider and mode of the request that produced the tokens
+        reply: Dict[str, Any] = {}
+
+        def request(provider: str, model: str):
+            return self._astream_recommendation(
+                provider, model, rag_context, rag_summary, user_query, temperature, max_tokens, reply
+            )
+
+        try:
+            primary, backup = self._recommendation_routes(model_type, model_name, request)
+            async for text in self.llm_caller.stream(primary, backup):
+                parts.append(text)
+                yield "token", {"text": text}
+
+            reply_text = "".join(parts).strip()
+            if reply["structured"]:
+                recommendation, rationale = self._parse_structured_reply(reply_text)
+            elif reply["provider"] == "gpt":
+                recommendation, rationale = self._parse_gpt_reply(reply_text)
+            else:
+                recommendation, rationale = self._parse_gemini_reply(reply_text)
+                if recommendation is None:
+                    recommendation, rationale = self._unparsed_reply(reply_text)
+        except Exception as e:
+            print(f"Error getting {model_type} recommendations: {str(e)}")
+            recommendation, rationale = self._error_recommendation(), f"Error processing request: {str(e)}"
+        yield "recommendation", {"recommendation": recommendation, "rationale": rationale}
+
+    async def _astream_recommendation(
+        self,
+        provider: str,
+        model: str,
+        rag_context: str,
+        rag_summary: str,
+        user_query: str,
+        temperature: float,
+        max_tokens: int,
+        reply: Dict[str, Any]
+    ) -> AsyncIterator[str]:
+        """
+        Stream one recommendation request's reply text.
+
+        Uses structured output like aget_*_recommendations, falling back to
+        text mode when the API rejects the schema. Once the stream is open,
+        `reply` records its provider and whether it is structured, so the
+        caller knows how to parse the text.
+        """
+        print(f"Streaming {provider} recommendations")
+        structured = self._use_structured_output(provider)
+        if structured:
             try:
-                return self.get_gpt_recommendations(
-                    rag_context,
-                    rag_summary,
-                    user_query,
-                    model=model,
-                    temperature=temperature,
-                    max_tokens=max_tokens
+                chunks = await self._aopen_recommendation_stream(
+                    provider, model, rag_context, rag_summary, user_query, temperature, max_tokens, structured=True
                 )
             except Exception as e:
-                print(f"Error getting GPT recommendations: {str(e)}")
-                # Return a minimal recommendation with error
-                fallback_rec = Recommendation(
-                    pretreatment=[Product(product_description="Error in processing", product_name="Error", model_number="N/A")],
-                    RO=[Product(product_description="Error in processing", product_name="Error", model_number="N/A")],
-                    postreatment=[Product(product_description="Error in processing", product_name="Error", model_number="N/A")]
-                )
-                return fallback_rec, f"Error processing request: {str(e)}"
-        elif model_type.lower() == "gemini":
-            model = model_name or "gemini-2.5-pro-exp-03-25"
-            try:
-                return self.get_gemini_recommendations(
-                    rag_context,
-                    rag_summary,
-                    user_query,
+                if not self._schema_rejected(e):
+                    raise
+                self._structured_output_failed(provider, e)
+                structured = False
+        if not structured:
+            chunks = await self._aopen_recommendation_stream(
+                provider, model, rag_context, rag_summary, user_query, temperature, max_tokens, structured=False
+            )
+        reply.update(provider=provider, structured=structured)
+        async for text in chunks:
+            yield text
+
+    async def _aopen_recommendation_stream(
+        self,
+        provider: str,
+        model: str,
+        rag_context: str,
+        rag_summary: str,
+        user_query: str,
+        temperature: float,
+        max_tokens: int,
+        structured: bool
+    ) -> AsyncIterator[str]:
+        """Open the streamed recommendation request on `provider`; the same requests as aget_*_recommendations."""
+        if provider == "gpt":
+            if structured:
+                request = self._gpt_structured_request(rag_context, rag_summary, user_query, model, temperature, max_tokens)
+            else:
+                request = dict(
                     model=model,
+                    messages=self._gpt_recommendation_messages(rag_context, rag_summary, user_query),
                     temperature=temperature,
                     max_tokens=max_tokens
                 )
-            except Exception as e:
-                print(f"Error getting Gemini recommendations: {str(e)}")
-                # Return a minimal recommendation with error
-                fallback_rec = Recommendation(
-                    pretreatment=[Product(product_description="Error in processing", product_name="Error", model_number="N/A")],
-                    RO=[Product(product_description="Error in processing", product_name="Error", model_number="N/A")],
-                    postreatment=[Product(product_description="Error in processing", product_name="Error", model_number="N/A")]
-                )
-                return fallback_rec, f"Error processing request: {str(e)}"
+            return await self._astream_chat(**request)
+        if structured:
+            request = self._gemini_structured_request(rag_context, rag_summary, user_query, model)
         else:
+            request = dict(model=model, contents=self._gemini_prompt(rag_context, rag_summary, user_query))
+        return await self._astream_gemini(**request)
+
+    async def abatch_process(
+        self,
+        lab_reports: Union[Dict[str, Union[str, Dict[str, Any]]], AsyncIterator[Tuple[str, Union[str, Dict[str, Any]]]]],
+        user_query: str,
+        model_type: str = "gpt",
+        model_name: str = None,
+        temperature: float = 0.2,
+        max_tokens: int = 1500,
+        llm_concurrency: int = 4,
+        query_mode: Optional[str] = None
+    ) -> AsyncIterator[Tuple[str, Recommendation, str]]:
+        """
+        Run aprocess for many lab reports, yielding each result as it finishes.
+
+        `lab_reports` may be an async iterator of (key, report) pairs, such
+        as reports coming off the PDF pool; each report starts as soon as
+        it arrives, so parsing overlaps with the LLM calls of earlier ones.
+
+        Work is shared across the batch where possible: search queries that
+        are ready while an embeddings request is in flight are embedded
+        together in the next one (identical queries once), and every LLM
+        request - search query, summary and each recommendation request,
+        backup and hedge requests included - waits on one semaphore so at
+        most `llm_concurrency` are in flight for the whole batch.
+
+        Args:
+            lab_reports: Report key -> parsed lab report or its JSON string, or an
+                async iterator of (key, report) pairs
+            user_query: User's request for treatment design, shared by all reports
+            model_type: 'gpt' or 'gemini'
+            model_name: Specific model name to use
+            temperature: Sampling temperature
+            max_tokens: Maximum tokens for response
+            llm_concurrency: Maximum concurrent LLM calls
+            query_mode: 'llm' or 'template' search queries; defaults to the agent's query_mode
+
+        Yields:
+            Tuples of (report_key, recommendation_object, explanation_markdown)
+            in completion order
+        """
+        if model_type.lower() not in ("gpt", "gemini"):
             raise ValueError(f"Unsupported model type: {model_type}. Use 'gpt' or 'gemini'.")
+        query_mode = self._checked_query_mode(query_mode or self.query_mode)
+        semaphore = asyncio.Semaphore(max(1, llm_concurrency))
+
+        async def limited(coro):
+            async with semaphore:
+                return await coro
+
+        # Queries waiting for the next embeddings request, and the task sending them
+        pending_embeddings: Dict[str, asyncio.Future] = {}
+        embedder: Optional[asyncio.Task] = None
+
+        async def flush_embeddings():
+            while pending_embeddings:
+                batch = dict(pending_embeddings)
+                pending_embeddings.clear()
+                try:
+                    embeddings = await self.aget_embeddings(list(batch))
+                except Exception as e:
+                    print(f"Error generating embedding: {str(e)}")
+                    embeddings = [self._fallback_embedding() for _ in batch]
+                for future, embedding in zip(batch.values(), embeddings):
+                    if not future.done():
+                        future.set_result(embedding)
+
+        async def embed(queries: List[str]) -> List[List[float]]:
+            nonlocal embedder
+            loop = asyncio.get_running_loop()
+            futures = [pending_embeddings.setdefault(q, loop.create_future()) for q in queries]
+            if embedder is None or embedder.done():
+                embedder = asyncio.create_task(flush_embeddings())
+            return list(await asyncio.gather(*futures))
+
+        async def run(key: str, report: Union[str, Dict[str, Any]]) -> Tuple[str, Recommendation, str]:
+            summary = None
+            try:
+                parsed_report = self._parsed_lab_report(report)
+                lab_report_json = self.prepare_lab_report(parsed_report if parsed_report is not None else report)
+                summary = asyncio.create_task(limited(self._asummarize(lab_report_json, parsed_report)))
+                search_query = await limited(self._asearch_query(lab_report_json, user_query, parsed_report, query_mode))
+                queries = self.search_queries(search_query)
+                embeddings = await embed(queries)
+                rag_context = await self._achecked_context(asyncio.to_thread(
+                    self.build_context_from_embeddings, embeddings, search_query
+                ))
+                # Slots are taken per request, so a backup or hedge request counts too
+                recommendation, rationale = await self._arecommend(
+                    rag_context, await summary, user_query, model_type, model_name, temperature, max_tokens,
+                    semaphore=semaphore
+                )
+            except Exception as e:
+                print(f"Error processing report {key}: {str(e)}")
+                recommendation, rationale = self._error_recommendation(), f"Error processing request: {str(e)}"
+            finally:
+                if summary is not None:
+                    summary.cancel()
+            return key, recommendation, rationale
+
+        if isinstance(lab_reports, dict):
+            reports = lab_reports
+
+            async def iterate():
+                for item in reports.items():
+                    yield item
+
+            lab_reports = iterate()
+
+        finished: asyncio.Queue = asyncio.Queue()
+        tasks: List[asyncio.Task] = []
+
+        async def feed():
+            async for key, report in lab_reports:
+                task = asyncio.create_task(run(key, report))
+                task.add_done_callback(finished.put_nowait)
+                tasks.append(task)
+
+        feeder = asyncio.create_task(feed())
+        feeder.add_done_callback(finished.put_nowait)
+        try:
+            feeding, done = True, 0
+            while feeding or done < len(tasks):
+                task = await finished.get()
+                if task is feeder:
+                    # Surfaces an error raised by the report source
+                    task.result()
+                    feeding = False
+                    continue
+                done += 1
+                yield task.result()
+        finally:
+            # The caller stopped early, e.g. the client disconnected
+            for task in [feeder] + tasks:
+                task.cancel()
+            if embedder is not None:
+                embedder.cancel()
+
+    def _unparsed_reply(self, reply_text: str) -> Tuple[Recommendation, str]:
+        """Result for a reply without recommendation JSON: the error placeholder, with the reply as the rationale."""
+        return self._error_recommendation(), reply_text
+
+    def _error_recommendation(self) -> Recommendation:
+        """Placeholder recommendation returned when the LLM call fails."""
+        def error_product(category: str) -> Product:
+            return Product(product_description="Error in processing", product_name="Error", model_number="N/A", category=category)
+
+        return Recommendation(
+            pretreatment=[error_product("pretreatment")],
+            RO=[error_product("RO")],
+            postreatment=[error_product("postreatment")]
+        )
+
+
+async def _single_chunk(text: str) -> AsyncIterator[str]:
+    """A whole reply as a one-chunk stream."""
+    yield text
+
+
+def serialize_lab_report(water_data: Dict[str, Any]) -> str:
+    """Compact JSON for a parsed lab report, as sent to the LLM (no indentation or escaped non-ASCII)."""
+    return json.dumps(water_data, separators=(',', ':'), ensure_ascii=False)
 
 
 # Helper function to load lab report from file
@@ -666,7 +1838,7 @@ def load_lab_report(file_path: str) -> str:
     try:
         with open(file_path, 'r') as f:
             water_data = json.load(f)
-        return json.dumps(water_data, indent=2)
+        return serialize_lab_report(water_data)
     except FileNotFoundError:
         raise FileNotFoundError(f"Water analysis file not found: {file_path}")
     except json.JSONDecodeError:
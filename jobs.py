@@ -0,0 +1,235 @@
+import os
+import json
+import uuid
+import asyncio
+import logging
+from datetime import datetime
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional
+
+from database import SessionLocal
+from models import Job
+
+logger = logging.getLogger("jobs")
+
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+TERMINAL_STATES = (SUCCEEDED, FAILED)
+
+
+def job_to_dict(job: Job, include_path: bool = False) -> Dict[str, Any]:
+    """Public view of a job row; `include_path` adds the stored upload path for workers."""
+    data = {
+        "job_id": job.id,
+        "status": job.status,
+        "query": job.query,
+        "report_name": job.report_name,
+        "result": json.loads(job.result) if job.result else None,
+        "error": job.error,
+        "attempts": job.attempts,
+        "created_at": job.created_at.isoformat() if job.created_at else None,
+        "started_at": job.started_at.isoformat() if job.started_at else None,
+        "finished_at": job.finished_at.isoformat() if job.finished_at else None,
+    }
+    if include_path:
+        data["report_path"] = job.report_path
+    return data
+
+
+class JobQueue:
+    """
+    SQLite-backed job queue drained by a pool of asyncio workers.
+
+    Jobs are persisted in the `jobs` table before they are queued, so a
+    restart picks up everything that was queued or still running. Workers
+    call `run_job` with the job's dict (including `report_path`) and store
+    the returned result; the uploaded report is deleted once the job ends.
+    On shutdown, workers stop taking new jobs and in-flight jobs are given
+    `drain_timeout` seconds to finish; anything cut off stays in the table
+    and is retried on the next start, up to `max_attempts` starts in all.
+    """
+
+    def __init__(
+        self,
+        run_job: Callable[[Dict[str, Any]], Awaitable[Dict[str, Any]]],
+        concurrency: int = 2,
+        drain_timeout: float = 60.0,
+        max_attempts: int = 3,
+        session_factory=SessionLocal
+    ):
+        """
+        Initialize the queue.
+
+        Args:
+            run_job: Coroutine function executing one job and returning its JSON-serialisable result
+            concurrency: Number of jobs run at the same time
+            drain_timeout: Seconds in-flight jobs get to finish on shutdown
+            max_attempts: Times a job may be started; a job cut off that often is marked failed
+            session_factory: SQLAlchemy session factory
+        """
+        self.run_job = run_job
+        self.concurrency = max(1, concurrency)
+        self.drain_timeout = drain_timeout
+        self.max_attempts = max(1, max_attempts)
+        self.session_factory = session_factory
+        self._queue: "asyncio.Queue[Optional[str]]" = asyncio.Queue()
+        self._workers: List[asyncio.Task] = []
+        self._listeners: Dict[str, List[asyncio.Queue]] = {}
+        self._stopping = False
+
+    # Database helpers; these run in a worker thread
+
+    def _insert(self, job: Job) -> Dict[str, Any]:
+        with self.session_factory() as session:
+            session.add(job)
+            session.commit()
+            return job_to_dict(job)
+
+    def _update(self, job_id: str, **fields) -> Optional[Dict[str, Any]]:
+        with self.session_factory() as session:
+            job = session.get(Job, job_id)
+            if job is None:
+                return None
+            for key, value in fields.items():
+                setattr(job, key, value)
+            session.commit()
+            return job_to_dict(job)
+
+    def _load(self, job_id: str, include_path: bool = False) -> Optional[Dict[str, Any]]:
+        with self.session_factory() as session:
+            job = session.get(Job, job_id)
+            return job_to_dict(job, include_path) if job is not None else None
+
+    def _requeue_unfinished(self) -> List[str]:
+        """Reset jobs left queued or running by a previous process; returns their ids, oldest first."""
+        with self.session_factory() as session:
+            jobs = (
+                session.query(Job)
+                .filter(Job.status.in_([QUEUED, RUNNING]))
+                .order_by(Job.created_at)
+                .all()
+            )
+            for job in jobs:
+                job.status = QUEUED
+                job.started_at = None
+            session.commit()
+            return [job.id for job in jobs]
+
+    # Public API
+
+    async def start(self):
+        """Requeue unfinished jobs and start the workers."""
+        self._stopping = False
+        for job_id in await asyncio.to_thread(self._requeue_unfinished):
+            self._queue.put_nowait(job_id)
+        if self._queue.qsize():
+            logger.info(f"Requeued {self._queue.qsize()} unfinished jobs")
+        self._workers = [asyncio.create_task(self._worker(n)) for n in range(self.concurrency)]
+
+    async def stop(self):
+        """Stop taking jobs and let in-flight ones finish, up to drain_timeout."""
+        self._stopping = True
+        for _ in self._workers:
+            # Wake idle workers; busy ones see _stopping when their job ends
+            self._queue.put_nowait(None)
+        if not self._workers:
+            return
+        done, pending = await asyncio.wait(self._workers, timeout=self.drain_timeout)
+        for task in pending:
+            task.cancel()
+        if pending:
+            logger.warning(f"{len(pending)} jobs did not finish in {self.drain_timeout}s; they will be retried on restart")
+            await asyncio.gather(*pending, return_exceptions=True)
+        self._workers = []
+
+    async def submit(self, query: str, report_path: str, report_name: str) -> Dict[str, Any]:
+        """Persist a new job and queue it. Returns the job's public dict."""
+        if self._stopping:
+            raise RuntimeError("Job queue is shutting down")
+        job = Job(
+            id=uuid.uuid4().hex,
+            status=QUEUED,
+            query=query,
+            report_name=report_name,
+            report_path=report_path,
+            attempts=0,
+            created_at=datetime.utcnow(),
+        )
+        data = await asyncio.to_thread(self._insert, job)
+        self._queue.put_nowait(job.id)
+        return data
+
+    async def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """Current state of a job, or None if unknown."""
+        return await asyncio.to_thread(self._load, job_id)
+
+    async def events(self, job_id: str) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Yield the job's state now and after every change, until it finishes.
+
+        Yields nothing for an unknown job.
+        """
+        listener: asyncio.Queue = asyncio.Queue()
+        # Subscribe before reading, so no change between the two is missed
+        self._listeners.setdefault(job_id, []).append(listener)
+        try:
+            data = await self.get(job_id)
+            while data is not None:
+                yield data
+                if data["status"] in TERMINAL_STATES:
+                    break
+                data = await listener.get()
+        finally:
+            listeners = self._listeners.get(job_id, [])
+            if listener in listeners:
+                listeners.remove(listener)
+            if not listeners:
+                self._listeners.pop(job_id, None)
+
+    def _publish(self, data: Optional[Dict[str, Any]]):
+        if data is None:
+            return
+        for listener in self._listeners.get(data["job_id"], []):
+            listener.put_nowait(data)
+
+    async def _worker(self, n: int):
+        while True:
+            job_id = await self._queue.get()
+            if job_id is None or self._stopping:
+                # Jobs not started yet stay queued in the table for the next start
+                return
+            job = await asyncio.to_thread(self._load, job_id, True)
+            if job is None or job["status"] != QUEUED:
+                continue
+            if job["attempts"] >= self.max_attempts:
+                # Cut off by shutdown on every start so far, e.g. a report that hangs the pool
+                logger.error(f"Job {job_id} gave up after {job['attempts']} attempts")
+                self._publish(await asyncio.to_thread(
+                    self._update, job_id, status=FAILED, finished_at=datetime.utcnow(),
+                    error=f"Job did not finish after {job['attempts']} attempts"
+                ))
+                self._remove_report(job)
+                continue
+            self._publish(await asyncio.to_thread(
+                self._update, job_id, status=RUNNING, started_at=datetime.utcnow(), attempts=job["attempts"] + 1
+            ))
+            logger.info(f"Worker {n} running job {job_id}")
+            try:
+                result = await self.run_job(job)
+                fields = {"status": SUCCEEDED, "result": json.dumps(result), "error": None}
+            except asyncio.CancelledError:
+                # Shutdown cut the job off; it stays running and is requeued on restart
+                raise
+            except Exception as e:
+                logger.error(f"Job {job_id} failed: {e}")
+                fields = {"status": FAILED, "error": str(e)}
+            self._publish(await asyncio.to_thread(
+                self._update, job_id, finished_at=datetime.utcnow(), **fields
+            ))
+            self._remove_report(job)
+
+    @staticmethod
+    def _remove_report(job: Dict[str, Any]):
+        if job["report_path"] and os.path.exists(job["report_path"]):
+            os.remove(job["report_path"])
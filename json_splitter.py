@@ -0,0 +1,198 @@
+import re
+import json
+from typing import List, NamedTuple, Optional, Tuple
+
+# Characters the scanner has to look at; everything between them is skipped
+_SPECIAL_RE = re.compile(r'```|[{}"\\\n]')
+_IDENTIFIER_RE = re.compile(r'[A-Za-z_][A-Za-z0-9_]*')
+
+
+class JsonSpan(NamedTuple):
+    """A balanced {...} found in model output."""
+    start: int  # Offset of the opening brace
+    end: int  # Offset just past the closing brace
+    fence: Optional[Tuple[int, int]]  # (start, end) of the enclosing ``` block, fences included
+
+
+def _at_line_start(text: str, pos: int) -> bool:
+    """True if only spaces or tabs sit between the previous newline (or the start) and `pos`."""
+    i = pos - 1
+    while i >= 0 and text[i] in " \t":
+        i -= 1
+    return i < 0 or text[i] == "\n"
+
+
+def scan_json_objects(text: str) -> List[JsonSpan]:
+    """
+    Find every top-level balanced {...} in `text` in one linear pass.
+
+    Braces inside JSON strings (with backslash escapes) do not count, and
+    ``` fences outside objects are tracked so each span knows whether it
+    sits in a fenced block. Only double quotes open strings, and only
+    inside an object, so apostrophes and quotes in the surrounding prose
+    are ignored.
+
+    Stray characters in the prose do not hide the objects after them: a
+    { that never closes is treated as text, so the objects inside it count
+    as top-level; a raw newline ends a string, since JSON strings cannot
+    hold one; and a ``` at the start of a line is always a fence, which
+    drops any object left open before it.
+    """
+    closed: List[Tuple[int, int, int, Optional[int]]] = []  # (start, end, parent opener, fence)
+    openers: List[int] = []  # offset of every {, in order
+    matched: List[bool] = []  # whether openers[i] was closed
+    stack: List[int] = []  # indices of the currently open openers
+    fences: List[List[int]] = []  # [start, end] of each ``` block
+    fence: Optional[int] = None  # index of the open fence
+    in_string = False
+    skip_to = 0
+
+    for match in _SPECIAL_RE.finditer(text):
+        pos = match.start()
+        if pos < skip_to:
+            continue
+        token = match.group()
+        if token == "\n":
+            in_string = False
+        elif in_string:
+            if token == "\\" and text[pos + 1:pos + 2] != "\n":
+                skip_to = pos + 2
+            elif token == '"':
+                in_string = False
+        elif token == '"':
+            in_string = bool(stack)
+        elif token == "{":
+            stack.append(len(openers))
+            openers.append(pos)
+            matched.append(False)
+        elif token == "}":
+            if stack:
+                opener = stack.pop()
+                matched[opener] = True
+                parent = stack[-1] if stack else -1
+                closed.append((openers[opener], pos + 1, parent, fence))
+        elif token == "```" and (not stack or _at_line_start(text, pos)):
+            # ``` outside any object, or starting a line: a fence
+            stack = []
+            if fence is None:
+                fence = len(fences)
+                fences.append([pos, len(text)])
+            else:
+                fences[fence][1] = match.end()
+                fence = None
+    # A span is top-level when it has no enclosing { that was closed
+    return [
+        JsonSpan(start, end, None if span_fence is None else tuple(fences[span_fence]))
+        for start, end, parent, span_fence in closed
+        if parent < 0 or not matched[parent]
+    ]
+
+
+def _parses(text: str) -> bool:
+    try:
+        return isinstance(json.loads(text), dict)
+    except ValueError:
+        return False
+
+
+def find_json_object(text: str) -> Optional[JsonSpan]:
+    """
+    The span of the JSON object in model output, or None.
+
+    Objects in ``` fences are preferred, then objects that parse as JSON;
+    when none parse, the first balanced object is returned so it can be
+    repaired.
+    """
+    spans = scan_json_objects(text)
+    if not spans:
+        return None
+    ordered = sorted(spans, key=lambda span: span.fence is None)  # stable: fenced first, in order
+    for span in ordered:
+        if _parses(text[span.start:span.end]):
+            return span
+    return ordered[0]
+
+
+def split_json_and_markdown(text: str) -> Tuple[str, str]:
+    """
+    Split model output into its JSON object and the surrounding Markdown.
+
+    The Markdown is the text before and after the object; for a fenced
+    object the whole fenced block is cut out.
+
+    Raises:
+        ValueError: If the text contains no {...} object
+    """
+    span = find_json_object(text)
+    if span is None:
+        raise ValueError("Could not extract JSON and markdown from the response")
+    cut_start, cut_end = span.fence or (span.start, span.end)
+    before, after = text[:cut_start].strip(), text[cut_end:].strip()
+    markdown = "\n\n".join(part for part in (before, after) if part)
+    return text[span.start:span.end].strip(), markdown
+
+
+def repair_json(text: str) -> str:
+    """
+    Fix common model JSON mistakes without touching the content of strings.
+
+    Valid JSON is returned unchanged. Otherwise, in one pass outside
+    double-quoted strings: single-quoted strings become double-quoted,
+    bare identifier keys are quoted and trailing commas before } or ] are
+    dropped.
+    """
+    if _parses(text):
+        return text
+    out: List[str] = []
+    i, n = 0, len(text)
+    last = ""  # last significant character written outside strings
+    while i < n:
+        ch = text[i]
+        if ch == '"':
+            j = i + 1
+            while j < n and text[j] != '"':
+                j += 2 if text[j] == "\\" else 1
+            out.append(text[i:j + 1])
+            last = '"'
+            i = j + 1
+        elif ch == "'" and last in "{[,:":
+            j = i + 1
+            chars = []
+            while j < n and text[j] != "'":
+                if text[j] == "\\" and j + 1 < n:
+                    chars.append(text[j + 1] if text[j + 1] == "'" else text[j:j + 2])
+                    j += 2
+                    continue
+                chars.append('\\"' if text[j] == '"' else text[j])
+                j += 1
+            out.append('"' + "".join(chars) + '"')
+            last = '"'
+            i = j + 1
+        elif ch == ",":
+            j = i + 1
+            while j < n and text[j].isspace():
+                j += 1
+            if j < n and text[j] in "}]":
+                i += 1  # trailing comma
+                continue
+            out.append(ch)
+            last = ch
+            i += 1
+        elif last in "{," and (ch.isalpha() or ch == "_"):
+            match = _IDENTIFIER_RE.match(text, i)
+            j = match.end()
+            k = j
+            while k < n and text[k].isspace():
+                k += 1
+            if k < n and text[k] == ":":
+                out.append(f'"{match.group()}"')
+            else:
+                out.append(match.group())
+            last = '"'
+            i = j
+        else:
+            out.append(ch)
+            if not ch.isspace():
+                last = ch
+            i += 1
+    return "".join(out)
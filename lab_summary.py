@@ -0,0 +1,212 @@
+import re
+from typing import Any, Dict, List, Optional, Tuple
+
+# Values at or above this share of their limit are called out as near the limit
+NEAR_LIMIT_RATIO = 0.8
+
+_NUMBER_RE = re.compile(r"\d+(?:\.\d+)?")
+_RANGE_RE = re.compile(r"(\d+(?:\.\d+)?)\s*[-–]\s*(\d+(?:\.\d+)?)")
+# "˂" (U+02C2) shows up in the lab PDFs in place of "<"
+_MAX_RE = re.compile(r"^[<˂≤]\s*=?\s*(\d+(?:\.\d+)?)")
+_NIL_VALUES = ("nil", "absent", "0")
+# Results the lab reports as not detected
+_NOT_DETECTED_VALUES = ("nil", "absent", "nd", "n.d.", "not detected", "bdl")
+
+
+def parse_number(text: Any) -> Optional[float]:
+    """First number in a cell such as "0.73" or "5.1 NTU"; None for "ND", "NS" and blanks."""
+    match = _NUMBER_RE.search(str(text or ""))
+    return float(match.group()) if match else None
+
+
+def parse_value(text: Any) -> Tuple[Optional[float], bool]:
+    """
+    Parse a result cell.
+
+    Returns:
+        (number, below_detection): (0.01, True) for "<0.01" - the value is at
+        most 0.01 -, (0.0, True) for "ND" or "Nil", (5.1, False) for "5.1 NTU"
+        and (None, False) when there is no number
+    """
+    text = " ".join(str(text or "").split()).lower()
+    if text in _NOT_DETECTED_VALUES:
+        return 0.0, True
+    match = _MAX_RE.match(text)
+    if match:
+        return float(match.group(1)), True
+    return parse_number(text), False
+
+
+def parse_guideline(text: Any) -> Optional[Tuple[str, float, float]]:
+    """
+    Parse a WHO guideline cell.
+
+    Returns:
+        ("range", low, high) for "6.5 - 8.50", ("max", 0, limit) for "<1000",
+        ("nil", 0, 0) for "NIL", or None when there is no usable guideline ("NS")
+    """
+    text = str(text or "").strip().lower()
+    if text in _NIL_VALUES:
+        return ("nil", 0.0, 0.0)
+    match = _RANGE_RE.search(text)
+    if match:
+        return ("range", float(match.group(1)), float(match.group(2)))
+    match = _MAX_RE.match(text)
+    if match:
+        return ("max", 0.0, float(match.group(1)))
+    return None
+
+
+def exceedance_ratio(
+    value: Optional[float],
+    guideline: Optional[Tuple[str, float, float]],
+    below_detection: bool = False
+) -> Optional[float]:
+    """
+    How far a value sits relative to its guideline; above 1 means it fails.
+
+    For an upper limit this is value / limit. For a range it is
+    value / high above the range and low / value below it, and
+    value / high inside it. A value below detection ("<x", "ND") is at
+    most x: it is compliant with a NIL guideline (0), and against a limit
+    its ratio is an upper bound, capped at 1 so a detection limit above the
+    guideline does not count as a failure. None when either side is unknown, and when an amount is
+    detected where the guideline is NIL (or zero) or a range's value is 0:
+    those have no finite ratio (see nil_detected).
+    """
+    if value is None or guideline is None:
+        return None
+    kind, low, high = guideline
+    if kind == "nil" or high <= 0:
+        return 0.0 if below_detection or value <= 0 else None
+    if kind == "range" and value < low:
+        return low / value if value > 0 else None
+    return min(value / high, 1.0) if below_detection else value / high
+
+
+def nil_detected(value: Optional[float], guideline: Optional[Tuple[str, float, float]], below_detection: bool) -> bool:
+    """True when a measurable amount was found where the guideline allows none."""
+    return (
+        value is not None and guideline is not None and not below_detection and value > 0
+        and (guideline[0] == "nil" or guideline[2] <= 0)
+    )
+
+
+def _rows(report: Dict[str, Any]) -> List[Dict[str, Any]]:
+    rows = []
+    for section in ("physical_analysis", "chemical_analysis"):
+        for entry in report.get(section) or []:
+            for name, fields in entry.items():
+                fields = fields or {}
+                value, below_detection = parse_value(fields.get("value"))
+                guideline = parse_guideline(fields.get("who_guideline"))
+                rows.append({
+                    "name": name,
+                    "value": " ".join(str(fields.get("value") or "").split()),
+                    "unit": " ".join(str(fields.get("unit") or "").split()),
+                    "guideline": " ".join(str(fields.get("who_guideline") or "").split()),
+                    "remark": str(fields.get("remark") or "").strip().lower(),
+                    "kind": guideline[0] if guideline else None,
+                    "low": guideline[1] if guideline else None,
+                    "ratio": exceedance_ratio(value, guideline, below_detection),
+                    "below_detection": below_detection,
+                    "nil_detected": nil_detected(value, guideline, below_detection),
+                })
+    return rows
+
+
+def classify_parameters(report: Dict[str, Any]) -> Dict[str, List[Dict[str, Any]]]:
+    """
+    Group the analysed parameters of a parsed lab report by guideline status.
+
+    Returns:
+        Dict with "failing" (marked Fail or past the guideline, worst
+        exceedance first), "near" (at NEAR_LIMIT_RATIO or more of an upper
+        limit, closest first), "within" and "unrated" (no usable guideline)
+        row lists. Rows carry name, value, unit, guideline, remark, kind,
+        ratio (see exceedance_ratio), below_detection and nil_detected.
+    """
+    groups = {"failing": [], "near": [], "within": [], "unrated": []}
+    for row in _rows(report):
+        ratio = row["ratio"]
+        if row["remark"] == "fail" or row["nil_detected"] or (ratio is not None and ratio > 1):
+            groups["failing"].append(row)
+        elif ratio is not None and ratio >= NEAR_LIMIT_RATIO and row["kind"] == "max":
+            groups["near"].append(row)
+        elif ratio is not None or row["remark"] == "pass":
+            groups["within"].append(row)
+        else:
+            groups["unrated"].append(row)
+
+    # Fails the guideline cannot quantify sort after the quantified ones
+    groups["failing"].sort(key=lambda row: -(row["ratio"] if row["ratio"] is not None else 0.0))
+    groups["near"].sort(key=lambda row: -row["ratio"])
+    return groups
+
+
+def _describe(row: Dict[str, Any]) -> str:
+    text = f"{row['name']}: {row['value']} {row['unit']}".rstrip()
+    if row["guideline"]:
+        text += f" (guideline {row['guideline']}"
+        ratio = row["ratio"]
+        if row["nil_detected"]:
+            text += ", should be absent)"
+        elif ratio is None:
+            text += ")"
+        elif row["kind"] == "range" and parse_number(row["value"]) < row["low"]:
+            text += f", below range by {ratio:.2f}x)"
+        elif row["below_detection"]:
+            text += f", at most {ratio:.2f}x limit)"
+        else:
+            text += f", {ratio:.2f}x limit)"
+    return text
+
+
+def summarize_lab_report(report: Dict[str, Any]) -> str:
+    """
+    Rule-based summary of a parsed lab report (mypdf.extract_pdf_data output).
+
+    Parameters the lab marked Fail, or whose value is past its WHO
+    guideline, are listed first, worst exceedance first; then parameters
+    at 80% or more of an upper limit, the remaining results and the lab
+    comments. Stands in for the LLM lab summary at no model cost.
+    """
+    header = report.get("header") or {}
+    client = header.get("client_info") or {}
+    sample = header.get("sample_info") or {}
+    lines = []
+    details = [
+        f"{label}: {' '.join(str(source[field]).split())}"
+        for label, source, field in (
+            ("Client", client, "client"),
+            ("Site", client, "site_location"),
+            ("Source", sample, "source"),
+            ("Test", sample, "type_of_test"),
+            ("Sampled", sample, "sampling_date"),
+            ("Analysed", sample, "date_of_analysis"),
+        )
+        if source.get(field)
+    ]
+    if details:
+        lines.append("; ".join(details))
+
+    groups = classify_parameters(report)
+    failing, near, within, unrated = (groups[name] for name in ("failing", "near", "within", "unrated"))
+    if failing:
+        lines.append("Exceeding WHO guidelines, worst first:")
+        lines.extend(f"- {_describe(row)}" for row in failing)
+    else:
+        lines.append("No parameter exceeds the WHO guidelines.")
+    if near:
+        lines.append("Close to the limit:")
+        lines.extend(f"- {_describe(row)}" for row in near)
+    if within:
+        lines.append("Within guidelines: " + "; ".join(f"{row['name']} {row['value']} {row['unit']}".rstrip() for row in within))
+    if unrated:
+        lines.append("No guideline: " + "; ".join(f"{row['name']} {row['value']} {row['unit']}".rstrip() for row in unrated))
+
+    for comment in report.get("final_comments") or []:
+        text = comment.get("comments") if isinstance(comment, dict) else comment
+        if text:
+            lines.append(f"Lab comments: {' '.join(str(text).split())}")
+    return "\n".join(lines)
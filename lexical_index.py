@@ -0,0 +1,264 @@
+import os
+import re
+import json
+import logging
+import tempfile
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+logger = logging.getLogger("lexical_index")
+
+# Bump when tokenize() changes so persisted indexes are rebuilt
+TOKENIZER_VERSION = 1
+
+# Spellings of the same unit, mapped to one canonical form
+UNIT_ALIASES = {
+    "l/hr": "lph", "l/h": "lph", "lph": "lph", "ltr/hr": "lph", "litre/hr": "lph", "liter/hr": "lph",
+    "lpm": "lpm", "l/min": "lpm",
+    "m3/hr": "m3h", "m3/h": "m3h", "m³/hr": "m3h", "m³/h": "m3h", "cmh": "m3h",
+    "gpm": "gpm", "gpd": "gpd",
+    "bar": "bar", "psi": "psi", "kpa": "kpa",
+    "kw": "kw", "hp": "hp", "v": "v", "hz": "hz",
+    "mm": "mm", "inch": "inch", "in": "inch",
+    "ppm": "ppm", "mg/l": "mgl", "ppb": "ppb", "µg/l": "ugl", "ug/l": "ugl",
+    "µs/cm": "uscm", "us/cm": "uscm", "ms/cm": "mscm",
+    "ntu": "ntu", "°c": "c", "degc": "c", "%": "pct",
+}
+
+_UNIT_PATTERN = "|".join(sorted((re.escape(u) for u in UNIT_ALIASES), key=len, reverse=True))
+# A number followed by a unit, e.g. "250 L/hr", "30bar", "0.5 mg/L"
+_QUANTITY_RE = re.compile(rf"(\d+(?:\.\d+)?)\s*({_UNIT_PATTERN})(?![a-z0-9])")
+# Words and model numbers; internal - / . _ are kept, e.g. "xl3-4040", "bw30-400"
+_TOKEN_RE = re.compile(r"[a-z0-9µ]+(?:[-_./][a-z0-9]+)*")
+_SPLIT_RE = re.compile(r"[-_./]")
+_NUMBER_RE = re.compile(r"\d+(?:\.\d+)*")
+
+STOPWORDS = frozenset(
+    "a an and are as at be by for from in is it of on or the this to with".split()
+)
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Split text into BM25 terms.
+
+    Besides plain words, model numbers such as "XL3-4040" are kept whole
+    (and also split into their parts), and numbers with units become a
+    single canonical term, so "250 L/hr", "250l/h" and "250 lph" all
+    produce "250lph".
+    """
+    text = text.lower()
+    terms = []
+    for number, unit in _QUANTITY_RE.findall(text):
+        if "." in number:
+            number = number.rstrip("0").rstrip(".")
+        terms.append(f"{number}{UNIT_ALIASES[unit]}")
+    for token in _TOKEN_RE.findall(text):
+        if token in STOPWORDS:
+            continue
+        terms.append(token)
+        if _SPLIT_RE.search(token) and not _NUMBER_RE.fullmatch(token):
+            terms.extend(part for part in _SPLIT_RE.split(token) if part and part not in STOPWORDS)
+    return terms
+
+
+class BM25Index:
+    """
+    In-memory Okapi BM25 inverted index.
+
+    Postings are stored in CSR form: the documents and term frequencies of
+    term t are `doc_ids[offsets[t]:offsets[t + 1]]` and the matching slice
+    of `term_freqs`. Document ids are positions in the text list, the same
+    ids the FAISS index uses.
+    """
+
+    def __init__(
+        self,
+        vocabulary: Dict[str, int],
+        offsets: np.ndarray,
+        doc_ids: np.ndarray,
+        term_freqs: np.ndarray,
+        doc_lengths: np.ndarray,
+        k1: float = 1.5,
+        b: float = 0.75
+    ):
+        self.vocabulary = vocabulary
+        self.offsets = offsets
+        self.doc_ids = doc_ids
+        self.term_freqs = term_freqs
+        self.doc_lengths = doc_lengths
+        self.k1 = k1
+        self.b = b
+        n_docs = len(doc_lengths)
+        doc_freqs = np.diff(offsets)
+        self.idf = np.log(1 + (n_docs - doc_freqs + 0.5) / (doc_freqs + 0.5)).astype('float32')
+        average_length = float(doc_lengths.mean()) if n_docs else 0.0
+        # Per-document length normalisation, k1 * (1 - b + b * |d| / avgdl)
+        self._norms = (k1 * (1 - b + b * doc_lengths / (average_length or 1))).astype('float32')
+
+    @classmethod
+    def build(cls, texts: Sequence[str], **kwargs) -> "BM25Index":
+        """Tokenize `texts` and build the postings."""
+        vocabulary: Dict[str, int] = {}
+        postings: List[Dict[int, int]] = []
+        doc_lengths = np.zeros(len(texts), dtype='int32')
+        for doc_id, text in enumerate(texts):
+            terms = tokenize(text)
+            doc_lengths[doc_id] = len(terms)
+            for term in terms:
+                term_id = vocabulary.setdefault(term, len(vocabulary))
+                if term_id == len(postings):
+                    postings.append({})
+                postings[term_id][doc_id] = postings[term_id].get(doc_id, 0) + 1
+
+        offsets = np.zeros(len(postings) + 1, dtype='int64')
+        offsets[1:] = np.cumsum([len(p) for p in postings])
+        doc_ids = np.fromiter((d for p in postings for d in p), dtype='int32', count=int(offsets[-1]))
+        term_freqs = np.fromiter((f for p in postings for f in p.values()), dtype='float32', count=int(offsets[-1]))
+        return cls(vocabulary, offsets, doc_ids, term_freqs, doc_lengths, **kwargs)
+
+    def extend(self, texts: Sequence[str]) -> "BM25Index":
+        """
+        A new index with `texts` appended as documents len(self), len(self) + 1, ...
+
+        Only the new texts are tokenized; the existing postings are merged
+        in as they are. The result is the same as build() over all texts.
+        """
+        added = BM25Index.build(texts, k1=self.k1, b=self.b)
+        vocabulary = dict(self.vocabulary)
+        term_map = np.array(
+            [vocabulary.setdefault(term, len(vocabulary)) for term, _ in sorted(added.vocabulary.items(), key=lambda item: item[1])],
+            dtype='int64'
+        )
+        terms = np.concatenate([
+            np.repeat(np.arange(len(self.offsets) - 1), np.diff(self.offsets)),
+            np.repeat(term_map, np.diff(added.offsets)),
+        ])
+        # Stable: per term, the old documents stay ahead of the new ones, in id order
+        order = np.argsort(terms, kind='stable')
+        offsets = np.zeros(len(vocabulary) + 1, dtype='int64')
+        offsets[1:] = np.cumsum(np.bincount(terms, minlength=len(vocabulary)))
+        doc_ids = np.concatenate([self.doc_ids, added.doc_ids + len(self)])[order].astype('int32')
+        term_freqs = np.concatenate([self.term_freqs, added.term_freqs])[order]
+        doc_lengths = np.concatenate([self.doc_lengths, added.doc_lengths])
+        return BM25Index(vocabulary, offsets, doc_ids, term_freqs, doc_lengths, k1=self.k1, b=self.b)
+
+    def __len__(self) -> int:
+        return len(self.doc_lengths)
+
+    def scores(self, query: str) -> np.ndarray:
+        """BM25 score of every document for `query`."""
+        scores = np.zeros(len(self), dtype='float32')
+        for term in set(tokenize(query)):
+            term_id = self.vocabulary.get(term)
+            if term_id is None:
+                continue
+            start, end = self.offsets[term_id], self.offsets[term_id + 1]
+            docs = self.doc_ids[start:end]
+            tf = self.term_freqs[start:end]
+            scores[docs] += self.idf[term_id] * tf * (self.k1 + 1) / (tf + self._norms[docs])
+        return scores
+
+    @staticmethod
+    def top_k(scores: np.ndarray, ids: np.ndarray, k: int) -> np.ndarray:
+        """
+        Best-scoring documents among `ids`, highest first.
+
+        Documents that match no query term are left out.
+        """
+        ids = np.asarray(ids)
+        candidate_scores = scores[ids]
+        matched = np.flatnonzero(candidate_scores > 0)
+        if len(matched) > k:
+            matched = matched[np.argpartition(-candidate_scores[matched], k - 1)[:k]]
+        order = np.argsort(-candidate_scores[matched], kind='stable')
+        return ids[matched[order]]
+
+    def save(self, path: str, fingerprint: str):
+        """Write the index to `path` (.npz) atomically."""
+        directory = os.path.dirname(path) or "."
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".npz")
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(
+                    f,
+                    offsets=self.offsets,
+                    doc_ids=self.doc_ids,
+                    term_freqs=self.term_freqs,
+                    doc_lengths=self.doc_lengths,
+                    vocabulary=np.array(json.dumps(self.vocabulary)),
+                    header=np.array(json.dumps({
+                        "tokenizer_version": TOKENIZER_VERSION,
+                        "fingerprint": fingerprint,
+                        "k1": self.k1,
+                        "b": self.b,
+                    })),
+                )
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    @classmethod
+    def load(cls, path: str, fingerprint: str) -> Optional["BM25Index"]:
+        """Read an index written by save(); None if missing or stale."""
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as data:
+            header = json.loads(str(data["header"]))
+            if header.get("tokenizer_version") != TOKENIZER_VERSION or header.get("fingerprint") != fingerprint:
+                return None
+            return cls(
+                json.loads(str(data["vocabulary"])),
+                data["offsets"],
+                data["doc_ids"],
+                data["term_freqs"],
+                data["doc_lengths"],
+                k1=header["k1"],
+                b=header["b"],
+            )
+
+
+def load_or_build(path: str, texts: Sequence[str], fingerprint: str) -> BM25Index:
+    """
+    Load the BM25 index persisted at `path`, or build it from `texts` and save it.
+
+    Args:
+        path: .npz file next to the FAISS files
+        texts: Chunk texts, in vector order
+        fingerprint: Identifies the text set; a stored index with a different
+            fingerprint is rebuilt
+
+    Returns:
+        The BM25 index
+    """
+    try:
+        index = BM25Index.load(path, fingerprint)
+        if index is not None and len(index) == len(texts):
+            return index
+    except Exception as e:
+        logger.warning(f"Could not read BM25 index {path}: {e}")
+    index = BM25Index.build(texts)
+    try:
+        index.save(path, fingerprint)
+    except OSError as e:
+        # Read-only deployments still get the in-memory index
+        logger.warning(f"Could not save BM25 index {path}: {e}")
+    return index
+
+
+def reciprocal_rank_fusion(rankings: Sequence[Sequence[int]], k: int = 60) -> List[int]:
+    """
+    Merge ranked id lists with reciprocal-rank fusion.
+
+    Each id scores sum(1 / (k + rank)) over the lists it appears in, with
+    ranks starting at 1. Ties keep first-seen order.
+    """
+    scores: Dict[int, float] = {}
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking, start=1):
+            scores[int(doc_id)] = scores.get(int(doc_id), 0.0) + 1.0 / (k + rank)
+    return sorted(scores, key=lambda doc_id: -scores[doc_id])
@@ -0,0 +1,443 @@
+import time
+import random
+import asyncio
+import logging
+from collections import deque
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Awaitable, Callable, Deque, Dict, List, NamedTuple, Optional, Tuple
+
+import httpx
+from openai import APIConnectionError
+
+logger = logging.getLogger("llm_calls")
+
+# HTTP statuses that mean "try again": timeout, conflict and rate limit; 5xx are added on top
+RETRYABLE_STATUSES = (408, 409, 429)
+
+
+class CircuitOpenError(Exception):
+    """The provider's circuit breaker is open, so the request was not sent."""
+
+
+class InvalidAnswer(Exception):
+    """A request returned, but not a usable answer; `result` keeps what it returned."""
+
+    def __init__(self, message: str, result: Any = None):
+        super().__init__(message)
+        self.result = result
+
+
+@dataclass
+class CallPolicy:
+    """
+    Time and retry limits for LLM calls.
+
+    `deadline` bounds one logical call - every attempt, backoff and hedge
+    included - and `attempt_timeout` each request within it. Generations
+    take 20-60 s, so the timeout sits well above that; once `min_samples`
+    latencies of a route are known it grows to `timeout_factor` times their
+    p99 if that is longer. Provider failures are retried up to
+    `max_attempts`; a reply that could not be parsed is only resent when
+    `parse_retries` is set (at most once, since structured output should
+    prevent it). Retries use full-jitter exponential backoff between
+    `base_delay` and `max_delay` and draw on a shared budget that refills
+    by `retry_ratio` per call.
+    With `hedge` on, a backup request is sent once the primary has been
+    out longer than its observed `hedge_quantile` latency (`hedge_delay`
+    until `min_samples` latencies are known). A provider's breaker opens
+    after `failure_threshold` consecutive failures and lets one trial
+    request through after `reset_timeout` seconds.
+    """
+    deadline: float = 300.0
+    attempt_timeout: float = 180.0
+    timeout_factor: float = 3.0
+    max_attempts: int = 3
+    parse_retries: int = 0
+    base_delay: float = 0.5
+    max_delay: float = 8.0
+    retry_ratio: float = 0.2
+    hedge: bool = False
+    hedge_quantile: float = 0.95
+    hedge_delay: float = 30.0
+    min_samples: int = 20
+    failure_threshold: int = 5
+    reset_timeout: float = 30.0
+
+
+class Route(NamedTuple):
+    """
+    One way to answer a call: the provider, a label for logs and latency
+    stats, and the request. For LLMCaller.stream the request returns an
+    async iterator of chunks instead of an awaitable.
+    """
+    provider: str
+    key: str
+    request: Callable[[], Awaitable[Any]]
+
+
+def status_code(error: BaseException) -> Optional[int]:
+    """HTTP status of an OpenAI or google-genai error, following the exceptions it wraps."""
+    seen = set()
+    while error is not None and id(error) not in seen:
+        seen.add(id(error))
+        code = getattr(error, "status_code", None) or getattr(error, "code", None)
+        if isinstance(code, int):
+            return code
+        error = error.__cause__ or error.__context__
+    return None
+
+
+def is_provider_failure(error: BaseException) -> bool:
+    """Timeouts, connection errors, rate limits and server errors: failures that count against the breaker."""
+    code = status_code(error)
+    if code is not None:
+        return code in RETRYABLE_STATUSES or code >= 500
+    return isinstance(error, (TimeoutError, ConnectionError, APIConnectionError, httpx.TransportError))
+
+
+def is_retryable(error: BaseException) -> bool:
+    """Provider failures: another attempt may succeed."""
+    return is_provider_failure(error)
+
+
+def is_parse_failure(error: BaseException) -> bool:
+    """A reply that arrived but could not be parsed; another sample may parse."""
+    return status_code(error) is None and isinstance(error, (ValueError, InvalidAnswer))
+
+
+class LatencyTracker:
+    """Latencies of the most recent successful requests."""
+
+    def __init__(self, window: int = 200):
+        self.samples: Deque[float] = deque(maxlen=window)
+
+    def record(self, seconds: float):
+        self.samples.append(seconds)
+
+    def quantile(self, q: float) -> Optional[float]:
+        if not self.samples:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class CircuitBreaker:
+    """
+    Consecutive-failure breaker for one provider.
+
+    Closed until `failure_threshold` failures in a row, then open for
+    `reset_timeout` seconds; after that one trial request is let through
+    (half open), which closes the breaker on success and reopens it on
+    failure.
+    """
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.trial = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half_open"
+        return "open"
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half_open" and not self.trial:
+            self.trial = True
+            return True
+        return False
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+
+    def record_failure(self):
+        self.failures += 1
+        self.trial = False
+        if self.opened_at is not None or self.failures >= self.failure_threshold:
+            if self.opened_at is None:
+                logger.warning("%s circuit breaker opened after %d consecutive failures", self.name, self.failures)
+            self.opened_at = time.monotonic()
+
+    def release(self):
+        """Give back a trial slot whose request ended without an outcome (e.g. cancelled)."""
+        self.trial = False
+
+
+class RetryBudget:
+    """Token bucket shared by all calls: each call deposits `ratio` tokens and each retry spends one."""
+
+    def __init__(self, ratio: float = 0.2, capacity: float = 10.0):
+        self.ratio = ratio
+        self.capacity = capacity
+        self.tokens = capacity
+
+    def deposit(self):
+        self.tokens = min(self.capacity, self.tokens + self.ratio)
+
+    def withdraw(self) -> bool:
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class LLMCaller:
+    """
+    Deadlines, retries, circuit breakers and hedging for LLM requests.
+
+    One instance is shared by every agent of the process, so breaker
+    state, latency statistics and the retry budget survive agent reloads.
+    """
+
+    def __init__(self, policy: Optional[CallPolicy] = None):
+        self.policy = policy or CallPolicy()
+        self.breakers: Dict[str, CircuitBreaker] = {}
+        self.latencies: Dict[str, LatencyTracker] = {}
+        self.retry_budget = RetryBudget(self.policy.retry_ratio)
+
+    def breaker(self, provider: str) -> CircuitBreaker:
+        if provider not in self.breakers:
+            self.breakers[provider] = CircuitBreaker(provider, self.policy.failure_threshold, self.policy.reset_timeout)
+        return self.breakers[provider]
+
+    def hedge_delay(self, key: str) -> float:
+        """Seconds to wait on `key` before hedging: its observed latency quantile, once known."""
+        tracker = self.latencies.get(key)
+        if tracker is None or len(tracker.samples) < self.policy.min_samples:
+            return self.policy.hedge_delay
+        return tracker.quantile(self.policy.hedge_quantile)
+
+    def attempt_timeout(self, key: str) -> float:
+        """Timeout for one request on `key`: the policy's, or timeout_factor times its observed p99 if longer."""
+        tracker = self.latencies.get(key)
+        if tracker is None or len(tracker.samples) < self.policy.min_samples:
+            return self.policy.attempt_timeout
+        return max(self.policy.attempt_timeout, self.policy.timeout_factor * tracker.quantile(0.99))
+
+    async def call(
+        self,
+        route: Route,
+        validate: Optional[Callable[[Any], None]] = None,
+        deadline: Optional[float] = None
+    ) -> Any:
+        """
+        Run one route with per-attempt timeouts and jittered retries.
+
+        Args:
+            route: Provider, label and request factory (called once per attempt)
+            validate: Raises InvalidAnswer for a result that is not usable
+            deadline: Event-loop time the call must finish by; defaults to now + policy.deadline
+
+        Returns:
+            The first valid result
+
+        Raises:
+            CircuitOpenError: The provider's breaker rejected the attempt
+            TimeoutError: The deadline passed
+            Exception: The last attempt's error when retries are exhausted or not allowed
+        """
+        policy = self.policy
+        loop = asyncio.get_running_loop()
+        if deadline is None:
+            deadline = loop.time() + policy.deadline
+        breaker = self.breaker(route.provider)
+        self.retry_budget.deposit()
+        attempt = 0
+        parse_retries = min(policy.parse_retries, 1)
+        while True:
+            attempt += 1
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                raise TimeoutError(f"{route.key}: deadline exceeded")
+            if not breaker.allow():
+                raise CircuitOpenError(f"{route.provider} circuit breaker is open")
+            start = loop.time()
+            try:
+                result = await asyncio.wait_for(route.request(), min(self.attempt_timeout(route.key), remaining))
+                if validate is not None:
+                    validate(result)
+            except asyncio.CancelledError:
+                breaker.release()
+                raise
+            except Exception as e:
+                self._record_failure(breaker, e)
+                retry = is_retryable(e)
+                if not retry and is_parse_failure(e) and parse_retries > 0:
+                    parse_retries -= 1
+                    retry = True
+                delay = self._retry_delay(route, attempt, e, deadline) if retry else None
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                continue
+            breaker.record_success()
+            self.latencies.setdefault(route.key, LatencyTracker()).record(loop.time() - start)
+            return result
+
+    @staticmethod
+    def _record_failure(breaker: CircuitBreaker, error: Exception):
+        if is_provider_failure(error):
+            breaker.record_failure()
+        else:
+            # The provider answered, it just was not a usable answer
+            breaker.record_success()
+
+    def _retry_delay(self, route: Route, attempt: int, error: Exception, deadline: float) -> Optional[float]:
+        """Backoff before retrying `route` after a retryable `error`, or None when no retry is allowed."""
+        policy = self.policy
+        if attempt >= policy.max_attempts:
+            return None
+        delay = random.uniform(0, min(policy.max_delay, policy.base_delay * 2 ** (attempt - 1)))
+        if asyncio.get_running_loop().time() + delay >= deadline:
+            return None
+        if not self.retry_budget.withdraw():
+            logger.warning("%s: retry budget exhausted, not retrying: %r", route.key, error)
+            return None
+        logger.warning("%s: attempt %d failed (%r), retrying in %.2fs", route.key, attempt, error, delay)
+        return delay
+
+    async def stream(self, primary: Route, backup: Optional[Route] = None) -> AsyncIterator[Any]:
+        """
+        Yield the chunks of a streamed request, with the limits of call().
+
+        Opening the stream and every chunk read are bounded by
+        `attempt_timeout` and one deadline for the whole stream. A route
+        that fails before its first chunk is retried as in call(), and then
+        `backup` takes over. Once a chunk has been yielded the stream stays
+        on its route, and a later failure is raised.
+
+        Raises:
+            CircuitOpenError: Every route's breaker rejected the attempt
+            TimeoutError: The deadline passed, or a chunk took longer than attempt_timeout
+            Exception: The first route's error when no route could start
+        """
+        policy = self.policy
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + policy.deadline
+        self.retry_budget.deposit()
+        errors: List[Exception] = []
+        for route in (primary, backup):
+            if route is None:
+                continue
+            breaker = self.breaker(route.provider)
+            attempt = 0
+            while True:
+                attempt += 1
+                if not breaker.allow():
+                    errors.append(CircuitOpenError(f"{route.provider} circuit breaker is open"))
+                    break
+                chunks = route.request().__aiter__()
+                started = False
+                try:
+                    while True:
+                        remaining = deadline - loop.time()
+                        if remaining <= 0:
+                            raise TimeoutError(f"{route.key}: deadline exceeded")
+                        timeout = min(self.attempt_timeout(route.key), remaining)
+                        try:
+                            chunk = await asyncio.wait_for(chunks.__anext__(), timeout)
+                        except StopAsyncIteration:
+                            break
+                        except asyncio.TimeoutError:
+                            raise TimeoutError(f"{route.key}: no reply chunk within {timeout:.1f}s")
+                        started = True
+                        yield chunk
+                except (asyncio.CancelledError, GeneratorExit):
+                    breaker.release()
+                    raise
+                except Exception as e:
+                    self._record_failure(breaker, e)
+                    if started:
+                        raise
+                    delay = self._retry_delay(route, attempt, e, deadline) if is_retryable(e) else None
+                    if delay is None:
+                        logger.warning("%s failed: %r", route.key, e)
+                        errors.append(e)
+                        break
+                    await asyncio.sleep(delay)
+                    continue
+                finally:
+                    aclose = getattr(chunks, "aclose", None)
+                    if aclose is not None:
+                        await aclose()
+                breaker.record_success()
+                return
+        raise errors[0]
+
+    async def first_valid(
+        self,
+        primary: Route,
+        backup: Optional[Route] = None,
+        validate: Optional[Callable[[Any], None]] = None
+    ) -> Any:
+        """
+        Run `primary`, bringing in `backup` when the primary fails or, with
+        hedging on, is slower than its observed latency quantile. The first
+        valid result wins and the other request is cancelled.
+
+        Raises:
+            Exception: When no route produced a valid result; an InvalidAnswer
+                is preferred so callers can still use what was returned
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.policy.deadline
+        tasks = {asyncio.create_task(self.call(primary, validate, deadline)): primary}
+        hedge_at = loop.time() + self.hedge_delay(primary.key) if self.policy.hedge else None
+        pending_backup = backup
+        errors: List[Exception] = []
+        try:
+            while tasks:
+                timeout = None
+                if pending_backup is not None and hedge_at is not None:
+                    timeout = max(0.0, hedge_at - loop.time())
+                done, _ = await asyncio.wait(tasks, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    route = tasks.pop(task)
+                    try:
+                        return task.result()
+                    except Exception as e:
+                        logger.warning("%s failed: %r", route.key, e)
+                        errors.append(e)
+                if pending_backup is not None and (not done or not tasks):
+                    if not done:
+                        logger.info("Hedging %s with %s", primary.key, pending_backup.key)
+                    tasks[asyncio.create_task(self.call(pending_backup, validate, deadline))] = pending_backup
+                    pending_backup = None
+        finally:
+            for task in tasks:
+                task.cancel()
+        raise next((e for e in errors if isinstance(e, InvalidAnswer)), errors[0])
+
+
+def parse_backup_models(spec: str) -> Optional[Dict[str, Tuple[str, str]]]:
+    """
+    Parse a backup-route spec such as "gpt=gemini:gemini-2.5-flash,gemini=gpt:openai/gpt-4.1-mini".
+
+    Returns:
+        Primary provider -> (backup provider, backup model); None for an
+        empty spec (use the agent's default) and {} for "none"
+    """
+    spec = (spec or "").strip()
+    if not spec:
+        return None
+    if spec.lower() == "none":
+        return {}
+    routes = {}
+    for entry in spec.split(","):
+        primary, _, target = entry.partition("=")
+        provider, _, model = target.partition(":")
+        if not primary.strip() or not provider.strip() or not model.strip():
+            raise ValueError(f"Invalid backup route {entry!r}; expected primary=provider:model")
+        routes[primary.strip().lower()] = (provider.strip().lower(), model.strip())
+    return routes
@@ -1,5 +1,7 @@
+from datetime import datetime
+
 from database import Base
-from sqlalchemy import Column, Integer, String, Float
+from sqlalchemy import Column, Integer, String, Float, Text, DateTime
 
 class Recommendations(Base):
     __tablename__ = "recommendations"
@@ -17,3 +19,20 @@ class Recommendations(Base):
         return f"<Recommendation(product_description={self.product_description}, product_name={self.item_id}\
             , model_number={self.model_number}, quantity={self.quantiy}, price={self.price})>"
 
+
+
+class Job(Base):
+    """A recommendation run submitted through the job API."""
+    __tablename__ = "jobs"
+
+    id = Column(String, primary_key=True, index=True)
+    status = Column(String, index=True, nullable=False)  # queued, running, succeeded, failed
+    query = Column(Text, nullable=False)
+    report_name = Column(String)
+    report_path = Column(String)
+    result = Column(Text, nullable=True)  # JSON-encoded AnalyzeResponse
+    error = Column(Text, nullable=True)
+    attempts = Column(Integer, default=0)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    started_at = Column(DateTime, nullable=True)
+    finished_at = Column(DateTime, nullable=True)
@@ -16,6 +16,9 @@ logging.basicConfig(
 )
 logger = logging.getLogger("pdf_processor")
 
+# Bump when extraction or parsing output changes, so cached reports are re-parsed
+PARSER_VERSION = 1
+
 class PDFDataExtractor:
     """Class to handle extraction of data from PDF files"""
     
@@ -26,13 +29,31 @@ class PDFDataExtractor:
         self.cleaned_data = []
         
     def extract_tables(self) -> bool:
-        """Extract tables from the PDF file"""
+        """
+        Extract the lab-results table from the PDF file.
+
+        Only the first non-empty table is used downstream (it holds both the
+        analysis rows and the comments block), so pages are scanned in order
+        and extraction stops as soon as that table is found. Pages without
+        ruling lines, rectangles or curves cannot contain a table under
+        pdfplumber's default "lines" strategy and are skipped before table
+        detection. Each page's cached layout objects are released once it
+        has been looked at, so memory does not grow with page count.
+        """
         try:
             with pdfplumber.open(self.pdf_path) as pdf:
                 for page in pdf.pages:
-                    tables = page.extract_tables()
-                    if tables:
-                        self.raw_data.extend(tables)
+                    try:
+                        if not (page.lines or page.rects or page.curves):
+                            continue
+                        for table in page.extract_tables():
+                            if self._clean_pdf_data([table]):
+                                self.raw_data.append(table)
+                                break
+                    finally:
+                        page.close()
+                    if self.raw_data:
+                        break
             
             if not self.raw_data:
                 logger.warning(f"No tables found in {self.pdf_path}")
@@ -236,13 +257,14 @@ class WaterReportParser:
 
 
 # Module-level functions for ease of use
-def extract_pdf_data(pdf_path: str, output_path: Optional[str] = None) -> Dict[str, Any]:
+def extract_pdf_data(pdf_path: str, output_path: Optional[str] = None, save: bool = True) -> Dict[str, Any]:
     """
     Extract and process data from a water report PDF file.
     
     Args:
         pdf_path: Path to the PDF file
         output_path: Optional path to save the JSON output
+        save: Write the JSON output; False only returns the result
     
     Returns:
         Dict containing the structured data extracted from the PDF
@@ -257,7 +279,8 @@ def extract_pdf_data(pdf_path: str, output_path: Optional[str] = None) -> Dict[s
         output_path = 'outputs/' + output_path
 
     # Ensure outputs directory exists
-    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    if save:
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
 
     # Extract and clean data
     extractor = PDFDataExtractor(pdf_path)
@@ -280,11 +303,12 @@ def extract_pdf_data(pdf_path: str, output_path: Optional[str] = None) -> Dict[s
         "final_comments": final_comments,
         "metadata": {
             "processed_date": datetime.now().isoformat(),
-            "source_file": os.path.basename(pdf_path)
+            "source_file": os.path.basename(pdf_path),
+            "parser_version": PARSER_VERSION
         }
     }
     # Save to file
-    if output_path:
+    if save:
         with open(output_path, 'w') as f:
             json.dump(result, f, indent=4)
         logger.info(f"Data saved to {output_path}")
@@ -0,0 +1,135 @@
+import os
+import asyncio
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable, Dict, Optional
+
+import mypdf
+
+logger = logging.getLogger("pdf_pool")
+
+
+class PdfExtractionError(RuntimeError):
+    """A PDF could not be extracted because its worker timed out or crashed."""
+
+
+class PdfExtractionPool:
+    """
+    Process pool for CPU-bound pdfplumber extraction.
+
+    Extraction runs in separate processes, so parsing never blocks the
+    event loop and a PDF that hangs or crashes its worker cannot take the
+    API process down with it. At most `max_workers` jobs are handed to the
+    pool at once, so the timeout covers only the extraction itself, not
+    time spent waiting for a free worker. A job that exceeds `timeout` or
+    breaks the pool causes the pool to be torn down, with its workers
+    terminated, and replaced. Jobs that were running on the old pool only
+    because they shared it with the bad PDF are retried once on the new one.
+    """
+
+    def __init__(
+        self,
+        max_workers: Optional[int] = None,
+        timeout: float = 60.0,
+        max_tasks_per_child: Optional[int] = 50,
+        extract_fn: Callable[..., Dict[str, Any]] = mypdf.extract_pdf_data
+    ):
+        """
+        Initialize the pool. Worker processes start lazily on first use.
+
+        Args:
+            max_workers: Number of worker processes (defaults to min(4, CPU count))
+            timeout: Seconds one extraction may take before its worker is killed
+            max_tasks_per_child: Recycle a worker after this many PDFs to bound memory growth
+            extract_fn: Picklable function run in the workers, called as
+                extract_fn(pdf_path, output_path, save)
+        """
+        self.max_workers = max_workers or min(4, os.cpu_count() or 1)
+        self.timeout = timeout
+        self.max_tasks_per_child = max_tasks_per_child
+        self.extract_fn = extract_fn
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._generation = 0
+        self._lock = asyncio.Lock()
+        # A job is submitted only when a worker is free
+        self._slots = asyncio.Semaphore(self.max_workers)
+
+    def _new_executor(self) -> ProcessPoolExecutor:
+        # spawn: the API process has threads, which fork does not copy safely
+        return ProcessPoolExecutor(
+            max_workers=self.max_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            max_tasks_per_child=self.max_tasks_per_child,
+        )
+
+    @staticmethod
+    def _terminate(executor: ProcessPoolExecutor):
+        """Kill the executor's workers, including ones stuck in a job."""
+        # There is no public API for this; shutdown() alone waits on running jobs
+        for process in list((getattr(executor, "_processes", None) or {}).values()):
+            if process.is_alive():
+                process.terminate()
+        # Jobs are only submitted when a worker is free, so there is no queue to
+        # cancel; the jobs running on the killed workers fail with BrokenProcessPool
+        executor.shutdown(wait=False)
+
+    async def _restart(self, generation: int):
+        """Replace the pool, unless another job already replaced this generation."""
+        async with self._lock:
+            if generation != self._generation or self._executor is None:
+                return
+            logger.warning("Restarting PDF extraction pool")
+            old, self._executor = self._executor, None
+            self._generation += 1
+            await asyncio.to_thread(self._terminate, old)
+
+    def _current(self):
+        if self._executor is None:
+            self._executor = self._new_executor()
+        return self._executor, self._generation
+
+    async def extract(self, pdf_path: str, output_path: Optional[str] = None, save: bool = True) -> Dict[str, Any]:
+        """
+        Run mypdf.extract_pdf_data in a worker process.
+
+        Args:
+            pdf_path: Path to the PDF file
+            output_path: Output JSON name, as for mypdf.extract_pdf_data
+            save: Write the JSON output; False only returns the result
+
+        Returns:
+            Dict containing the structured data extracted from the PDF
+
+        Raises:
+            PdfExtractionError: If the extraction timed out or its worker crashed
+        """
+        for attempt in range(2):
+            async with self._slots:
+                executor, generation = self._current()
+                future = asyncio.get_running_loop().run_in_executor(
+                    executor, self.extract_fn, pdf_path, output_path, save
+                )
+                try:
+                    return await asyncio.wait_for(future, self.timeout)
+                except asyncio.TimeoutError:
+                    await self._restart(generation)
+                    raise PdfExtractionError(f"PDF extraction timed out after {self.timeout:g}s")
+                except (BrokenProcessPool, asyncio.CancelledError):
+                    if asyncio.current_task().cancelling():
+                        # The caller itself is being cancelled
+                        raise
+                    if generation != self._generation and attempt == 0:
+                        # Collateral of another job's restart; run it again on the new pool
+                        continue
+                    await self._restart(generation)
+                    raise PdfExtractionError("PDF extraction worker crashed")
+        raise PdfExtractionError("PDF extraction worker crashed")
+
+    async def shutdown(self):
+        """Stop the pool and its workers."""
+        async with self._lock:
+            if self._executor is not None:
+                await asyncio.to_thread(self._terminate, self._executor)
+                self._executor = None
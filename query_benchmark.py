@@ -0,0 +1,113 @@
+import os
+import json
+import time
+import argparse
+from typing import Any, Dict, List, Optional, Set
+
+from dotenv import load_dotenv
+from openai import OpenAI
+
+import mypdf
+from faiss_agent import RagAgent
+from query_builder import build_search_query
+
+DEFAULT_QUERY = (
+    "Please help with a design of a water treatment pipeline consisting of pretreatment, "
+    "reverse osmosis design, and posttreatment for a borehole water source at a demand of "
+    "0.5 m3/hr for domestic purposes."
+)
+
+
+def load_report(path: str) -> Dict[str, Any]:
+    """Parsed lab report from a mypdf JSON output or a PDF."""
+    if path.lower().endswith(".pdf"):
+        return mypdf.extract_pdf_data(path, save=False)
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def retrieved_ids(agent: RagAgent, search_query: str) -> Set[int]:
+    """Every chunk retrieved for `search_query`, over all categories."""
+    embeddings = agent.get_embeddings(agent.search_queries(search_query))
+    return {int(idx) for ids, _ in agent.retrieve_hits(embeddings, search_query) for idx in ids}
+
+
+def compare_queries(agent: RagAgent, report: Dict[str, Any], user_query: str) -> Dict[str, Any]:
+    """
+    Retrieval overlap between the LLM and template search queries for one report.
+
+    Returns:
+        Dict with both queries, their generation times, the share of the LLM
+        query's chunks the template query also retrieves (recall) and the
+        Jaccard overlap of the two chunk sets
+    """
+    start = time.perf_counter()
+    llm_query = agent.generate_search_query(agent.prepare_lab_report(report), user_query)
+    llm_ms = (time.perf_counter() - start) * 1000
+    start = time.perf_counter()
+    template_query = build_search_query(report, user_query, agent.query_keywords)
+    template_ms = (time.perf_counter() - start) * 1000
+
+    llm_ids = retrieved_ids(agent, llm_query)
+    template_ids = retrieved_ids(agent, template_query)
+    shared = len(llm_ids & template_ids)
+    return {
+        "llm_query": llm_query,
+        "template_query": template_query,
+        "llm_ms": round(llm_ms, 1),
+        "template_ms": round(template_ms, 3),
+        "recall": round(shared / len(llm_ids), 3) if llm_ids else 0.0,
+        "jaccard": round(shared / len(llm_ids | template_ids), 3) if llm_ids or template_ids else 0.0,
+    }
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Compare retrieval for LLM-generated and template search queries")
+    parser.add_argument("reports", nargs="+", help="Lab report PDFs or mypdf JSON outputs")
+    parser.add_argument("--query", default=DEFAULT_QUERY, help="User query sent with every report")
+    parser.add_argument("--faiss-dir", default="FAISS")
+    parser.add_argument("--index-name", default="water-treatment")
+    parser.add_argument("--embedding-model", default="text-embedding-3-large")
+    parser.add_argument("--output", help="Write the per-report results to this JSON file")
+    args = parser.parse_args(argv)
+
+    load_dotenv('.env.local')
+    github_token = os.environ.get("GITHUB_TOKEN")
+    agent = RagAgent(
+        faiss_dir=args.faiss_dir,
+        index_name=args.index_name,
+        gpt_client=OpenAI(base_url=os.environ.get("GITHUB_ENDPOINT"), api_key=github_token),
+        gemini_client=None,
+        embedding_client=OpenAI(base_url=os.environ.get("AZURE_ENDPOINT"), api_key=github_token),
+        embedding_model=args.embedding_model,
+    )
+
+    results = []
+    for path in args.reports:
+        report = load_report(path)
+        if not report:
+            print(f"{path}: no tables could be extracted, skipped")
+            continue
+        result = {"report": path, **compare_queries(agent, report, args.query)}
+        results.append(result)
+        print(
+            f"{path}: recall {result['recall']:.2f}, jaccard {result['jaccard']:.2f}, "
+            f"llm {result['llm_ms']:.0f} ms, template {result['template_ms']:.2f} ms"
+        )
+
+    if results:
+        n = len(results)
+        print(
+            f"Mean over {n} reports: recall {sum(r['recall'] for r in results) / n:.2f}, "
+            f"jaccard {sum(r['jaccard'] for r in results) / n:.2f}, "
+            f"llm {sum(r['llm_ms'] for r in results) / n:.0f} ms, "
+            f"template {sum(r['template_ms'] for r in results) / n:.2f} ms"
+        )
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,126 @@
+import re
+from typing import Any, Dict, List, Optional, Tuple
+
+from lab_summary import classify_parameters
+
+STAGES = ("Pretreatment", "RO", "Posttreatment")
+
+# Parameter name pattern -> (stage, treatment keywords). Patterns are matched
+# case-insensitively against the parameter names of the parsed report; the
+# first matching pattern wins.
+TREATMENT_KEYWORDS: Dict[str, Tuple[str, str]] = {
+    r"\btds\b|dissolved solids|conductivity|\bec\b|salinity": ("RO", "high-TDS brackish water RO membranes, high-pressure pump, antiscalant dosing"),
+    r"chlorides?|sodium|potassium|sulph?ate|sulfate": ("RO", "brackish water RO membranes, antiscalant dosing"),
+    r"hardness|calcium|magnesium": ("Pretreatment", "cation-exchange water softener, antiscalant dosing"),
+    r"iron|manganese": ("Pretreatment", "iron and manganese removal, oxidation with air blower or chlorine dosing, manganese greensand filter media"),
+    r"turbidity|suspended solids|\btss\b|colou?r": ("Pretreatment", "coagulation, sedimentation, multimedia sand filter"),
+    r"bicarbonate|alkalinity|carbonate": ("Pretreatment", "antiscalant dosing, acid dosing"),
+    r"silic": ("Pretreatment", "silica antiscalant dosing"),
+    r"copper|lead|zinc|alumin|arsenic|chromium": ("Posttreatment", "heavy metal adsorption media"),
+    r"fluorid": ("Posttreatment", "fluoride removal media, activated alumina"),
+    r"nitrat|nitrit|ammon": ("Posttreatment", "nitrate removal ion exchange resin"),
+    r"coliform|e\.?\s?coli|bacteria": ("Posttreatment", "UV sterilizer, chlorination dosing"),
+}
+# pH is a range: the keywords depend on the side it falls out on
+PH_LOW_KEYWORDS = ("Posttreatment", "pH correction, calcite neutralizing filter, soda ash dosing")
+PH_HIGH_KEYWORDS = ("Pretreatment", "pH correction, acid dosing")
+
+_CAPACITY_RE = re.compile(
+    r"(\d+(?:\.\d+)?)\s*"
+    r"(m3|m³|cubic\s+met(?:er|re)s?|l|ltrs?|lit(?:er|re)s?|gallons?|gal)\s*"
+    r"(?:/|per\s+)\s*(hr|hour|h|day|d)\b"
+    r"|(\d+(?:\.\d+)?)\s*(lph|lpd|gpd|gph)\b",
+    re.IGNORECASE,
+)
+_LITRES_PER = {"m3": 1000.0, "m³": 1000.0, "cubic": 1000.0, "gal": 3.785}
+_USE_RE = re.compile(r"\b(domestic|commercial|industrial|irrigation|drinking|hotel|school|hospital|residential)\b", re.IGNORECASE)
+
+
+def parse_capacity(user_query: str) -> Optional[float]:
+    """First flow rate stated in the user query, in litres per hour, or None."""
+    match = _CAPACITY_RE.search(user_query or "")
+    if not match:
+        return None
+    if match.group(4):
+        number, unit = float(match.group(4)), match.group(5).lower()
+        volume, per = {"lph": ("l", "h"), "lpd": ("l", "d"), "gpd": ("gal", "d"), "gph": ("gal", "h")}[unit]
+    else:
+        number, volume, per = float(match.group(1)), match.group(2).lower(), match.group(3).lower()
+    litres = number * next((factor for prefix, factor in _LITRES_PER.items() if volume.startswith(prefix)), 1.0)
+    return litres / 24 if per.startswith("d") else litres
+
+
+def _ph_keywords(row: Dict[str, Any]) -> Tuple[str, str]:
+    match = re.search(r"\d+(?:\.\d+)?", row["value"])
+    if match and row["kind"] == "range" and float(match.group()) < row["low"]:
+        return PH_LOW_KEYWORDS
+    return PH_HIGH_KEYWORDS
+
+
+def build_search_query(
+    report: Dict[str, Any],
+    user_query: str,
+    keyword_table: Optional[Dict[str, Tuple[str, str]]] = None,
+    max_parameters: int = 12
+) -> str:
+    """
+    Build the retrieval query for a parsed lab report without an LLM call.
+
+    Follows the shape the search-query prompt asks the LLM for: the site and
+    source, the failing parameters with their values (worst exceedance
+    first), keywords for the treatment stages those parameters call for, and
+    the capacity and use stated by the user.
+
+    Args:
+        report: Parsed lab report (mypdf.extract_pdf_data output)
+        user_query: The user's request
+        keyword_table: Parameter pattern -> (stage, keywords); defaults to TREATMENT_KEYWORDS
+        max_parameters: Most failing parameters listed with their values
+
+    Returns:
+        Search query text
+    """
+    table = [(re.compile(pattern, re.IGNORECASE), target) for pattern, target in (keyword_table or TREATMENT_KEYWORDS).items()]
+    failing = classify_parameters(report)["failing"]
+
+    stage_keywords: Dict[str, List[str]] = {stage: [] for stage in STAGES}
+    for row in failing:
+        name = row["name"].lstrip("*# ")
+        if re.search(r"\bph\b", name, re.IGNORECASE):
+            target = _ph_keywords(row)
+        else:
+            target = next((target for pattern, target in table if pattern.search(name)), None)
+        if target is None:
+            continue
+        stage, keywords = target
+        for keyword in keywords.split(","):
+            keyword = keyword.strip()
+            if keyword and keyword not in stage_keywords.setdefault(stage, []):
+                stage_keywords[stage].append(keyword)
+
+    parts = []
+    sample = (report.get("header") or {}).get("sample_info") or {}
+    client = (report.get("header") or {}).get("client_info") or {}
+    source = " ".join(filter(None, (sample.get("source"), "water")))
+    if client.get("site_location"):
+        source += f" at {client['site_location']}"
+    parts.append(source)
+    if failing:
+        parts.append("exceeding WHO guidelines: " + ", ".join(
+            f"{row['name'].lstrip('*# ')} {row['value']} {row['unit']}".rstrip() for row in failing[:max_parameters]
+        ))
+
+    capacity = parse_capacity(user_query)
+    ro_line = "RO reverse osmosis system"
+    if capacity:
+        rate = f"{capacity:.0f}" if capacity >= 10 else f"{capacity:.1f}"
+        ro_line += f" {rate} L/hr, pump >= {rate} lph"
+    stage_keywords["RO"].insert(0, ro_line)
+    for stage in stage_keywords:
+        if stage_keywords[stage]:
+            parts.append(f"{stage}: " + ", ".join(stage_keywords[stage]))
+
+    uses = list(dict.fromkeys(use.lower() for use in _USE_RE.findall(user_query or "")))
+    if uses:
+        parts.append(f"for {' and '.join(uses)} use")
+    return "; ".join(parts)
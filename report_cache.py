@@ -0,0 +1,133 @@
+import os
+import re
+import json
+import hashlib
+import logging
+import tempfile
+from typing import Any, BinaryIO, Dict, Optional
+
+from mypdf import PARSER_VERSION
+
+logger = logging.getLogger("report_cache")
+
+OUTPUTS_DIR = "outputs"
+_ENTRY_RE = re.compile(r"^[0-9a-f]{64}\.p(?P<version>[^.]+)\.json$")
+
+
+def hash_upload(source: BinaryIO, dest_path: str, chunk_size: int = 1024 * 1024) -> str:
+    """
+    Copy an upload stream to `dest_path`, hashing it on the way.
+
+    Returns:
+        Hex SHA-256 of the bytes written
+    """
+    digest = hashlib.sha256()
+    with open(dest_path, "wb") as f:
+        while True:
+            chunk = source.read(chunk_size)
+            if not chunk:
+                break
+            digest.update(chunk)
+            f.write(chunk)
+    return digest.hexdigest()
+
+
+def file_sha256(path: str, chunk_size: int = 1024 * 1024) -> str:
+    """Hex SHA-256 of a file already on disk."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ReportCache:
+    """
+    Content-addressed cache of parsed lab reports.
+
+    Entries are compact JSON files named
+    `<sha256 of the PDF>.p<PARSER_VERSION>.json`, so the same bytes are
+    parsed once per parser version whatever the upload was called, and
+    different reports can never collide. The directory is bounded by total
+    size and entry count, evicting the least recently used entries (by
+    mtime, which a hit refreshes). Entries of other parser versions are
+    never hit and are evicted first.
+    """
+
+    def __init__(self, subdir: str = "reports", max_bytes: int = 256 * 1024 * 1024, max_entries: int = 10000):
+        """
+        Initialize the cache.
+
+        Args:
+            subdir: Cache directory, relative to OUTPUTS_DIR
+            max_bytes: Maximum total size of the cached JSON files
+            max_entries: Maximum number of cached reports
+        """
+        self.directory = os.path.join(OUTPUTS_DIR, subdir)
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        os.makedirs(self.directory, exist_ok=True)
+
+    def path(self, digest: str) -> str:
+        return os.path.join(self.directory, f"{digest}.p{PARSER_VERSION}.json")
+
+    def get(self, digest: str) -> Optional[Dict[str, Any]]:
+        """Parsed report for `digest`, or None on a miss."""
+        path = self.path(digest)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                report = json.load(f)
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning(f"Discarding unreadable cache entry {path}: {e}")
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+        logger.info(f"Report cache hit for {digest[:12]}")
+        return report
+
+    def put(self, digest: str, report: Dict[str, Any]):
+        """Store a parsed report atomically, then evict down to the bounds."""
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(report, f, separators=(",", ":"), ensure_ascii=False)
+            os.replace(tmp_path, self.path(digest))
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self.evict()
+
+    def evict(self):
+        """Delete entries until the cache is within its size and count bounds."""
+        entries = []
+        for name in os.listdir(self.directory):
+            match = _ENTRY_RE.match(name)
+            if not match:
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            current = match.group("version") == str(PARSER_VERSION)
+            entries.append((current, stat.st_mtime, stat.st_size, path))
+
+        # Stale parser versions first, then least recently used
+        entries.sort()
+        total = sum(entry[2] for entry in entries)
+        count = len(entries)
+        for current, _, size, path in entries:
+            if current and total <= self.max_bytes and count <= self.max_entries:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            count -= 1
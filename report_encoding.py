@@ -0,0 +1,105 @@
+import json
+import logging
+from typing import Any, Callable, Dict, List
+
+logger = logging.getLogger("report_encoding")
+
+TABLE_COLUMNS = ("parameter", "value", "unit", "guideline", "remark")
+
+# Header fields worth sending to the model, as (section, field, label)
+HEADER_FIELDS = (
+    ("client_info", "client", "client"),
+    ("client_info", "site_location", "site"),
+    ("sample_info", "source", "source"),
+    ("sample_info", "type_of_test", "test"),
+    ("sample_info", "sampling_date", "sampled"),
+    ("sample_info", "date_of_analysis", "analysed"),
+)
+
+
+def _cell(value: Any) -> str:
+    """Table cell text; the separator and line breaks would break the row."""
+    return " ".join(str(value if value is not None else "").replace("|", "/").split())
+
+
+def _rows(analysis: List[Dict[str, Any]]) -> List[Dict[str, str]]:
+    """Flatten mypdf's [{name: {...}}, ...] analysis list into rows."""
+    rows = []
+    for entry in analysis or []:
+        for name, fields in entry.items():
+            fields = fields or {}
+            rows.append({
+                "parameter": _cell(name),
+                "value": _cell(fields.get("value")),
+                "unit": _cell(fields.get("unit")),
+                "guideline": _cell(fields.get("who_guideline")),
+                "remark": _cell(fields.get("remark")),
+            })
+    return rows
+
+
+def encode_lab_report(report: Dict[str, Any], drop_passing: bool = False) -> str:
+    """
+    Encode a parsed lab report (mypdf.extract_pdf_data output) for a prompt.
+
+    The physical and chemical analyses become one pipe-separated table with
+    the columns parameter|value|unit|guideline|remark, so key names are not
+    repeated per parameter; method-of-analysis codes, the reference number,
+    sign-off and processing metadata are left out.
+
+    Args:
+        report: Parsed lab report
+        drop_passing: Leave parameters with a "Pass" remark out of the table;
+            their names are still listed on one line
+
+    Returns:
+        The encoded report
+    """
+    header = report.get("header") or {}
+    lines = []
+    meta = [
+        f"{label}: {_cell(header.get(section, {}).get(field))}"
+        for section, field, label in HEADER_FIELDS
+        if header.get(section, {}).get(field)
+    ]
+    if meta:
+        lines.append("; ".join(meta))
+
+    rows = _rows(report.get("physical_analysis")) + _rows(report.get("chemical_analysis"))
+    passing = []
+    if drop_passing:
+        passing = [row["parameter"] for row in rows if row["remark"].lower() == "pass"]
+        rows = [row for row in rows if row["remark"].lower() != "pass"]
+    lines.append("|".join(TABLE_COLUMNS))
+    lines.extend("|".join(row[column] for column in TABLE_COLUMNS) for row in rows)
+    if passing:
+        lines.append(f"passing (within guideline): {', '.join(passing)}")
+
+    for comment in report.get("final_comments") or []:
+        text = _cell(comment.get("comments")) if isinstance(comment, dict) else _cell(comment)
+        if text:
+            lines.append(f"comments: {text}")
+    return "\n".join(lines)
+
+
+def token_savings(report: Dict[str, Any], encoded: str, count_tokens: Callable[[str], int]) -> Dict[str, Any]:
+    """
+    Compare the encoded report with the compact JSON it replaces.
+
+    Args:
+        report: Parsed lab report
+        encoded: Output of encode_lab_report for it
+        count_tokens: Tokenizer, e.g. RagAgent.count_tokens
+
+    Returns:
+        Dict with json_tokens, encoded_tokens, saved_tokens and saved_ratio
+    """
+    json_tokens = count_tokens(json.dumps(report, separators=(",", ":"), ensure_ascii=False))
+    encoded_tokens = count_tokens(encoded)
+    saved = json_tokens - encoded_tokens
+    return {
+        "json_tokens": json_tokens,
+        "encoded_tokens": encoded_tokens,
+        "saved_tokens": saved,
+        "saved_ratio": round(saved / json_tokens, 3) if json_tokens else 0.0,
+    }
@@ -0,0 +1,123 @@
+import json
+import time
+
+import pytest
+from hypothesis import given, strategies as st
+
+from json_splitter import find_json_object, repair_json, scan_json_objects, split_json_and_markdown
+
+# JSON values whose strings may hold braces, quotes, backslashes and backticks
+json_strings = st.text(alphabet=st.characters(blacklist_categories=("Cs",)), max_size=20)
+json_values = st.recursive(
+    st.none() | st.booleans() | st.integers() | json_strings,
+    lambda children: st.lists(children, max_size=4) | st.dictionaries(json_strings, children, max_size=4),
+    max_leaves=20,
+)
+json_objects = st.dictionaries(json_strings, json_values, max_size=5)
+# Prose that cannot itself contain an object or a fence
+prose = st.text(alphabet=st.characters(blacklist_characters="{}`", blacklist_categories=("Cs",)), max_size=80)
+# One line of prose with stray opening braces and unbalanced quotes
+stray_prose = st.text(alphabet=st.characters(blacklist_characters="}`\n", blacklist_categories=("Cs",)), max_size=80)
+
+
+@given(json_objects, prose, prose)
+def test_unfenced_object_round_trips(obj, before, after):
+    encoded = json.dumps(obj)
+    json_part, markdown = split_json_and_markdown(f"{before}{encoded}{after}")
+    assert json.loads(json_part) == obj
+    assert markdown == "\n\n".join(part for part in (before.strip(), after.strip()) if part)
+
+
+@given(json_objects, prose, prose, st.sampled_from(["", "json"]))
+def test_fenced_object_round_trips(obj, before, after, info):
+    encoded = json.dumps(obj, indent=2)
+    json_part, markdown = split_json_and_markdown(f"{before}\n```{info}\n{encoded}\n```\n{after}")
+    assert json.loads(json_part) == obj
+    assert "```" not in markdown
+
+
+@given(json_objects, json_objects)
+def test_fenced_object_preferred_over_prose_object(prose_obj, fenced_obj):
+    text = f"Example {json.dumps(prose_obj)} above.\n```json\n{json.dumps(fenced_obj)}\n```"
+    json_part, _ = split_json_and_markdown(text)
+    assert json.loads(json_part) == fenced_obj
+
+
+@given(st.text(max_size=200))
+def test_arbitrary_text_only_raises_value_error(text):
+    try:
+        json_part, _ = split_json_and_markdown(text)
+    except ValueError:
+        return
+    assert json_part.startswith("{") and json_part.endswith("}")
+
+
+@given(st.text(max_size=200))
+def test_spans_are_balanced_and_ordered(text):
+    previous_end = 0
+    for span in scan_json_objects(text):
+        assert text[span.start] == "{" and text[span.end - 1] == "}"
+        assert span.start >= previous_end
+        previous_end = span.end
+
+
+@given(json_objects)
+def test_repair_leaves_valid_json_unchanged(obj):
+    encoded = json.dumps(obj)
+    assert repair_json(encoded) == encoded
+
+
+@given(st.dictionaries(st.from_regex(r"[A-Za-z_][A-Za-z0-9_]{0,8}", fullmatch=True), json_values, min_size=1, max_size=5))
+def test_repair_trailing_commas_and_bare_keys(obj):
+    body = ", ".join(f"{key}: {json.dumps(value)}" for key, value in obj.items())
+    assert json.loads(repair_json("{" + body + ",}")) == obj
+
+
+def test_repair_single_quotes_keep_string_contents():
+    fixed = repair_json("{'name': 'it\\'s \"fine\"', 'note': \"don't: touch, this\",}")
+    assert json.loads(fixed) == {"name": "it's \"fine\"", "note": "don't: touch, this"}
+
+
+def test_braces_in_strings_and_prose():
+    text = 'Use {curly} notes.\n{"a": "}{", "b": {"c": "\\"}"}} trailing }'
+    span = find_json_object(text)
+    assert json.loads(text[span.start:span.end]) == {"a": "}{", "b": {"c": '"}'}}
+
+
+@given(json_objects, stray_prose, stray_prose)
+def test_stray_braces_and_quotes_in_prose(obj, before, after):
+    json_part, markdown = split_json_and_markdown(f"{before}\n{json.dumps(obj)}\n{after}")
+    assert json.loads(json_part) == obj
+    assert markdown == "\n\n".join(part for part in (before.strip(), after.strip()) if part)
+
+
+@given(json_objects, stray_prose, stray_prose)
+def test_stray_braces_and_quotes_before_fence(obj, before, after):
+    text = f"{before}\n```json\n{json.dumps(obj, indent=2)}\n```\n{after}"
+    json_part, markdown = split_json_and_markdown(text)
+    assert json.loads(json_part) == obj
+    assert markdown == "\n\n".join(part for part in (before.strip(), after.strip()) if part)
+
+
+@pytest.mark.parametrize("text, expected_markdown", [
+    ('Note: use { carefully.\n{"a":1}\nbye', "Note: use { carefully.\n\nbye"),
+    ('Here :) "quote {\n```json\n{"a": 1}\n```', 'Here :) "quote {'),
+    ('Pipe is 2" wide, { see below\n{"a": 1}', 'Pipe is 2" wide, { see below'),
+])
+def test_unclosed_brace_does_not_hide_later_object(text, expected_markdown):
+    json_part, markdown = split_json_and_markdown(text)
+    assert json.loads(json_part) == {"a": 1}
+    assert markdown == expected_markdown
+
+
+def test_no_object_raises():
+    with pytest.raises(ValueError):
+        split_json_and_markdown("no json here ``` just a fence")
+
+
+def test_linear_time_on_large_input():
+    text = "x {" * 200_000 + '{"ok": true}'
+    start = time.perf_counter()
+    scan_json_objects(text)
+    split_json_and_markdown("prose " * 200_000 + '{"ok": true}')
+    assert time.perf_counter() - start < 5
@@ -0,0 +1,59 @@
+import asyncio
+import time
+
+import pytest
+
+from pdf_pool import PdfExtractionError, PdfExtractionPool
+
+
+# Stand-ins for mypdf.extract_pdf_data; module-level so spawned workers can import them
+def fake_extract(pdf_path, output_path=None, save=True):
+    if pdf_path == "hang":
+        time.sleep(600)
+    time.sleep(0.2)
+    return {"path": pdf_path}
+
+
+def _run(coro):
+    return asyncio.run(coro)
+
+
+def test_queued_jobs_do_not_count_against_the_timeout():
+    async def main():
+        pool = PdfExtractionPool(max_workers=1, timeout=5, extract_fn=fake_extract)
+        try:
+            return await asyncio.gather(*(pool.extract(f"report-{i}") for i in range(8)))
+        finally:
+            await pool.shutdown()
+
+    results = _run(main())
+    assert [result["path"] for result in results] == [f"report-{i}" for i in range(8)]
+
+
+def test_hanging_job_does_not_fail_queued_jobs():
+    async def main():
+        pool = PdfExtractionPool(max_workers=2, timeout=5, extract_fn=fake_extract)
+        try:
+            paths = ["hang"] + [f"report-{i}" for i in range(6)]
+            return await asyncio.gather(*(pool.extract(path) for path in paths), return_exceptions=True)
+        finally:
+            await pool.shutdown()
+
+    hung, *others = _run(main())
+    assert isinstance(hung, PdfExtractionError)
+    assert [result["path"] for result in others] == [f"report-{i}" for i in range(6)]
+
+
+def test_cancelled_caller_is_not_retried():
+    async def main():
+        pool = PdfExtractionPool(max_workers=1, timeout=5, extract_fn=fake_extract)
+        try:
+            task = asyncio.create_task(pool.extract("report"))
+            await asyncio.sleep(0.1)
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+        finally:
+            await pool.shutdown()
+
+    _run(main())
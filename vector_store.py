@@ -0,0 +1,456 @@
+import os
+import sys
+import json
+import shutil
+import argparse
+import logging
+import tempfile
+from datetime import datetime
+from collections.abc import Sequence
+from typing import Any, Dict, List, Optional
+
+import faiss
+import numpy as np
+
+from ann_index import IndexConfig, apply_search_config
+from lexical_index import BM25Index, load_or_build
+
+logger = logging.getLogger("vector_store")
+
+FORMAT_VERSION = 1
+CURRENT_FILE = "CURRENT"
+MANIFEST_FILE = "manifest.json"
+INDEX_FILE = "index.faiss"
+TEXTS_FILE = "texts.bin"
+TEXT_OFFSETS_FILE = "text_offsets.npy"
+METADATA_FILE = "metadata.json"  # all columns in one file; snapshots written before METADATA_COLUMNS_DIR
+METADATA_COLUMNS_DIR = "metadata"  # one JSON list per field, named by its position in manifest["metadata_columns"]
+METADATA_ROWS_FILE = "metadata_rows.bin"
+METADATA_ROW_OFFSETS_FILE = "metadata_row_offsets.npy"
+CATEGORIES_FILE = "categories.npy"
+IDS_FILE = "ids.json"
+TOKEN_COUNTS_FILE = "text_token_counts.npy"
+VECTORS_FILE = "vectors.npy"
+LEXICAL_FILE = "bm25.npz"
+# Snapshots kept by write_bundle by default, the current one included
+KEEP_SNAPSHOTS = 5
+
+
+class LazyTexts(Sequence):
+    """Chunk texts stored as one UTF-8 blob plus an offsets array; strings are decoded on access."""
+
+    def __init__(self, blob_path: str, offsets_path: str):
+        self.offsets = np.load(offsets_path, mmap_mode='r')
+        size = int(self.offsets[-1]) if len(self.offsets) else 0
+        # np.memmap cannot map an empty file
+        self.blob = np.memmap(blob_path, dtype='uint8', mode='r') if size else np.zeros(0, dtype='uint8')
+
+    def __len__(self) -> int:
+        return max(len(self.offsets) - 1, 0)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("text index out of range")
+        start, end = int(self.offsets[i]), int(self.offsets[i + 1])
+        return self.blob[start:end].tobytes().decode('utf-8')
+
+
+class ColumnarMetadata(Sequence):
+    """
+    Chunk metadata of a snapshot, read lazily.
+
+    Every field is stored as its own JSON list, so column() reads only
+    that field, and every row as a JSON record in a blob indexed by offset
+    (like the texts), so metadatas[i] decodes only row i. Snapshots written
+    before this layout keep all columns in one metadata.json, which is
+    parsed on first access.
+    """
+
+    def __init__(self, path: str, count: int, column_names: Optional[List[str]] = None):
+        """
+        Args:
+            path: Snapshot directory
+            count: Number of rows
+            column_names: Field names from the manifest; None for a snapshot with only metadata.json
+        """
+        self.path = path
+        self.count = count
+        self.column_names = column_names
+        self._columns: Dict[str, List[Any]] = {}
+        self._rows: Optional[LazyTexts] = None
+        self._legacy: Optional[Dict[str, List[Any]]] = None
+
+    def _legacy_columns(self) -> Dict[str, List[Any]]:
+        if self._legacy is None:
+            with open(os.path.join(self.path, METADATA_FILE), 'r', encoding='utf-8') as f:
+                self._legacy = json.load(f)["columns"]
+        return self._legacy
+
+    @property
+    def columns(self) -> Dict[str, List[Any]]:
+        """Every field for every row; reads all columns."""
+        if self.column_names is None:
+            return self._legacy_columns()
+        return {name: self.column(name) for name in self.column_names}
+
+    def column(self, name: str) -> List[Any]:
+        """Return one metadata field for every row (None where absent)."""
+        if self.column_names is None:
+            return self._legacy_columns().get(name, [None] * self.count)
+        if name not in self.column_names:
+            return [None] * self.count
+        if name not in self._columns:
+            position = self.column_names.index(name)
+            with open(os.path.join(self.path, METADATA_COLUMNS_DIR, f"{position}.json"), 'r', encoding='utf-8') as f:
+                self._columns[name] = json.load(f)
+        return self._columns[name]
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += self.count
+        if not 0 <= i < self.count:
+            raise IndexError("metadata index out of range")
+        if self.column_names is None:
+            return {key: values[i] for key, values in self._legacy_columns().items() if values[i] is not None}
+        if self._rows is None:
+            self._rows = LazyTexts(
+                os.path.join(self.path, METADATA_ROWS_FILE), os.path.join(self.path, METADATA_ROW_OFFSETS_FILE)
+            )
+        return json.loads(self._rows[i])
+
+
+def _write_blob(blob_path: str, offsets_path: str, strings: List[str]):
+    """Write strings as one UTF-8 blob plus an offsets array, the layout LazyTexts reads."""
+    encoded = [string.encode('utf-8') for string in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype='int64')
+    np.cumsum([len(b) for b in encoded], out=offsets[1:])
+    with open(blob_path, 'wb') as f:
+        for b in encoded:
+            f.write(b)
+    np.save(offsets_path, offsets)
+
+
+class VectorBundle:
+    """A loaded, read-only snapshot of the vector store."""
+
+    def __init__(self, path: str, mmap: bool = True):
+        """
+        Open a snapshot directory.
+
+        Args:
+            path: Snapshot directory (e.g. FAISS/water-treatment/v0001)
+            mmap: Open the FAISS index with IO_FLAG_MMAP instead of reading it into RAM
+        """
+        self.path = path
+        with open(os.path.join(path, MANIFEST_FILE), 'r', encoding='utf-8') as f:
+            self.manifest = json.load(f)
+        if self.manifest.get("format_version") != FORMAT_VERSION:
+            raise ValueError(f"Unsupported vector store format: {self.manifest.get('format_version')}")
+
+        index_path = os.path.join(path, INDEX_FILE)
+        try:
+            self.index = faiss.read_index(index_path, faiss.IO_FLAG_MMAP if mmap else 0)
+        except RuntimeError:
+            # Not every index type can be memory-mapped
+            self.index = faiss.read_index(index_path)
+        self.index_config = IndexConfig.from_dict(self.manifest.get("index_config"))
+        apply_search_config(self.index, self.index_config)
+        self.count = self.manifest["count"]
+        self.texts = LazyTexts(os.path.join(path, TEXTS_FILE), os.path.join(path, TEXT_OFFSETS_FILE))
+        self.metadatas = ColumnarMetadata(path, self.count, self.manifest.get("metadata_columns"))
+        self.category_names: List[str] = self.manifest["category_names"]
+        self.category_codes = np.load(os.path.join(path, CATEGORIES_FILE), mmap_mode='r')
+
+    @property
+    def version(self) -> str:
+        return os.path.basename(self.path)
+
+    @property
+    def category_code_map(self) -> Dict[str, int]:
+        return {name: code for code, name in enumerate(self.category_names)}
+
+    def ids(self) -> List[str]:
+        """Chunk ids, in vector order."""
+        with open(os.path.join(self.path, IDS_FILE), 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def vectors(self) -> Optional[np.ndarray]:
+        """Full-precision vectors (memory-mapped), if stored in the snapshot."""
+        path = os.path.join(self.path, VECTORS_FILE)
+        return np.load(path, mmap_mode='r') if os.path.exists(path) else None
+
+    def lexical_index(self) -> BM25Index:
+        """BM25 index over the texts, built and saved into the snapshot if missing."""
+        return load_or_build(os.path.join(self.path, LEXICAL_FILE), self.texts, lexical_fingerprint(self.count))
+
+    def text_token_counts(self, tokenizer_name: str) -> Optional[np.ndarray]:
+        """Token count of every text for `tokenizer_name`, if stored in the snapshot."""
+        if self.manifest.get("tokenizer") != tokenizer_name:
+            return None
+        path = os.path.join(self.path, TOKEN_COUNTS_FILE)
+        return np.load(path, mmap_mode='r') if os.path.exists(path) else None
+
+
+def lexical_fingerprint(count: int) -> str:
+    # Snapshots are immutable, so the chunk count identifies the text set
+    return f"snapshot:{count}"
+
+
+def has_bundle(store_dir: str) -> bool:
+    """True if `store_dir` contains a CURRENT pointer to a snapshot."""
+    return os.path.isfile(os.path.join(store_dir, CURRENT_FILE))
+
+
+def current_version(store_dir: str) -> str:
+    """Name of the snapshot CURRENT points to."""
+    with open(os.path.join(store_dir, CURRENT_FILE), 'r', encoding='utf-8') as f:
+        return f.read().strip()
+
+
+def load_bundle(store_dir: str, mmap: bool = True) -> VectorBundle:
+    """Open the snapshot that CURRENT points to."""
+    return VectorBundle(os.path.join(store_dir, current_version(store_dir)), mmap=mmap)
+
+
+def _versions(store_dir: str) -> List[str]:
+    """Snapshot names in `store_dir`, oldest first."""
+    names = [name for name in os.listdir(store_dir) if name.startswith("v") and name[1:].isdigit()]
+    return sorted(names, key=lambda name: int(name[1:]))
+
+
+def _next_version(store_dir: str) -> str:
+    versions = _versions(store_dir)
+    return f"v{int(versions[-1][1:]) + 1 if versions else 1:04d}"
+
+
+def prune_snapshots(store_dir: str, keep: int = KEEP_SNAPSHOTS) -> List[str]:
+    """
+    Delete all but the newest `keep` snapshots; the current one is never deleted.
+
+    Agents still reading a deleted snapshot keep their open files, and
+    AgentRegistry reloads them onto the current one.
+
+    Returns:
+        Names of the deleted snapshots
+    """
+    if keep <= 0:
+        return []
+    current = current_version(store_dir) if has_bundle(store_dir) else None
+    removed = [name for name in _versions(store_dir)[:-keep] if name != current]
+    for name in removed:
+        shutil.rmtree(os.path.join(store_dir, name), ignore_errors=True)
+    if removed:
+        logger.info(f"Pruned snapshots {', '.join(removed)} from {store_dir}")
+    return removed
+
+
+def _base_manifest(base_dir: Optional[str], ids: List[str]) -> Optional[Dict[str, Any]]:
+    """Manifest of snapshot `base_dir` if its chunks are the first rows of `ids`, else None."""
+    if not base_dir:
+        return None
+    try:
+        with open(os.path.join(base_dir, MANIFEST_FILE), 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+        with open(os.path.join(base_dir, IDS_FILE), 'r', encoding='utf-8') as f:
+            base_ids = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if manifest.get("format_version") != FORMAT_VERSION or base_ids != list(ids[:len(base_ids)]):
+        return None
+    return manifest
+
+
+def _lexical_index(base_dir: Optional[str], base: Optional[Dict[str, Any]], texts: List[str]) -> BM25Index:
+    """BM25 index over `texts`, extending the base snapshot's postings when it has them."""
+    if base is not None:
+        try:
+            index = BM25Index.load(os.path.join(base_dir, LEXICAL_FILE), lexical_fingerprint(base["count"]))
+        except Exception as e:
+            logger.warning(f"Could not read the BM25 index of {base_dir}: {e}")
+            index = None
+        if index is not None:
+            return index.extend(texts[base["count"]:])
+    return BM25Index.build(texts)
+
+
+def _token_counts(base_dir: Optional[str], base: Optional[Dict[str, Any]], texts: List[str], tokenizer) -> np.ndarray:
+    """Token count of every text, reusing the base snapshot's counts when they are for the same tokenizer."""
+    start, counts = 0, np.zeros(0, dtype='int32')
+    path = os.path.join(base_dir, TOKEN_COUNTS_FILE) if base is not None else None
+    if base is not None and base.get("tokenizer") == tokenizer.name and os.path.exists(path):
+        start, counts = base["count"], np.load(path).astype('int32')
+    added = [len(tokens) for tokens in tokenizer.encode_batch(list(texts[start:]))]
+    return np.concatenate([counts, np.array(added, dtype='int32')])
+
+
+def write_bundle(
+    store_dir: str,
+    index,
+    texts: List[str],
+    metadatas: List[Dict[str, Any]],
+    ids: List[str],
+    tokenizer=None,
+    vectors: Optional[np.ndarray] = None,
+    index_config: Optional[IndexConfig] = None,
+    extra_manifest: Optional[Dict[str, Any]] = None,
+    base_dir: Optional[str] = None,
+    keep: int = KEEP_SNAPSHOTS
+) -> str:
+    """
+    Write a new immutable snapshot and point CURRENT at it.
+
+    The snapshot is assembled in a temporary directory, renamed into place,
+    and CURRENT is replaced atomically, so readers never see a partial write.
+    When `base_dir` is the snapshot the new one was appended to, its token
+    counts and BM25 postings are carried over and only the new rows are
+    tokenized. Snapshots beyond the newest `keep` are then pruned.
+
+    Args:
+        store_dir: Store directory (e.g. FAISS/water-treatment)
+        index: FAISS index whose ids are positions in `texts`
+        texts: Chunk texts
+        metadatas: Metadata dict per chunk
+        ids: Chunk id per chunk
+        tokenizer: Optional tiktoken encoding; its token counts are stored for cold start
+        vectors: Optional float32 source vectors, kept so lossy indexes can be rebuilt
+        index_config: Index type and parameters the index was built with
+        extra_manifest: Additional manifest fields
+        base_dir: Parent snapshot whose chunks are the first rows of `ids`; ignored if they are not
+        keep: Snapshots to keep, the new one included (0 keeps all)
+
+    Returns:
+        Path of the new snapshot directory
+    """
+    if not (index.ntotal == len(texts) == len(metadatas) == len(ids)):
+        raise ValueError("index, texts, metadatas and ids must have the same length")
+    os.makedirs(store_dir, exist_ok=True)
+    base = _base_manifest(base_dir, ids)
+    tmp_dir = tempfile.mkdtemp(prefix=".tmp-", dir=store_dir)
+    try:
+        os.chmod(tmp_dir, 0o755)
+        faiss.write_index(index, os.path.join(tmp_dir, INDEX_FILE))
+
+        _write_blob(os.path.join(tmp_dir, TEXTS_FILE), os.path.join(tmp_dir, TEXT_OFFSETS_FILE), texts)
+
+        keys = sorted({key for metadata in metadatas for key in metadata})
+        os.makedirs(os.path.join(tmp_dir, METADATA_COLUMNS_DIR))
+        for position, key in enumerate(keys):
+            with open(os.path.join(tmp_dir, METADATA_COLUMNS_DIR, f"{position}.json"), 'w', encoding='utf-8') as f:
+                json.dump([metadata.get(key) for metadata in metadatas], f, ensure_ascii=False)
+        _write_blob(
+            os.path.join(tmp_dir, METADATA_ROWS_FILE),
+            os.path.join(tmp_dir, METADATA_ROW_OFFSETS_FILE),
+            [
+                json.dumps({key: value for key, value in metadata.items() if value is not None}, ensure_ascii=False)
+                for metadata in metadatas
+            ],
+        )
+
+        category_names = sorted({metadata.get("category") or "" for metadata in metadatas})
+        code_map = {name: code for code, name in enumerate(category_names)}
+        dtype = 'int8' if len(category_names) < 128 else 'int16'
+        codes = np.array([code_map[metadata.get("category") or ""] for metadata in metadatas], dtype=dtype)
+        np.save(os.path.join(tmp_dir, CATEGORIES_FILE), codes)
+
+        with open(os.path.join(tmp_dir, IDS_FILE), 'w', encoding='utf-8') as f:
+            json.dump(list(ids), f, ensure_ascii=False)
+
+        _lexical_index(base_dir, base, texts).save(os.path.join(tmp_dir, LEXICAL_FILE), lexical_fingerprint(len(texts)))
+
+        if vectors is not None:
+            np.save(os.path.join(tmp_dir, VECTORS_FILE), np.ascontiguousarray(vectors, dtype='float32'))
+
+        manifest = {
+            "format_version": FORMAT_VERSION,
+            "created": datetime.now().isoformat(),
+            "count": len(texts),
+            "dim": index.d,
+            "index_type": type(index).__name__,
+            "index_config": (index_config or IndexConfig()).to_dict(),
+            "category_names": category_names,
+            "metadata_columns": keys,
+        }
+        if tokenizer is not None:
+            counts = _token_counts(base_dir, base, texts, tokenizer)
+            np.save(os.path.join(tmp_dir, TOKEN_COUNTS_FILE), counts)
+            manifest["tokenizer"] = tokenizer.name
+        manifest.update(extra_manifest or {})
+        with open(os.path.join(tmp_dir, MANIFEST_FILE), 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, indent=2)
+
+        version = _next_version(store_dir)
+        version_dir = os.path.join(store_dir, version)
+        os.rename(tmp_dir, version_dir)
+    except Exception:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+
+    pointer_tmp = os.path.join(store_dir, f".{CURRENT_FILE}.tmp")
+    with open(pointer_tmp, 'w', encoding='utf-8') as f:
+        f.write(version)
+    os.replace(pointer_tmp, os.path.join(store_dir, CURRENT_FILE))
+    logger.info(f"Wrote vector store snapshot {version_dir} ({len(texts)} chunks)")
+    prune_snapshots(store_dir, keep)
+    return version_dir
+
+
+def load_legacy(faiss_dir: str, index_name: str):
+    """Load the legacy index + pickle files. Only use on trusted files."""
+    import pickle
+
+    index = faiss.read_index(os.path.join(faiss_dir, f"{index_name}.index"))
+    with open(os.path.join(faiss_dir, f"{index_name}_texts.pkl"), 'rb') as f:
+        texts = pickle.load(f)
+    with open(os.path.join(faiss_dir, f"{index_name}_metadata.pkl"), 'rb') as f:
+        metadatas = pickle.load(f)
+    ids_path = os.path.join(faiss_dir, f"{index_name}_ids.pkl")
+    if os.path.exists(ids_path):
+        with open(ids_path, 'rb') as f:
+            ids = pickle.load(f)
+    else:
+        ids = [metadata.get("id", str(i)) for i, metadata in enumerate(metadatas)]
+    return index, texts, metadatas, ids
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Manage the versioned FAISS vector store")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    convert = sub.add_parser("convert", help="Convert the legacy .index/.pkl files into a snapshot")
+    convert.add_argument("--faiss-dir", default="FAISS")
+    convert.add_argument("--index-name", default="water-treatment")
+
+    info = sub.add_parser("info", help="Show the current snapshot")
+    info.add_argument("--faiss-dir", default="FAISS")
+    info.add_argument("--index-name", default="water-treatment")
+
+    args = parser.parse_args(argv)
+    store_dir = os.path.join(args.faiss_dir, args.index_name)
+
+    if args.command == "convert":
+        import tiktoken
+
+        index, texts, metadatas, ids = load_legacy(args.faiss_dir, args.index_name)
+        path = write_bundle(store_dir, index, texts, metadatas, ids, tokenizer=tiktoken.get_encoding("cl100k_base"))
+        print(f"Wrote {path}")
+    elif args.command == "info":
+        if not has_bundle(store_dir):
+            print(f"No snapshot in {store_dir}")
+            return 1
+        bundle = load_bundle(store_dir)
+        print(json.dumps({"version": bundle.version, **bundle.manifest}, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main())